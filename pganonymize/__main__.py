@@ -9,8 +9,7 @@ def main():
 
     try:
         args = get_arg_parser().parse_args()
-        main(args)
-        exit_status = 0
+        exit_status = main(args) or 0
     except KeyboardInterrupt:
         exit_status = 1
     sys.exit(exit_status)
@@ -0,0 +1,231 @@
+"""A columnar representation of a batch of table rows"""
+
+from __future__ import absolute_import
+
+try:
+    from collections.abc import Mapping
+except ImportError:  # Python 2.7
+    from collections import Mapping
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8
+    shared_memory = None
+
+# PostgreSQL text values can't contain NUL characters, so they can separate the values of a column in a shared buffer
+SEPARATOR = u'\0'
+
+
+class Chunk(object):
+    """
+    A batch of table rows, that is stored column by column.
+
+    Every column is a list with the value of every row, ``NULL`` is stored as None. The ``altered`` list is a mask,
+    that marks the rows whose values have been anonymized.
+    """
+
+    __slots__ = ('column_names', 'columns', 'altered')
+
+    def __init__(self, column_names, columns, altered=None):
+        self.column_names = list(column_names)
+        self.columns = dict(zip(self.column_names, columns))
+        length = len(columns[0]) if columns else 0
+        self.altered = altered if altered is not None else [False] * length
+
+    @classmethod
+    def from_rows(cls, column_names, rows):
+        """
+        Create a chunk from a list of rows.
+
+        :param list column_names: The names of the columns, in the order of the row values.
+        :param list rows: The rows, either sequences with a value for every column or mappings by the column names.
+        :rtype: Chunk
+        """
+        if not rows:
+            return cls(column_names, [[] for _ in column_names])
+        if isinstance(rows[0], Mapping):
+            return cls(column_names, [[row[column_name] for row in rows] for column_name in column_names])
+        return cls(column_names, [list(column) for column in zip(*rows)])
+
+    def __len__(self):
+        return len(self.altered)
+
+    def __getstate__(self):
+        # Python 2.7 can't pickle objects with __slots__ without this
+        return self.column_names, [self.columns[column_name] for column_name in self.column_names], self.altered
+
+    def __setstate__(self, state):
+        column_names, columns, altered = state
+        self.column_names = column_names
+        self.columns = dict(zip(column_names, columns))
+        self.altered = altered
+
+    def column(self, column_name):
+        """
+        Return the values of a column.
+
+        :param str column_name: The name of the column
+        :return: The list of values, that can be altered in place.
+        :rtype: list
+        """
+        return self.columns[column_name]
+
+    def row(self, index):
+        """
+        Return a single row.
+
+        :param int index: The index of the row, negative indexes count from the end.
+        :return: A dictionary with the values by the column names.
+        :rtype: dict
+        """
+        return dict((column_name, self.columns[column_name][index]) for column_name in self.column_names)
+
+    def rows(self, column_names=None, convert=None):
+        """
+        Return the rows as tuples, e.g. to be written with ``COPY``.
+
+        :param list column_names: The columns and their order, all columns of the chunk if omitted.
+        :param convert: A function to convert every value with.
+        :rtype: list
+        """
+        columns = [self.columns[column_name] for column_name in column_names or self.column_names]
+        if convert is not None:
+            columns = [[convert(value) for value in column] for column in columns]
+        return list(zip(*columns))
+
+    def altered_indexes(self):
+        """
+        Return the indexes of the anonymized rows.
+
+        :rtype: list
+        """
+        return [index for index, altered in enumerate(self.altered) if altered]
+
+    def take(self, indexes, column_names=None):
+        """
+        Return a new chunk with some of the rows and columns.
+
+        :param list indexes: The indexes of the rows
+        :param list column_names: The columns to take, all columns if omitted.
+        :rtype: Chunk
+        """
+        column_names = column_names or self.column_names
+        columns = [self.columns[column_name] for column_name in column_names]
+        return Chunk(column_names, [[column[index] for index in indexes] for column in columns],
+                     [self.altered[index] for index in indexes])
+
+    def put(self, indexes, chunk):
+        """
+        Replace the values and the mask of some of the rows with the rows of another chunk.
+
+        :param list indexes: The indexes of the replaced rows, one for every row of the other chunk.
+        :param Chunk chunk: A chunk with the new values, only its columns are replaced.
+        """
+        for column_name in chunk.column_names:
+            column = self.columns[column_name]
+            for index, value in zip(indexes, chunk.columns[column_name]):
+                column[index] = value
+        for index, altered in zip(indexes, chunk.altered):
+            self.altered[index] = altered
+
+
+class SharedChunk(object):
+    """
+    A chunk, whose text columns are written once into a shared memory buffer to pass it to another process.
+
+    Every text column is stored at an offset of the buffer as its values separated by NUL characters and encoded with
+    UTF-8. Only this layout, the positions of the ``NULL`` values, the other columns and the mask are pickled.
+    Requires Python 3.8 or later, see :data:`shared_memory`.
+    """
+
+    def __init__(self, name, length, column_names, layout, columns, altered, memory=None):
+        self.name = name
+        self.length = length
+        self.column_names = column_names
+        self.layout = layout
+        self.columns = columns
+        self.altered = altered
+        #: The shared memory buffer, if it has been created for this chunk
+        self.memory = memory
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['memory'] = None
+        return state
+
+    @classmethod
+    def create(cls, chunk, memory=None, check=True):
+        """
+        Write the text columns of a chunk into a shared memory buffer.
+
+        A new buffer is created (with some room to spare) unless the given one is large enough. A new buffer has to be
+        removed with :meth:`unlink` by the process that reads the chunk last, or reused.
+
+        :param Chunk chunk: The chunk
+        :param memory: An open :class:`multiprocessing.shared_memory.SharedMemory` buffer to reuse.
+        :param bool check: Make sure the text values don't contain NUL characters. Values read from PostgreSQL
+          can't contain them.
+        :rtype: SharedChunk
+        """
+        layout = {}
+        columns = {}
+        buffers = []
+        size = 0
+        for column_name in chunk.column_names:
+            column = chunk.column(column_name)
+            values = [value for value in column if value is not None]
+            data = None
+            if values and all(type(value) is str for value in values):
+                text = SEPARATOR.join(values)
+                # A value with a NUL character would be split
+                if not check or text.count(SEPARATOR) == len(values) - 1:
+                    data = text.encode('utf-8')
+            if data is None:
+                columns[column_name] = column
+                continue
+            nulls = [index for index, value in enumerate(column) if value is None] if len(values) < len(column) else []
+            layout[column_name] = (size, len(data), nulls)
+            buffers.append(data)
+            size += len(data)
+        if memory is None or memory.size < size:
+            memory = shared_memory.SharedMemory(create=True, size=max(size + size // 4, 1))
+            created = memory
+        else:
+            created = None
+        offset = 0
+        for data in buffers:
+            memory.buf[offset:offset + len(data)] = data
+            offset += len(data)
+        return cls(memory.name, len(chunk), chunk.column_names, layout, columns, chunk.altered, created)
+
+    def to_chunk(self):
+        """
+        Read the chunk from the shared memory buffer.
+
+        :rtype: Chunk
+        """
+        memory = shared_memory.SharedMemory(name=self.name)
+        try:
+            columns = []
+            for column_name in self.column_names:
+                if column_name not in self.layout:
+                    columns.append(self.columns[column_name])
+                    continue
+                offset, size, nulls = self.layout[column_name]
+                values = bytes(memory.buf[offset:offset + size]).decode('utf-8').split(SEPARATOR)
+                if nulls:
+                    values = iter(values)
+                    nulls = set(nulls)
+                    values = [None if index in nulls else next(values) for index in range(self.length)]
+                columns.append(values)
+        finally:
+            memory.close()
+        return Chunk(self.column_names, columns, self.altered)
+
+    def unlink(self):
+        """
+        Remove the shared memory buffer.
+        """
+        memory = self.memory or shared_memory.SharedMemory(name=self.name)
+        memory.close()
+        memory.unlink()
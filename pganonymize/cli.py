@@ -6,10 +6,15 @@ import argparse
 import logging
 import time
 
+from pganonymize.clone import clone_tables
 from pganonymize.config import config, validate_args_with_config
 from pganonymize.constants import DATABASE_ARGS, DEFAULT_SCHEMA_FILE
+from pganonymize.dump import anonymize_dump_file
 from pganonymize.providers import provider_registry
-from pganonymize.utils import anonymize_tables, create_database_dump, get_connection, truncate_tables
+from pganonymize.utils import (
+    anonymize_tables, apply_settings, create_database_dump, execute_init_sql, get_connection, get_connection_pool,
+    get_pool_size, truncate_tables,
+)
 
 
 def get_pg_args(args):
@@ -48,13 +53,91 @@ def get_arg_parser():
     parser.add_argument('--dump-file', help='Create a database dump file with the given name')
     parser.add_argument('--dump-options', help='Options to pass to the pg_dump command',
                         default='--format custom --compress 9')
+    parser.add_argument(
+        '--dump-jobs',
+        type=int,
+        help='Number of tables to dump concurrently, more than one job creates a dump in the directory format',
+        default=1,
+    )
+    parser.add_argument(
+        '--dump-compress',
+        help='Compression method and/or level to pass to the pg_dump command, e.g. "9", "lz4" or "zstd:3"',
+    )
+    parser.add_argument(
+        '--input-dump',
+        help=(
+            'Anonymize the data of a plain-format dump file (or "-" for the standard input) without a database '
+            'connection and write the anonymized dump to the --dump-file (or the standard output)'
+        ),
+    )
+    parser.add_argument(
+        '--target',
+        help=(
+            'Connection string of a database to copy all tables into, anonymizing the tables of the schema on the '
+            'way, instead of changing the database in place. The tables have to exist in the target database'
+        ),
+    )
     parser.add_argument('--init-sql', help='SQL to run before starting anonymization', default=False)
     parser.add_argument(
         '--parallel',
         action='store_true',
         help=(
-            'Parallelize anonymization of value.'
-            'WARNING: `fake.unique.*` providers are not compatible with this option'
+            'Anonymize the rows of every batch in parallel by one worker process per CPU. The values of '
+            '`fake.unique.*` providers are kept unique across all workers'
+        ),
+        default=False,
+    )
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        help=(
+            'Number of tables to anonymize concurrently, each on its own database connection and committed on its own. '
+            'The default of 1 anonymizes all tables within a single transaction'
+        ),
+        default=1,
+    )
+    parser.add_argument(
+        '--pushdown',
+        action='store_true',
+        help='Let PostgreSQL anonymize all fields whose providers it can evaluate natively with a single UPDATE',
+        default=False,
+    )
+    parser.add_argument(
+        '--exact-count',
+        action='store_true',
+        help='Count the rows of every table before anonymizing it instead of using the planner\'s estimates',
+        default=False,
+    )
+    parser.add_argument(
+        '--binary-copy',
+        action='store_true',
+        help='Read the table data with a binary COPY instead of a server-side cursor',
+        default=False,
+    )
+    parser.add_argument(
+        '--pipeline-depth',
+        type=int,
+        help=(
+            'Fetch, anonymize and import the batches of a table concurrently, with at most this many batches waiting '
+            'between the stages. The default of 0 processes the batches one after another'
+        ),
+        default=0,
+    )
+    parser.add_argument(
+        '--batch-commit',
+        action='store_true',
+        help=(
+            'Apply and commit the anonymized rows after every batch instead of once at the end, the rows are fetched '
+            'in the order of the primary key'
+        ),
+        default=False,
+    )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help=(
+            'Keep the progress in the "pganonymize_checkpoint" table and continue an interrupted run, tables and '
+            'batches that have already been committed are skipped'
         ),
         default=False,
     )
@@ -78,22 +161,67 @@ def main(args):
 
     validate_args_with_config(args, config)
 
+    if args.input_dump:
+        start_time = time.time()
+        anonymize_dump_file(args.input_dump, args.dump_file)
+        logging.info('Anonymization took {:.2f}s'.format(time.time() - start_time))
+        return 0
+
     pg_args = get_pg_args(args)
     connection = get_connection(pg_args)
     if args.init_sql:
-        cursor = connection.cursor()
-        logging.info('Executing initialisation sql {}'.format(args.init_sql))
-        cursor.execute(args.init_sql)
-        cursor.close()
+        execute_init_sql(connection, args.init_sql)
+    settings = config.schema.get('settings', {})
+    if settings:
+        apply_settings(connection, settings)
+
+    if args.target:
+        source_pool = get_connection_pool(pg_args, args.jobs, init_sql=args.init_sql, settings=settings)
+        target_pool = get_connection_pool({'dsn': args.target}, args.jobs, settings=settings)
+        start_time = time.time()
+        try:
+            clone_tables(
+                connection,
+                source_pool,
+                target_pool,
+                jobs=args.jobs,
+                verbose=args.verbose,
+                dry_run=args.dry_run,
+                parallel=args.parallel,
+                binary_copy=args.binary_copy,
+                pipeline_depth=args.pipeline_depth,
+            )
+        finally:
+            source_pool.closeall()
+            target_pool.closeall()
+        connection.close()
+        logging.info('Anonymization took {:.2f}s'.format(time.time() - start_time))
+        return 0
+    connection_pool = None
+    pool_size = get_pool_size(config.schema.get('tables', []), args.jobs)
+    if pool_size:
+        connection_pool = get_connection_pool(pg_args, pool_size, init_sql=args.init_sql, settings=settings)
 
     start_time = time.time()
-    truncate_tables(connection)
-    anonymize_tables(
-        connection,
-        verbose=args.verbose,
-        dry_run=args.dry_run,
-        parallel=args.parallel,
-    )
+    try:
+        truncate_tables(connection)
+        anonymize_tables(
+            connection,
+            verbose=args.verbose,
+            dry_run=args.dry_run,
+            parallel=args.parallel,
+            jobs=args.jobs,
+            connection_pool=connection_pool,
+            pushdown=args.pushdown,
+            exact_count=args.exact_count,
+            binary_copy=args.binary_copy,
+            pipeline_depth=args.pipeline_depth,
+            batch_commit=args.batch_commit,
+            resume=args.resume,
+        )
+    finally:
+        if connection_pool is not None:
+            connection_pool.closeall()
 
     if not args.dry_run:
         connection.commit()
@@ -103,4 +231,5 @@ def main(args):
     logging.info('Anonymization took {:.2f}s'.format(end_time - start_time))
 
     if args.dump_file:
-        create_database_dump(args.dump_file, pg_args, args.dump_options)
+        return create_database_dump(args.dump_file, pg_args, args.dump_options, jobs=args.dump_jobs,
+                                    compress=args.dump_compress)
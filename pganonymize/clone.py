@@ -0,0 +1,334 @@
+"""Copying the anonymized data of a source database into a target database"""
+
+from __future__ import absolute_import
+
+import logging
+import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from psycopg2.sql import SQL, Composed, Identifier
+
+from pganonymize.config import config
+from pganonymize.constants import DEFAULT_CHUNK_SIZE
+from pganonymize.dump import get_table_name
+from pganonymize.utils import (
+    WorkerPool, compile_table_plan, fetch_batches, get_copy_column_types, get_fetch_condition, get_fetch_cursor,
+    get_json_columns, get_table_fields, import_data, log_sql_excludes, process_chunk, run_pipeline, split_excludes,
+)
+
+
+def clone_tables(connection, source_pool, target_pool, jobs=1, verbose=False, dry_run=False, parallel=False,
+                 binary_copy=False, pipeline_depth=0):
+    """
+    Copy all tables of the source database into the target database, anonymizing the tables of the schema definition.
+
+    The tables have to exist in the target database already. Every table is copied on its own pair of pooled
+    connections and committed as soon as it has been copied. All source connections read the same snapshot, so the
+    copied data is consistent even if the source database is changed meanwhile.
+
+    :param connection: A connection to the source database, that exports the snapshot and has to be kept open until all
+      tables have been copied.
+    :param pganonymize.utils.ConnectionPool source_pool: The pool to take the source connections from.
+    :param pganonymize.utils.ConnectionPool target_pool: The pool to take the target connections from.
+    :param int jobs: Number of tables to copy concurrently.
+    :param bool verbose: Display logging information and a progress bar.
+    :param bool dry_run: Script is running in dry-run mode, the target database is rolled back.
+    :param bool parallel: Data anonymization is done in parallel.
+    :param bool binary_copy: Read the data of the anonymized tables with a binary ``COPY`` instead of a server-side
+      cursor.
+    :param int pipeline_depth: Fetch, anonymize and import the batches concurrently with at most this many batches
+      waiting between the stages. 0 processes the batches one after another.
+    """
+    snapshot = export_snapshot(connection)
+    definitions = {}
+    for definition in config.schema.get('tables', []):
+        table_name, table_definition = list(definition.items())[0]
+        definitions[table_name] = table_definition
+    truncated_tables = config.schema.get('truncate', [])
+    tables = get_tables(connection)
+    found_tables = set()
+    items = []
+    for table in tables:
+        table_name = get_table_name(list(table), definitions, truncated_tables)
+        found_tables.add(table_name)
+        if table_name in truncated_tables:
+            logging.info('Skipping truncated table "%s"', table_name)
+            continue
+        items.append((table, definitions.get(table_name)))
+    for table_name in list(definitions) + truncated_tables:
+        if table_name not in found_tables:
+            logging.warning('Table "%s" was not found in the source database', table_name)
+    for table, table_definition in items:
+        if table_definition is not None:
+            # Fail before any table has been copied
+            get_copy_column_types(connection, table, get_copy_column_names(connection, table))
+
+    def run(item):
+        table, table_definition = item
+        source_connection = source_pool.getconn()
+        target_connection = target_pool.getconn()
+        try:
+            set_snapshot(source_connection, snapshot)
+            clone_table(source_connection, target_connection, table, table_definition, verbose=verbose,
+                        parallel=parallel, binary_copy=binary_copy, pipeline_depth=pipeline_depth)
+            if dry_run:
+                target_connection.rollback()
+            else:
+                target_connection.commit()
+        except Exception:
+            target_connection.rollback()
+            raise
+        finally:
+            source_connection.rollback()
+            source_pool.putconn(source_connection)
+            target_pool.putconn(target_connection)
+
+    worker_pool = WorkerPool(get_table_fields(config.schema.get('tables', []))) if parallel else None
+    pool = ThreadPool(jobs)
+    try:
+        for _ in pool.imap_unordered(run, items):
+            pass
+    except Exception:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+        if worker_pool is not None:
+            worker_pool.close()
+
+    target_connection = target_pool.getconn()
+    try:
+        copy_sequences(connection, target_connection)
+        if dry_run:
+            target_connection.rollback()
+        else:
+            target_connection.commit()
+    except Exception:
+        target_connection.rollback()
+        raise
+    finally:
+        target_pool.putconn(target_connection)
+
+
+def clone_table(source_connection, target_connection, table, table_definition=None, verbose=False, parallel=False,
+                binary_copy=False, pipeline_depth=0):
+    """
+    Copy a single table into the target database.
+
+    Tables without a definition are streamed with a binary ``COPY`` from the source into the target database. The
+    rows of tables with a definition are written with pgcopy, see :func:`pganonymize.utils.get_copy_column_types` for
+    the supported column types, and anonymized like :func:`pganonymize.utils.build_and_then_rewrite_data` does:
+    excluded rows are copied unchanged and the rows that don't match the ``search`` condition are streamed unchanged.
+    With a ``search`` condition or exclude patterns PostgreSQL can evaluate, the excluded rows and the rows without any
+    value to anonymize are streamed unchanged as well.
+
+    :param source_connection: A connection to the source database.
+    :param target_connection: A connection to the target database.
+    :param tuple table: The schema name and the name of the table.
+    :param dict table_definition: The table definition from the schema.
+    :param bool verbose: Display logging information and a progress bar.
+    :param bool parallel: Data anonymization is done in parallel.
+    :param bool binary_copy: Read the table data with a binary ``COPY`` instead of a server-side cursor.
+    :param int pipeline_depth: Fetch, anonymize and import the batches concurrently with at most this many batches
+      waiting between the stages. 0 processes the batches one after another.
+    """
+    start_time = time.time()
+    qualified_name = '.'.join(table)
+    column_names = get_copy_column_names(source_connection, table)
+    if table_definition is None:
+        logging.info('Copying table "%s"', qualified_name)
+        copy_table_data(source_connection, target_connection, table, column_names)
+    else:
+        logging.info('Copying and anonymizing table "%s"', qualified_name)
+        columns = table_definition.get('fields', [])
+        excludes = table_definition.get('excludes', [])
+        search = table_definition.get('search')
+        chunk_size = table_definition.get('chunk_size', DEFAULT_CHUNK_SIZE)
+        if search or split_excludes(excludes)[0]:
+            # The rows are split by a condition anyway, so PostgreSQL filters all rows that are copied unchanged
+            search, excludes = get_fetch_condition(source_connection, search, columns, excludes)
+        sql_select = SQL('SELECT {columns} FROM {table}').format(
+            columns=SQL(', ').join([Identifier(column_name) for column_name in column_names]),
+            table=Identifier(*table),
+        )
+        if search:
+            copy_table_data(source_connection, target_connection, table, column_names,
+                            condition='({search_condition}) IS NOT TRUE'.format(search_condition=search))
+            sql_select = Composed([sql_select, SQL(' WHERE {search_condition}'.format(search_condition=search))])
+        cursor = get_fetch_cursor(source_connection, qualified_name, column_names, binary_copy=binary_copy)
+        cursor.execute(sql_select.as_string(source_connection))
+        plan = compile_table_plan(columns, excludes)
+        json_columns = get_json_columns(get_copy_column_types(source_connection, table, column_names))
+
+        def transform(chunk):
+            # Rows that haven't been anonymized are copied unchanged
+            return process_chunk(chunk, plan, verbose=verbose, parallel=parallel)
+
+        batches = fetch_batches(cursor, column_names, chunk_size, table=qualified_name, verbose=verbose)
+        run_pipeline(batches, transform,
+                     lambda data: import_data(target_connection, qualified_name, column_names, data, json_columns),
+                     depth=pipeline_depth)
+        cursor.close()
+        plan.excludes.log_counts(qualified_name)
+        log_sql_excludes(qualified_name, table_definition.get('excludes', []), excludes)
+        plan.uniques.log_counts(qualified_name)
+    end_time = time.time()
+    logging.info('{} copy took {:.2f}s'.format(qualified_name, end_time - start_time))
+
+
+def copy_table_data(source_connection, target_connection, table, column_names, condition=None):
+    """
+    Stream the rows of a table with a binary ``COPY`` from the source into the target database.
+
+    The data is passed through a pipe, so neither the whole table is kept in memory nor written to disk.
+
+    :param source_connection: A connection to the source database.
+    :param target_connection: A connection to the target database.
+    :param tuple table: The schema name and the name of the table.
+    :param list column_names: The columns to copy.
+    :param str condition: A SQL condition to copy only some of the rows.
+    """
+    sql_table = Identifier(*table)
+    sql_columns = SQL(', ').join([Identifier(column_name) for column_name in column_names])
+    if condition:
+        source_sql = SQL('COPY (SELECT {columns} FROM {table} WHERE {condition}) TO STDOUT (FORMAT binary)').format(
+            columns=sql_columns, table=sql_table, condition=SQL(condition))
+    else:
+        source_sql = SQL('COPY {table} ({columns}) TO STDOUT (FORMAT binary)').format(
+            table=sql_table, columns=sql_columns)
+    target_sql = SQL('COPY {table} ({columns}) FROM STDIN (FORMAT binary)').format(
+        table=sql_table, columns=sql_columns)
+    read_fd, write_fd = os.pipe()
+    reader = os.fdopen(read_fd, 'rb')
+    writer = os.fdopen(write_fd, 'wb')
+    errors = []
+
+    def produce():
+        cursor = source_connection.cursor()
+        try:
+            cursor.copy_expert(source_sql.as_string(source_connection), writer)
+        except Exception as exc:
+            errors.append(exc)
+        finally:
+            writer.close()
+            cursor.close()
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    cursor = target_connection.cursor()
+    try:
+        cursor.copy_expert(target_sql.as_string(target_connection), reader)
+    except Exception:
+        reader.close()
+        thread.join()
+        # A failing source also aborts the target COPY, its error is the cause
+        if errors:
+            raise errors[0]
+        raise
+    finally:
+        cursor.close()
+    reader.close()
+    thread.join()
+    if errors:
+        raise errors[0]
+
+
+def export_snapshot(connection):
+    """
+    Start a read-only transaction and export its snapshot.
+
+    :param connection: A database connection instance
+    :return: The identifier of the snapshot
+    :rtype: str
+    """
+    # Keep the session state of the init SQL and the settings
+    connection.commit()
+    connection.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    cursor = connection.cursor()
+    cursor.execute('SELECT pg_catalog.pg_export_snapshot()')
+    snapshot = cursor.fetchone()[0]
+    cursor.close()
+    return snapshot
+
+
+def set_snapshot(connection, snapshot):
+    """
+    Start a read-only transaction with an exported snapshot.
+
+    :param connection: A database connection instance
+    :param str snapshot: The identifier of the snapshot, see :func:`export_snapshot`
+    """
+    connection.rollback()
+    connection.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    cursor = connection.cursor()
+    cursor.execute('SET TRANSACTION SNAPSHOT %s', (snapshot,))
+    cursor.close()
+
+
+def get_tables(connection):
+    """
+    Return all user tables of a database, largest first.
+
+    :param connection: A database connection instance
+    :return: A list of tuples with the schema name and the name of every table
+    :rtype: list
+    """
+    cursor = connection.cursor()
+    cursor.execute(
+        'SELECT n.nspname, c.relname FROM pg_catalog.pg_class c '
+        'JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace '
+        'WHERE c.relkind = \'r\' AND n.nspname <> \'information_schema\' AND n.nspname NOT LIKE \'pg\\_%\' '
+        'AND NOT EXISTS (SELECT 1 FROM pg_catalog.pg_depend d WHERE d.classid = \'pg_catalog.pg_class\'::regclass '
+        'AND d.objid = c.oid AND d.deptype = \'e\') '
+        'ORDER BY pg_catalog.pg_total_relation_size(c.oid) DESC, 1, 2'
+    )
+    tables = [tuple(row) for row in cursor.fetchall()]
+    cursor.close()
+    return tables
+
+
+def get_copy_column_names(connection, table):
+    """
+    Return the names of all columns of a table that can be copied, i.e. all columns except generated ones.
+
+    :param connection: A database connection instance
+    :param tuple table: The schema name and the name of the table
+    :return: A list of column names, ordered by their position within the table
+    :rtype: list
+    """
+    query = ('SELECT attname FROM pg_catalog.pg_attribute '
+             'WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped')
+    if connection.server_version >= 120000:
+        query += ' AND attgenerated = \'\''
+    cursor = connection.cursor()
+    cursor.execute(query + ' ORDER BY attnum', (Identifier(*table).as_string(connection),))
+    column_names = [row[0] for row in cursor.fetchall()]
+    cursor.close()
+    return column_names
+
+
+def copy_sequences(source_connection, target_connection):
+    """
+    Set the sequences of the target database to the values of the source database.
+
+    :param source_connection: A connection to the source database.
+    :param target_connection: A connection to the target database.
+    """
+    source_cursor = source_connection.cursor()
+    source_cursor.execute(
+        'SELECT schemaname, sequencename, last_value IS NOT NULL, COALESCE(last_value, start_value) '
+        'FROM pg_catalog.pg_sequences WHERE schemaname <> \'information_schema\' AND schemaname NOT LIKE \'pg\\_%\''
+    )
+    sequences = source_cursor.fetchall()
+    source_cursor.close()
+    target_cursor = target_connection.cursor()
+    for schema_name, sequence_name, is_called, value in sequences:
+        sequence = Identifier(schema_name, sequence_name).as_string(target_connection)
+        logging.info('Setting sequence %s to %s', sequence, value)
+        target_cursor.execute('SELECT pg_catalog.setval(%s::regclass, %s, %s)', (sequence, value, is_called))
+    target_cursor.close()
@@ -2,6 +2,7 @@ import os
 import re
 
 import yaml
+from pganonymize.constants import APPLY_REWRITE, APPLY_STRATEGIES, CTID, REBUILD_INDEXES
 from pganonymize.exceptions import InvalidConfiguration
 
 
@@ -60,11 +61,58 @@ config = Config()
 
 
 def validate_args_with_config(args, config):
+    if args.parallel and args.jobs > 1:
+        raise InvalidConfiguration('`--parallel` and `--jobs` options are incompatible')
+    if args.target:
+        # Only the rows of the copy are written, the options for updating the tables in place don't apply
+        for option in ('dump_file', 'pushdown', 'batch_commit', 'resume', 'exact_count'):
+            if getattr(args, option):
+                raise InvalidConfiguration('`--target` and `--{}` options are incompatible'.format(
+                    option.replace('_', '-')))
+    if not isinstance(config.schema.get('settings', {}), dict):
+        raise InvalidConfiguration('The settings have to be a mapping of configuration parameters')
+    seed = config.schema.get('options', {}).get('faker', {}).get('seed')
+    if seed is not None and (not isinstance(seed, int) or isinstance(seed, bool)):
+        raise InvalidConfiguration('The Faker seed has to be an integer')
     definitions = config.schema.get('tables', [])
     for definition in definitions:
-        table_definition = list(definition.values())[0]
-        columns = table_definition.get('fields', [])
-        for column in columns:
-            column_config = list(column.values())[0]
-            if args.parallel and column_config['provider']['name'].startswith('fake.unique'):
-                raise InvalidConfiguration('`--parallel` option and `fake.unique.*` providers are incompatible')
+        table_name, table_definition = list(definition.items())[0]
+        apply_strategy = table_definition.get('apply')
+        if apply_strategy is not None and apply_strategy not in APPLY_STRATEGIES:
+            raise InvalidConfiguration('Unknown apply strategy "{}" for table "{}"'.format(apply_strategy, table_name))
+        if apply_strategy == APPLY_REWRITE and table_definition.get('search'):
+            raise InvalidConfiguration('Table "{}" can only be rewritten without a search condition'.format(table_name))
+        partitions = table_definition.get('partitions', 1)
+        if not isinstance(partitions, int) or partitions < 1:
+            raise InvalidConfiguration('Invalid number of partitions for table "{}"'.format(table_name))
+        if partitions > 1 and apply_strategy == APPLY_REWRITE:
+            raise InvalidConfiguration('Table "{}" can only be rewritten without partitions'.format(table_name))
+        if partitions > 1 and args.parallel:
+            raise InvalidConfiguration('`--parallel` option and partitioned tables are incompatible')
+        if partitions > 1 and args.resume and not args.batch_commit:
+            # Every range is committed on its own, only the checkpoints of its batches keep track of it
+            raise InvalidConfiguration('The partitions of table "{}" can only be resumed with `--batch-commit`'.format(
+                table_name))
+        if not isinstance(table_definition.get('settings', {}), dict):
+            raise InvalidConfiguration('The settings of table "{}" have to be a mapping'.format(table_name))
+        if table_definition.get('unlogged') and apply_strategy == APPLY_REWRITE:
+            raise InvalidConfiguration('Table "{}" can only be rewritten as a logged table'.format(table_name))
+        primary_key = table_definition.get('primary_key')
+        if isinstance(primary_key, list) and (not primary_key or CTID in primary_key):
+            raise InvalidConfiguration('Invalid primary key columns for table "{}"'.format(table_name))
+        if primary_key == CTID and partitions > 1:
+            raise InvalidConfiguration('Table "{}" can only be scanned in partitions by its primary key'.format(
+                table_name))
+        if primary_key == CTID and args.batch_commit:
+            raise InvalidConfiguration('`--batch-commit` option and tables addressed by `ctid` are incompatible')
+        rebuild_indexes = table_definition.get('rebuild_indexes')
+        if rebuild_indexes is not None and rebuild_indexes not in REBUILD_INDEXES:
+            raise InvalidConfiguration('Unknown indexes "{}" to rebuild for table "{}"'.format(
+                rebuild_indexes, table_name))
+        if rebuild_indexes and apply_strategy == APPLY_REWRITE:
+            raise InvalidConfiguration('Table "{}" can only be rewritten with its indexes'.format(table_name))
+        if rebuild_indexes and (args.batch_commit or partitions > 1) and not args.resume:
+            # The dropped indexes are committed before the table has been anonymized, only the checkpoint table keeps
+            # their definitions if the run is interrupted
+            raise InvalidConfiguration('The indexes of table "{}" can only be rebuilt with `--batch-commit` or '
+                                       'partitions together with `--resume`'.format(table_name))
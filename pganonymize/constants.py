@@ -4,8 +4,31 @@ DATABASE_ARGS = ('dbname', 'user', 'password', 'host', 'port')
 # Default name for the primary key column
 DEFAULT_PRIMARY_KEY = 'id'
 
+# Primary key to address the rows by their physical location, and the name of the column it is staged as
+CTID = 'ctid'
+CTID_COLUMN = 'pga_ctid'
+
 # Filename of the default schema
 DEFAULT_SCHEMA_FILE = 'schema.yml'
 
 # Default chunk size for data fetch
 DEFAULT_CHUNK_SIZE = 100000
+
+# Strategies to apply the anonymized data to a table
+APPLY_UPDATE = 'update'
+APPLY_REWRITE = 'rewrite'
+APPLY_STRATEGIES = (APPLY_UPDATE, APPLY_REWRITE)
+
+# Secondary indexes to drop while a table is anonymized and to rebuild afterwards
+REBUILD_INDEXES_ALL = 'all'
+REBUILD_INDEXES_COLUMNS = 'columns'
+REBUILD_INDEXES = (REBUILD_INDEXES_ALL, REBUILD_INDEXES_COLUMNS)
+
+# Name of the table that keeps the progress of a run, see the `--resume` option
+CHECKPOINT_TABLE = 'pganonymize_checkpoint'
+
+# Prefix of the Faker providers, that generate unique values
+UNIQUE_FAKE_PROVIDER = 'fake.unique.'
+
+# Number of times a unique value is generated again before giving up, the same as Faker's limit
+MAX_UNIQUE_RETRIES = 1000
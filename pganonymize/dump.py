@@ -0,0 +1,275 @@
+"""Anonymizing the table data of plain-format dump files without a database"""
+
+from __future__ import absolute_import
+
+import gzip
+import io
+import json
+import logging
+import re
+import sys
+
+from psycopg2.extensions import encodings
+
+from pganonymize.config import config
+from pganonymize.exceptions import BadDataFormat, InvalidConfiguration
+from pganonymize.utils import compile_table_plan, get_column_name, process_row
+
+CUSTOM_FORMAT_SIGNATURE = b'PGDMP'
+COPY_STATEMENT = re.compile(r'^COPY (?P<table>.+?) \((?P<columns>.*)\) FROM stdin;$')
+COPY_END = b'\\.'
+CLIENT_ENCODING = re.compile(r"^SET client_encoding = '(?P<encoding>[^']+)';$")
+IDENTIFIER = re.compile(r'"((?:[^"]|"")*)"|([^",.\s]+)')
+
+NULL = u'\\N'
+# The escape sequences stand for bytes in the encoding of the dump
+ESCAPE_SEQUENCE = re.compile(br'\\(?:([0-7]{1,3})|x([0-9a-fA-F]{1,2})|(.))', re.DOTALL)
+UNESCAPED_CHARACTERS = {u'b': u'\b', u'f': u'\f', u'n': u'\n', u'r': u'\r', u't': u'\t', u'v': u'\v'}
+UNESCAPED_BYTES = dict((key.encode('ascii'), value.encode('ascii')) for key, value in UNESCAPED_CHARACTERS.items())
+SPECIAL_CHARACTER = re.compile(u'[\\\\\b\f\n\r\t\v]')
+ESCAPED_CHARACTERS = {value: u'\\' + key for key, value in UNESCAPED_CHARACTERS.items()}
+ESCAPED_CHARACTERS[u'\\'] = u'\\\\'
+
+
+def anonymize_dump_file(input_filename, output_filename=None):
+    """
+    Anonymize a plain-format dump file and write the anonymized dump file.
+
+    Files with a ``.gz`` suffix are read or written compressed.
+
+    :param str input_filename: Path to the dump file, ``-`` for the standard input
+    :param str output_filename: Path to the anonymized dump file, the standard output if omitted
+    """
+    input_file = open_dump_file(input_filename, 'rb', sys.stdin)
+    try:
+        output_file = open_dump_file(output_filename, 'wb', sys.stdout)
+        try:
+            anonymize_dump(input_file, output_file)
+        finally:
+            if output_file is not getattr(sys.stdout, 'buffer', sys.stdout):
+                output_file.close()
+            else:
+                output_file.flush()
+    finally:
+        input_file.close()
+
+
+def open_dump_file(filename, mode, stream):
+    """
+    Open a dump file in binary mode.
+
+    :param str filename: Path to the file, ``-`` or None for the given stream
+    :param str mode: The file mode
+    :param stream: The standard stream to use without a filename
+    :return: A binary file object
+    """
+    if not filename or filename == '-':
+        return getattr(stream, 'buffer', stream)
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode)
+    return io.open(filename, mode)
+
+
+def anonymize_dump(input_file, output_file):
+    """
+    Anonymize the ``COPY`` data of a plain-format dump (e.g. created by ``pg_dump --format plain`` or
+    ``pg_restore --file -``) according to the schema definition.
+
+    The dump is read line by line and every line except the data rows of the anonymized and truncated tables is written
+    unchanged, so only a single row is kept in memory.
+
+    :param input_file: A binary file object to read the dump from
+    :param output_file: A binary file object to write the anonymized dump to
+    """
+    definitions = get_table_definitions()
+    truncated_tables = config.schema.get('truncate', [])
+    found_tables = set()
+    encoding = 'utf-8'
+    lines = iter(input_file)
+    for line_number, line in enumerate(lines):
+        if line_number == 0 and line.startswith(CUSTOM_FORMAT_SIGNATURE):
+            raise BadDataFormat('Only plain-format dumps can be anonymized, convert the dump with '
+                                '"pg_restore --file -"')
+        output_file.write(line)
+        if not line.startswith((b'SET ', b'COPY ')):
+            continue
+        statement = line.rstrip(b'\r\n').decode(encoding)
+        match = CLIENT_ENCODING.match(statement)
+        if match:
+            encoding = encodings.get(match.group('encoding').upper(), match.group('encoding'))
+            continue
+        match = COPY_STATEMENT.match(statement)
+        if not match:
+            continue
+        table_name = get_table_name(parse_identifiers(match.group('table')), definitions, truncated_tables)
+        if table_name is None:
+            continue
+        found_tables.add(table_name)
+        column_names = parse_identifiers(match.group('columns'))
+        if table_name in truncated_tables:
+            logging.info('Truncating table "%s"', table_name)
+            anonymize_copy_data(lines, output_file, table_name, column_names, encoding, truncate=True)
+        else:
+            anonymize_copy_data(lines, output_file, table_name, column_names, encoding, definitions[table_name])
+    for table_name in list(definitions) + truncated_tables:
+        if table_name not in found_tables:
+            logging.warning('Table "%s" was not found in the dump', table_name)
+
+
+def get_table_definitions():
+    """
+    Return the table definitions of the schema that can be applied to a dump.
+
+    :return: A dictionary with the table names and their definitions
+    :rtype: dict
+    """
+    definitions = {}
+    for definition in config.schema.get('tables', []):
+        table_name, table_definition = list(definition.items())[0]
+        if table_definition.get('search'):
+            raise InvalidConfiguration('The search condition of table "{}" can\'t be evaluated in a dump'.format(
+                table_name))
+        definitions[table_name] = table_definition
+    return definitions
+
+
+def get_table_name(names, definitions, truncated_tables):
+    """
+    Return the name the table of a ``COPY`` statement is defined with in the schema.
+
+    :param list names: The optional schema name and the name of the table
+    :param dict definitions: The table definitions of the schema
+    :param list truncated_tables: The tables to truncate
+    :return: The qualified or the unqualified table name, None if the table isn't part of the schema
+    :rtype: str
+    """
+    for table_name in ('.'.join(names), names[-1]):
+        if table_name in definitions or table_name in truncated_tables:
+            return table_name
+    return None
+
+
+def parse_identifiers(value):
+    """
+    Parse a list of (quoted) identifiers, e.g. the columns of a ``COPY`` statement.
+
+    :param str value: The identifiers separated by dots or commas
+    :return: A list of names
+    :rtype: list
+    """
+    return [quoted.replace('""', '"') if quoted else name for quoted, name in IDENTIFIER.findall(value)]
+
+
+def anonymize_copy_data(lines, output_file, table_name, column_names, encoding, table_definition=None,
+                        truncate=False):
+    """
+    Anonymize the data rows of a ``COPY`` statement up to the end-of-data marker.
+
+    :param lines: An iterator over the lines of the dump
+    :param output_file: A binary file object to write the anonymized rows to
+    :param str table_name: Name of the table
+    :param list column_names: The columns of the ``COPY`` statement
+    :param str encoding: The encoding of the dump
+    :param dict table_definition: The table definition from the schema
+    :param bool truncate: Remove all rows of the table
+    """
+    table_definition = table_definition or {}
+    columns = table_definition.get('fields', [])
+    excludes = table_definition.get('excludes', [])
+    missing_columns = [get_column_name(definition) for definition in columns
+                       if get_column_name(definition) not in column_names]
+    if missing_columns:
+        logging.warning('Columns %s of table "%s" were not found in the dump', ', '.join(missing_columns), table_name)
+    missing_exclude_columns = sorted(set(list(definition.keys())[0] for definition in excludes) - set(column_names))
+    if missing_exclude_columns:
+        logging.warning('Exclude columns %s of table "%s" were not found in the dump, their rules are ignored',
+                        ', '.join(missing_exclude_columns), table_name)
+        excludes = [definition for definition in excludes if list(definition.keys())[0] in column_names]
+    plan = compile_table_plan(columns, excludes)
+    # PostgreSQL returns the values of JSON columns parsed, the dump contains their text
+    json_columns = set(field.column_name for field in plan.fields
+                       if field.keys is not None or field.provider_class.json_value)
+    row_count = 0
+    changed_count = 0
+    for line in lines:
+        if line.rstrip(b'\r\n') == COPY_END:
+            output_file.write(line)
+            if not truncate:
+                logging.info('Anonymized %d of %d rows of table "%s"', changed_count, row_count, table_name)
+                plan.excludes.log_counts(table_name)
+            return
+        row_count += 1
+        if truncate:
+            continue
+        row = decode_copy_row(line, column_names, encoding)
+        for column_name in json_columns:
+            if row.get(column_name) is not None:
+                row[column_name] = json.loads(row[column_name])
+        row = process_row(row, plan)
+        if row is None:
+            output_file.write(line)
+        else:
+            changed_count += 1
+            output_file.write(encode_copy_row([row[column_name] for column_name in column_names], encoding))
+    raise BadDataFormat('Unexpected end of the dump in the data of table "{}"'.format(table_name))
+
+
+def decode_copy_row(line, column_names, encoding):
+    """
+    Decode a data row of the text ``COPY`` format.
+
+    :param bytes line: The data row
+    :param list column_names: The column names of the row
+    :param str encoding: The encoding of the dump
+    :return: A dictionary with the column names and their values, NULL values are decoded as None
+    :rtype: dict
+    """
+    values = line.rstrip(b'\r\n').split(b'\t')
+    if len(values) != len(column_names):
+        raise BadDataFormat('Expected {} columns instead of {} in a COPY data row'.format(
+            len(column_names), len(values)))
+    return dict(zip(column_names, [decode_copy_value(value, encoding) for value in values]))
+
+
+def decode_copy_value(value, encoding):
+    if value == b'\\N':
+        return None
+    if b'\\' in value:
+        value = ESCAPE_SEQUENCE.sub(unescape_character, value)
+    return value.decode(encoding)
+
+
+def unescape_character(match):
+    octal, hexadecimal, character = match.groups()
+    if octal:
+        # PostgreSQL keeps the lowest byte of larger octal values
+        return bytes(bytearray([int(octal, 8) & 0xFF]))
+    if hexadecimal:
+        return bytes(bytearray([int(hexadecimal, 16)]))
+    return UNESCAPED_BYTES.get(character, character)
+
+
+def encode_copy_row(values, encoding):
+    """
+    Encode a data row with the text ``COPY`` format.
+
+    :param list values: The values of the row
+    :param str encoding: The encoding of the dump
+    :return: The data row
+    :rtype: bytes
+    """
+    return (u'\t'.join([encode_copy_value(value) for value in values]) + u'\n').encode(encoding)
+
+
+def encode_copy_value(value):
+    if value is None:
+        return NULL
+    if isinstance(value, bool):
+        value = u't' if value else u'f'
+    elif isinstance(value, (dict, list)):
+        value = json.dumps(value, default=str)
+    elif isinstance(value, bytes) and bytes is not str:
+        value = u'\\x' + value.hex()
+    else:
+        value = u'{}'.format(value)
+    return SPECIAL_CHARACTER.sub(lambda match: ESCAPED_CHARACTERS[match.group()], value)
@@ -24,3 +24,7 @@ class BadDataFormat(PgAnonymizeException):
 
 class InvalidConfiguration(PgAnonymizeException):
     """Raised if configuration is invalid."""
+
+
+class UniquenessError(PgAnonymizeException):
+    """Raised if no unique value could be generated for a field."""
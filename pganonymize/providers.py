@@ -6,6 +6,7 @@ from hashlib import md5
 from uuid import uuid4
 
 from faker import Faker
+from psycopg2.sql import SQL, Literal
 
 from pganonymize.config import config
 from pganonymize.exceptions import InvalidProvider, InvalidProviderArgument, ProviderAlreadyRegistered
@@ -17,11 +18,12 @@ class FakerInitializer(object):
     def __init__(self):
         self._faker = None
         self._options = None
+        self._seed = None
 
     @property
     def options(self):
         if self._options is None:
-            self._options = config.schema.get('options', {}).get('faker', {})
+            self._options = (config.schema or {}).get('options', {}).get('faker', {})
         return self._options
 
     @property
@@ -39,8 +41,25 @@ class FakerInitializer(object):
         if self._faker is None:
             locales = self.options.get('locales')
             self._faker = Faker(locales)
+            seed = self._seed if self._seed is not None else self.options.get('seed')
+            if seed is not None:
+                self._faker.seed_instance(seed)
         return self._faker
 
+    def seed(self, seed):
+        """
+        Seed the random generators of the faker instance, even if it is created later, and start over with the unique
+        values it has generated, so the values only depend on the seed.
+
+        :param int seed: The seed
+        """
+        self._seed = seed
+        if self._faker is not None:
+            self._faker.seed_instance(seed)
+            # Python 2.7 requires a Faker version without unique values
+            if hasattr(self._faker, 'unique'):
+                self._faker.unique.clear()
+
     def get_locale_generator(self, locale):
         """
         Get the internal generator for the given locale.
@@ -66,6 +85,12 @@ class ProviderRegistry(object):
 
     def __init__(self):
         self._registry = OrderedDict()
+        # Registration position and class of every provider id, for exact lookups
+        self._exact_ids = {}
+        # Registration position, compiled pattern and class of the providers matching their id as a regex
+        self._patterns = []
+        # Resolved provider ids, cleared whenever a provider is registered
+        self._lookup_cache = {}
 
     def register(self, provider_class, provider_id):
         """
@@ -78,21 +103,41 @@ class ProviderRegistry(object):
         if provider_id in self._registry:
             raise ProviderAlreadyRegistered('A provider with the id "{}" has already been registered'
                                             .format(provider_id))
+        position = len(self._registry)
         self._registry[provider_id] = provider_class
+        self._exact_ids[provider_id] = (position, provider_class)
+        if provider_class.regex_match is True:
+            self._patterns.append((position, re.compile(provider_id), provider_class))
+        self._lookup_cache.clear()
 
     def get_provider(self, provider_id):
         """
         Return a provider by its provider id.
 
+        The first registered provider whose id equals the given id or whose regex matches it wins. Resolved ids are
+        cached until another provider is registered.
+
         :param str provider_id: The string id of the desired provider.
         :raises InvalidProvider: If no provider can be found with the given id.
         :return: The provider class that matches the id.
         :rtype: type
         """
-        for key, cls in self._registry.items():
-            if (cls.regex_match is True and re.match(re.compile(key), provider_id) is not None) or key == provider_id:
-                return cls
-        raise InvalidProvider('Could not find provider with id "{}"'.format(provider_id))
+        try:
+            return self._lookup_cache[provider_id]
+        except KeyError:
+            pass
+        position, cls = self._exact_ids.get(provider_id, (len(self._registry), None))
+        # Only regex providers registered before an exact match take precedence over it
+        for pattern_position, pattern, pattern_cls in self._patterns:
+            if pattern_position >= position:
+                break
+            if pattern.match(provider_id) is not None:
+                cls = pattern_cls
+                break
+        if cls is None:
+            raise InvalidProvider('Could not find provider with id "{}"'.format(provider_id))
+        self._lookup_cache[provider_id] = cls
+        return cls
 
     @property
     def providers(self):
@@ -129,6 +174,9 @@ class Provider(object):
     regex_match = False
     """Defines whether a provider matches it's id using regular expressions."""
 
+    json_value = False
+    """Defines whether a provider alters the parsed value of a JSON column instead of its text."""
+
     @classmethod
     def alter_value(cls, original_value, **kwargs):
         """
@@ -138,6 +186,33 @@ class Provider(object):
         """
         raise NotImplementedError()
 
+    @classmethod
+    def alter_values(cls, original_values, **kwargs):
+        """
+        Alter or replace the original values of a database column for a whole batch of rows.
+
+        Providers can override this method to handle the values at once, e.g. to evaluate their configuration only
+        once. By default :meth:`alter_value` is called for every value.
+
+        :param list original_values: The original values of the database column, none of them is None.
+        :return: A list with the altered value for every original value.
+        :rtype: list
+        """
+        return [cls.alter_value(original_value, **kwargs) for original_value in original_values]
+
+    @classmethod
+    def sql_expression(cls, column, **kwargs):
+        """
+        Return an SQL expression that lets PostgreSQL alter the value of the database column itself.
+
+        The expression has to return the same value as :meth:`alter_value` and has to keep ``NULL`` values untouched.
+
+        :param psycopg2.sql.Composable column: The (quoted) database column.
+        :return: The SQL expression or None, if the provider can't be evaluated by PostgreSQL.
+        :rtype: psycopg2.sql.Composable
+        """
+        return None
+
 
 @register('choice')
 class ChoiceProvider(Provider):
@@ -147,6 +222,13 @@ class ChoiceProvider(Provider):
     def alter_value(cls, original_value, **kwargs):
         return random.choice(kwargs.get('values'))
 
+    @classmethod
+    def alter_values(cls, original_values, **kwargs):
+        choices = kwargs.get('values')
+        if hasattr(random, 'choices'):
+            return random.choices(choices, k=len(original_values))
+        return [random.choice(choices) for _ in original_values]  # Python 2.7
+
 
 @register('clear')
 class ClearProvider(Provider):
@@ -156,6 +238,14 @@ class ClearProvider(Provider):
     def alter_value(cls, original_value, **kwargs):
         return None
 
+    @classmethod
+    def alter_values(cls, original_values, **kwargs):
+        return [None] * len(original_values)
+
+    @classmethod
+    def sql_expression(cls, column, **kwargs):
+        return SQL('NULL')
+
 
 @register('fake.+')
 class FakeProvider(Provider):
@@ -165,16 +255,31 @@ class FakeProvider(Provider):
 
     @classmethod
     def alter_value(cls, original_value, **kwargs):
-        func_name = kwargs['name'].split('.', 1)[1]
+        func = cls.get_function(**kwargs)
+        return func(**kwargs.get('kwargs', {}))
+
+    @classmethod
+    def alter_values(cls, original_values, **kwargs):
+        func = cls.get_function(**kwargs)
         func_kwargs = kwargs.get('kwargs', {})
+        return [func(**func_kwargs) for _ in original_values]
+
+    @classmethod
+    def get_function(cls, **kwargs):
+        """
+        Return the faker function of the provider name, e.g. ``first_name`` for ``fake.first_name``.
+
+        :raises InvalidProviderArgument: If faker doesn't provide the function.
+        :rtype: function
+        """
+        func_name = kwargs['name'].split('.', 1)[1]
         locale = kwargs.get('locale', faker_initializer.default_locale)
         # Use the generator for the locale if a locale is configured (per field definition or as global default locale)
         faker_generator = faker_initializer.get_locale_generator(locale) if locale else faker_initializer.faker
         try:
-            func = operator.attrgetter(func_name)(faker_generator)
+            return operator.attrgetter(func_name)(faker_generator)
         except AttributeError as exc:
             raise InvalidProviderArgument(exc)
-        return func(**func_kwargs)
 
 
 @register('mask')
@@ -189,6 +294,16 @@ class MaskProvider(Provider):
         sign = kwargs.get('sign', cls.default_sign) or cls.default_sign
         return sign * len(original_value)
 
+    @classmethod
+    def alter_values(cls, original_values, **kwargs):
+        sign = kwargs.get('sign', cls.default_sign) or cls.default_sign
+        return [sign * len(original_value) for original_value in original_values]
+
+    @classmethod
+    def sql_expression(cls, column, **kwargs):
+        sign = kwargs.get('sign', cls.default_sign) or cls.default_sign
+        return SQL('repeat({sign}, char_length({column}))').format(sign=Literal(sign), column=column)
+
 
 @register('partial_mask')
 class PartialMaskProvider(Provider):
@@ -211,6 +326,32 @@ class PartialMaskProvider(Provider):
             original_value[-unmasked_right:]
         )
 
+    @classmethod
+    def alter_values(cls, original_values, **kwargs):
+        sign = kwargs.get('sign', cls.default_sign) or cls.default_sign
+        unmasked_left = kwargs.get('unmasked_left', cls.default_unmasked_left) or cls.default_unmasked_left
+        unmasked_right = kwargs.get('unmasked_right', cls.default_unmasked_right) or cls.default_unmasked_right
+        unmasked = unmasked_left + unmasked_right
+        return [
+            original_value[:unmasked_left] + (len(original_value) - unmasked) * sign + original_value[-unmasked_right:]
+            for original_value in original_values
+        ]
+
+    @classmethod
+    def sql_expression(cls, column, **kwargs):
+        sign = kwargs.get('sign', cls.default_sign) or cls.default_sign
+        unmasked_left = kwargs.get('unmasked_left', cls.default_unmasked_left) or cls.default_unmasked_left
+        unmasked_right = kwargs.get('unmasked_right', cls.default_unmasked_right) or cls.default_unmasked_right
+        return SQL(
+            'left({column}, {left}) || repeat({sign}, char_length({column}) - {masked}) || right({column}, {right})'
+        ).format(
+            column=column,
+            left=Literal(unmasked_left),
+            right=Literal(unmasked_right),
+            masked=Literal(unmasked_left + unmasked_right),
+            sign=Literal(sign),
+        )
+
 
 @register('md5')
 class MD5Provider(Provider):
@@ -229,6 +370,34 @@ class MD5Provider(Provider):
         else:
             return hashed
 
+    @classmethod
+    def alter_values(cls, original_values, **kwargs):
+        as_number = kwargs.get('as_number', False)
+        as_number_length = kwargs.get('as_number_length', cls.default_max_length)
+        hashed_values = [md5(original_value.encode('utf-8')).hexdigest() for original_value in original_values]
+        if as_number:
+            modulo = 10 ** as_number_length
+            return [int(hashed, 16) % modulo for hashed in hashed_values]
+        return hashed_values
+
+    @classmethod
+    def sql_expression(cls, column, **kwargs):
+        as_number = kwargs.get('as_number', False)
+        as_number_length = kwargs.get('as_number_length', cls.default_max_length)
+        hashed = SQL('md5({column})').format(column=column)
+        if not as_number:
+            return hashed
+        # Build the 128 bit integer of the hash from four unsigned 32 bit parts, as there is no direct cast from a
+        # hexadecimal string to numeric
+        parts = [
+            SQL("('x' || substr({hashed}, {start}, 8))::bit(32)::bigint").format(hashed=hashed, start=Literal(start))
+            for start in (1, 9, 17, 25)
+        ]
+        number = parts[0]
+        for part in parts[1:]:
+            number = SQL('({number}::numeric * 4294967296 + {part})').format(number=number, part=part)
+        return SQL('mod({number}, {modulo})').format(number=number, modulo=Literal(10 ** as_number_length))
+
 
 @register('set')
 class SetProvider(Provider):
@@ -238,6 +407,23 @@ class SetProvider(Provider):
     def alter_value(cls, original_value, **kwargs):
         return kwargs.get('value')
 
+    @classmethod
+    def alter_values(cls, original_values, **kwargs):
+        return [kwargs.get('value')] * len(original_values)
+
+    @classmethod
+    def sql_expression(cls, column, **kwargs):
+        value = kwargs.get('value')
+        if value is None:
+            return SQL('NULL')
+        if isinstance(value, (dict, list)):
+            return None
+        # Pass the value as untyped literal, so PostgreSQL casts it to the type of the column
+        value = value if isinstance(value, type(u'')) else str(value)
+        return SQL('CASE WHEN {column} IS NULL THEN {column} ELSE {value} END').format(
+            column=column, value=Literal(value),
+        )
+
 
 @register('uuid4')
 class UUID4Provider(Provider):
@@ -247,11 +433,17 @@ class UUID4Provider(Provider):
     def alter_value(cls, original_value, **kwargs):
         return uuid4()
 
+    @classmethod
+    def alter_values(cls, original_values, **kwargs):
+        return [uuid4() for _ in original_values]
+
 
 @register('update_json')
 class UpdateJSONProvider(Provider):
     """Provider to update JSON data (currently values) by providers."""
 
+    json_value = True
+
     @classmethod
     def alter_value(cls, original_value, **kwargs):
         def update_dict(input_dict, update_values_type={}):
@@ -0,0 +1,301 @@
+"""Reading table data with the binary COPY format"""
+
+from __future__ import absolute_import
+
+import json
+import logging
+import os
+import struct
+import threading
+import uuid
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+from pgcopy import inspect, util
+from psycopg2.extensions import encodings
+
+try:
+    from datetime import timezone
+    UTC = timezone.utc
+except ImportError:  # Python 2.7
+    from psycopg2.tz import FixedOffsetTimezone
+    UTC = FixedOffsetTimezone(offset=0)
+
+BINCOPY_SIGNATURE = b'PGCOPY\n\377\r\n\0'
+BINCOPY_HEADER = struct.Struct('>11sii')
+BLOCK_SIZE = 1024 * 1024
+
+POSTGRES_EPOCH_DATE = date(2000, 1, 1)
+POSTGRES_EPOCH = datetime(2000, 1, 1)
+POSTGRES_EPOCH_UTC = datetime(2000, 1, 1, tzinfo=UTC)
+
+NUMERIC_NEGATIVE = 0x4000
+NUMERIC_SPECIAL_VALUES = {0xC000: 'NaN', 0xD000: 'Infinity', 0xF000: '-Infinity'}
+
+INT16 = struct.Struct('>h')
+INT32 = struct.Struct('>i')
+
+
+def simple_decoder(fmt):
+    unpack = struct.Struct('>' + fmt).unpack
+    return lambda data, encoding: unpack(data)[0]
+
+
+def str_decoder(data, encoding):
+    return data.decode(encoding)
+
+
+def bytes_decoder(data, encoding):
+    return bytes(data)
+
+
+def json_decoder(data, encoding):
+    return json.loads(data.decode(encoding))
+
+
+def jsonb_decoder(data, encoding):
+    # The first byte is the version of the jsonb format
+    return json.loads(data[1:].decode(encoding))
+
+
+def date_decoder(data, encoding):
+    return POSTGRES_EPOCH_DATE + timedelta(days=INT32.unpack(data)[0])
+
+
+def time_decoder(data, encoding):
+    return (POSTGRES_EPOCH + timedelta(microseconds=struct.unpack('>q', data)[0])).time()
+
+
+def timestamp_decoder(data, encoding):
+    return POSTGRES_EPOCH + timedelta(microseconds=struct.unpack('>q', data)[0])
+
+
+def timestamptz_decoder(data, encoding):
+    return POSTGRES_EPOCH_UTC + timedelta(microseconds=struct.unpack('>q', data)[0])
+
+
+def numeric_decoder(data, encoding):
+    """
+    Decode a numeric value.
+
+    The value consists of the number of base-10000 digits, the weight of the first digit, the sign, the number of
+    decimal digits after the decimal point and the base-10000 digits.
+    """
+    ndigits, weight, sign, dscale = struct.unpack('>hhHh', data[:8])
+    if sign in NUMERIC_SPECIAL_VALUES:
+        return Decimal(NUMERIC_SPECIAL_VALUES[sign])
+    digits = struct.unpack('>{}H'.format(ndigits), data[8:8 + 2 * ndigits])
+    coefficient = int(('%04d' * ndigits) % digits or '0')
+    # Scale the coefficient to the number of decimal digits after the decimal point
+    exponent = 4 * (weight + 1 - ndigits) + dscale
+    if exponent >= 0:
+        coefficient *= 10 ** exponent
+    else:
+        coefficient //= 10 ** -exponent
+    value = str(coefficient)
+    if dscale > 0:
+        value = value.rjust(dscale + 1, '0')
+        value = value[:-dscale] + '.' + value[-dscale:]
+    return Decimal('-' + value if sign == NUMERIC_NEGATIVE else value)
+
+
+def uuid_decoder(data, encoding):
+    return uuid.UUID(bytes=bytes(data))
+
+
+# The same types that are supported by the pgcopy.CopyManager to write data
+type_decoders = {
+    'bool': simple_decoder('?'),
+    'int2': simple_decoder('h'),
+    'int4': simple_decoder('i'),
+    'int8': simple_decoder('q'),
+    'float4': simple_decoder('f'),
+    'float8': simple_decoder('d'),
+    'varchar': str_decoder,
+    'bpchar': str_decoder,
+    'bytea': bytes_decoder,
+    'text': str_decoder,
+    'json': json_decoder,
+    'jsonb': jsonb_decoder,
+    'date': date_decoder,
+    'time': time_decoder,
+    'timestamp': timestamp_decoder,
+    'timestamptz': timestamptz_decoder,
+    'numeric': numeric_decoder,
+    'uuid': uuid_decoder,
+}
+
+
+def get_column_decoders(connection, table, column_names):
+    """
+    Return the decoders for the binary representation of the given table columns.
+
+    :param connection: A database connection instance
+    :param str table: Name of the database table, optionally qualified with its schema name (e.g. ``public.auth_user``)
+    :param list column_names: A list of column names
+    :return: A list of decoder functions, None if one of the column types isn't supported.
+    :rtype: list
+    """
+    if '.' in table:
+        schema, table = table.split('.', 1)
+    else:
+        schema = util.get_schema(connection, table)
+    types = inspect.get_types(connection, schema, table)
+    decoders = []
+    for column_name in column_names:
+        attribute = types[column_name]
+        if attribute.type_category == 'A' or attribute.type_name not in type_decoders:
+            logging.info('Column "{}" of table {} with type {} can\'t be read with binary COPY'.format(
+                column_name, table, attribute.type_name))
+            return None
+        decoders.append(type_decoders[attribute.type_name])
+    return decoders
+
+
+class CopyCursor(object):
+    """
+    A cursor that reads the result of a query with ``COPY ... TO STDOUT (FORMAT binary)``.
+
+    The ``COPY`` runs in a background thread, that writes its output into a pipe. The rows are decoded from the pipe
+    while they are fetched, so the result is neither kept in memory nor written to disk. The connection is busy until
+    all rows have been fetched, closing the cursor before aborts the ``COPY``. The rows are returned as tuples like the
+    rows of a regular cursor.
+    """
+
+    def __init__(self, connection, column_names, decoders):
+        self.connection = connection
+        self.column_names = column_names
+        self.decoders = decoders
+        self.encoding = encodings[connection.encoding]
+        self.file = None
+        self._thread = None
+        self._errors = []
+        self._buffer = b''
+        self._offset = 0
+        self._finished = True
+
+    def execute(self, query):
+        self.close()
+        self._buffer = b''
+        self._offset = 0
+        self._finished = False
+        self._errors = errors = []
+        read_fd, write_fd = os.pipe()
+        self.file = os.fdopen(read_fd, 'rb')
+        writer = os.fdopen(write_fd, 'wb')
+        sql = 'COPY ({}) TO STDOUT (FORMAT binary)'.format(query)
+
+        def produce():
+            cursor = self.connection.cursor()
+            try:
+                cursor.copy_expert(sql, writer)
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                writer.close()
+                cursor.close()
+
+        self._thread = threading.Thread(target=produce)
+        self._thread.daemon = True
+        self._thread.start()
+        signature, _, extension_length = BINCOPY_HEADER.unpack(self._read(BINCOPY_HEADER.size))
+        if signature != BINCOPY_SIGNATURE:
+            raise ValueError('Invalid binary COPY signature')
+        self._read(extension_length)
+
+    def fetchmany(self, size):
+        rows = []
+        while len(rows) < size:
+            row = self._read_row()
+            if row is None:
+                break
+            rows.append(row)
+        return rows
+
+    def fetchall(self):
+        rows = []
+        while True:
+            row = self._read_row()
+            if row is None:
+                return rows
+            rows.append(row)
+
+    def close(self):
+        if self.file is not None:
+            # A COPY that is still running fails writing into the closed pipe
+            self.file.close()
+            self.file = None
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _finish(self):
+        """Wait for the COPY to end after its output has been read and raise its error."""
+        self._finished = True
+        self.file.close()
+        self.file = None
+        self._thread.join()
+        self._thread = None
+        if self._errors:
+            raise self._errors[0]
+
+    def _read_row(self):
+        """Decode the next row, refilling the buffer if it only contains a part of the row."""
+        if self._finished:
+            return None
+        while True:
+            row, offset = self._decode_row(self._buffer, self._offset)
+            if offset is not None:
+                self._offset = offset
+                if row is None:
+                    # The trailer, the COPY ends with it
+                    self.file.read()
+                    self._finish()
+                return row
+            data = self.file.read(BLOCK_SIZE)
+            if not data:
+                self._finish()
+                if self._offset == len(self._buffer):
+                    return None
+                raise ValueError('Unexpected end of binary COPY data')
+            self._buffer = self._buffer[self._offset:] + data
+            self._offset = 0
+
+    def _decode_row(self, buffer, offset):
+        """
+        Decode a row starting at the given offset of the buffer.
+
+        :return: The decoded row and the offset of the next row, the offset is None if the row is incomplete.
+        :rtype: tuple
+        """
+        end = len(buffer)
+        if offset + 2 > end:
+            return None, None
+        if INT16.unpack_from(buffer, offset)[0] == -1:
+            return None, offset + 2
+        offset += 2
+        values = []
+        append = values.append
+        unpack_from = INT32.unpack_from
+        encoding = self.encoding
+        try:
+            for decoder in self.decoders:
+                length = unpack_from(buffer, offset)[0]
+                offset += 4
+                if length == -1:
+                    append(None)
+                    continue
+                offset += length
+                if offset > end:
+                    return None, None
+                append(decoder(buffer[offset - length:offset], encoding))
+        except struct.error:
+            return None, None
+        return tuple(values), offset
+
+    def _read(self, size):
+        data = self.file.read(size)
+        if len(data) < size:
+            self._finish()
+            raise ValueError('Unexpected end of binary COPY data')
+        return data
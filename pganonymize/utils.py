@@ -5,26 +5,64 @@ from __future__ import absolute_import
 import json
 import logging
 import math
+import multiprocessing
+import numbers
+import os
+import random
 import re
 import subprocess
+import threading
 import time
+from collections import OrderedDict, namedtuple
+from multiprocessing.pool import ThreadPool
+from string import Formatter
 
-import parmap
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
 from pgcopy import CopyManager
-from psycopg2.sql import SQL, Composed, Identifier
-from tqdm import trange
+from pgcopy.copy import type_formatters
+from pgcopy.util import Replace
+from psycopg2.sql import SQL, Composed, Identifier, Literal
+from tqdm import tqdm
 
+from pganonymize.chunk import Chunk, SharedChunk, shared_memory
 from pganonymize.config import config
-from pganonymize.constants import DEFAULT_CHUNK_SIZE, DEFAULT_PRIMARY_KEY
-from pganonymize.providers import provider_registry
+from pganonymize.constants import (
+    APPLY_REWRITE, APPLY_UPDATE, CHECKPOINT_TABLE, CTID, CTID_COLUMN, DEFAULT_CHUNK_SIZE, DEFAULT_PRIMARY_KEY,
+    MAX_UNIQUE_RETRIES, REBUILD_INDEXES_COLUMNS, UNIQUE_FAKE_PROVIDER,
+)
+from pganonymize.exceptions import InvalidConfiguration, UniquenessError
+from pganonymize.providers import faker_initializer, provider_registry
+from pganonymize.reader import CopyCursor, get_column_decoders, type_decoders
+
+try:
+    import queue
+except ImportError:  # Python 2.7
+    import Queue as queue
+
+try:
+    from multiprocessing import resource_tracker
+except ImportError:  # Python < 3.8
+    resource_tracker = None
+
+PIPELINE_END = object()
+PIPELINE_TIMEOUT = 0.1
+
+# The --verbose output of pg_dump when it starts and (with more than one job) finishes to dump the data of a table
+DUMP_TABLE_START = re.compile(r'dumping contents of table "(?P<table>.+)"$')
+DUMP_TABLE_END = re.compile(r'finished item \d+ TABLE DATA (?P<table>.+)$')
+
+# Inline flags, that would apply to all patterns of a combined exclude regex
+INLINE_FLAGS = re.compile(r'\(\?[aiLmsux]+\)')
 
 # Needed to work with UUID objects
 psycopg2.extras.register_uuid()
 
 
-def anonymize_tables(connection, verbose=False, dry_run=False, parallel=False):
+def anonymize_tables(connection, verbose=False, dry_run=False, parallel=False, jobs=1, connection_pool=None,
+                     pushdown=False, exact_count=False, binary_copy=False, pipeline_depth=0,
+                     batch_commit=False, resume=False):
     """
     Anonymize a list of tables according to the schema definition.
 
@@ -32,41 +70,330 @@ def anonymize_tables(connection, verbose=False, dry_run=False, parallel=False):
     :param bool verbose: Display logging information and a progress bar.
     :param bool dry_run: Script is running in dry-run mode, no commit expected.
     :param bool parallel: Data anonymization is done in parallel.
+    :param int jobs: Number of tables to anonymize concurrently. With more than one job every table is anonymized and
+      committed on its own connection taken from the `connection_pool`, otherwise all tables are anonymized within the
+      single transaction of the given `connection`.
+    :param pganonymize.utils.ConnectionPool connection_pool: A connection pool used if `jobs` is greater than 1 or
+      if tables are scanned in partitions.
+    :param bool pushdown: Let PostgreSQL evaluate all field definitions it is capable of.
+    :param bool exact_count: Count the rows of every table exactly instead of using the planner's estimates for the
+      progress.
+    :param bool binary_copy: Read the table data with a binary ``COPY`` instead of a server-side cursor.
+    :param int pipeline_depth: Fetch, anonymize and import the batches concurrently with at most this many batches
+      waiting between the stages. 0 processes the batches one after another.
+    :param bool batch_commit: Apply and commit the anonymized rows after every batch instead of once per table.
+    :param bool resume: Keep the progress in a checkpoint table and skip the work that has been committed by a
+      previous, interrupted run.
     """
     definitions = config.schema.get('tables', [])
-    for definition in definitions:
-        start_time = time.time()
-        table_name = list(definition.keys())[0]
-        logging.info('Found table definition "%s"', table_name)
-        table_definition = definition[table_name]
-        columns = table_definition.get('fields', [])
-        excludes = table_definition.get('excludes', [])
-        search = table_definition.get('search')
-        primary_key = table_definition.get('primary_key', DEFAULT_PRIMARY_KEY)
-        total_count = get_table_count(connection, table_name, dry_run)
-        chunk_size = table_definition.get('chunk_size', DEFAULT_CHUNK_SIZE)
-        build_and_then_import_data(
+    if resume:
+        create_checkpoint_table(connection)
+        if not dry_run:
+            connection.commit()
+        completed_tables = get_completed_tables(connection)
+        for table_name in completed_tables:
+            logging.info('Skipping table {}, it has been anonymized by a previous run'.format(table_name))
+        definitions = [definition for definition in definitions
+                       if list(definition.keys())[0] not in completed_tables]
+    worker_pool = WorkerPool(get_table_fields(definitions)) if parallel and definitions else None
+    try:
+        if jobs > 1 and definitions:
+            if connection_pool is None:
+                raise ValueError('A connection pool is required to anonymize tables concurrently')
+            definitions = sort_definitions_by_size(connection, definitions)
+            anonymize_tables_concurrently(connection_pool, definitions, jobs, verbose=verbose, dry_run=dry_run,
+                                          parallel=parallel, pushdown=pushdown, exact_count=exact_count,
+                                          binary_copy=binary_copy, pipeline_depth=pipeline_depth,
+                                          batch_commit=batch_commit, resume=resume)
+        else:
+            for definition in definitions:
+                anonymize_table(connection, definition, verbose=verbose, dry_run=dry_run, parallel=parallel,
+                                pushdown=pushdown, connection_pool=connection_pool, exact_count=exact_count,
+                                binary_copy=binary_copy, pipeline_depth=pipeline_depth,
+                                batch_commit=batch_commit, resume=resume)
+    finally:
+        if worker_pool is not None:
+            worker_pool.close()
+    if resume:
+        remove_checkpoint_table(connection)
+
+
+def anonymize_tables_concurrently(connection_pool, definitions, jobs, verbose=False, dry_run=False, parallel=False,
+                                  pushdown=False, exact_count=False, binary_copy=False, pipeline_depth=0,
+                                  batch_commit=False, resume=False):
+    """
+    Anonymize the given table definitions with a fixed number of worker threads.
+
+    Each table is anonymized on a separate pooled connection and committed (or rolled back in dry-run mode) as soon as
+    it has been finished.
+
+    :param pganonymize.utils.ConnectionPool connection_pool: The pool to take the database connections from.
+    :param list definitions: A list of table definitions from the YAML schema.
+    :param int jobs: Number of tables to anonymize concurrently.
+    :param bool verbose: Display logging information and a progress bar.
+    :param bool dry_run: Script is running in dry-run mode, no commit expected.
+    :param bool parallel: Data anonymization is done in parallel.
+    :param bool pushdown: Let PostgreSQL evaluate all field definitions it is capable of.
+    :param bool exact_count: Count the rows of every table exactly instead of using the planner's estimates.
+    :param bool binary_copy: Read the table data with a binary ``COPY`` instead of a server-side cursor.
+    :param int pipeline_depth: Fetch, anonymize and import the batches concurrently with at most this many batches
+      waiting between the stages. 0 processes the batches one after another.
+    :param bool batch_commit: Apply and commit the anonymized rows after every batch instead of once per table.
+    :param bool resume: Keep the progress of every table in the checkpoint table and continue from it.
+    """
+    def run(connection, definition):
+        anonymize_table(connection, definition, verbose=verbose, dry_run=dry_run, parallel=parallel,
+                        pushdown=pushdown, connection_pool=connection_pool, exact_count=exact_count,
+                        binary_copy=binary_copy, pipeline_depth=pipeline_depth,
+                        batch_commit=batch_commit, resume=resume)
+
+    run_concurrently(connection_pool, run, definitions, jobs, dry_run=dry_run)
+
+
+def run_concurrently(connection_pool, func, items, jobs, dry_run=False):
+    """
+    Call a function for every item with a fixed number of worker threads.
+
+    Every call gets its own pooled connection, that is committed (or rolled back in dry-run mode) as soon as the call
+    has been finished.
+
+    :param pganonymize.utils.ConnectionPool connection_pool: The pool to take the database connections from.
+    :param func: The function to call with a connection and an item.
+    :param list items: The items to process.
+    :param int jobs: Number of worker threads.
+    :param bool dry_run: Script is running in dry-run mode, no commit expected.
+    """
+    def run(item):
+        connection = connection_pool.getconn()
+        try:
+            func(connection, item)
+            if dry_run:
+                connection.rollback()
+            else:
+                connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection_pool.putconn(connection)
+
+    pool = ThreadPool(jobs)
+    try:
+        for _ in pool.imap_unordered(run, items):
+            pass
+    except Exception:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+
+def anonymize_table(connection, definition, verbose=False, dry_run=False, parallel=False, pushdown=False,
+                    connection_pool=None, exact_count=False, binary_copy=False, pipeline_depth=0,
+                    batch_commit=False, resume=False):
+    """
+    Anonymize a single table according to its definition.
+
+    :param connection: A database connection instance.
+    :param dict definition: A table definition from the YAML schema, e.g. ``{'auth_user': {'fields': [...]}}``.
+    :param bool verbose: Display logging information and a progress bar.
+    :param bool dry_run: Script is running in dry-run mode, no commit expected.
+    :param bool parallel: Data anonymization is done in parallel.
+    :param bool pushdown: Let PostgreSQL evaluate all field definitions it is capable of. The remaining fields are
+      anonymized by Python.
+    :param pganonymize.utils.ConnectionPool connection_pool: A connection pool used to scan the table in partitions.
+    :param bool exact_count: Count the rows exactly instead of using the planner's estimate for the progress.
+    :param bool binary_copy: Read the table data with a binary ``COPY`` instead of a server-side cursor.
+    :param int pipeline_depth: Fetch, anonymize and import the batches concurrently with at most this many batches
+      waiting between the stages. 0 processes the batches one after another.
+    :param bool batch_commit: Apply and commit the anonymized rows after every batch instead of once per table.
+    :param bool resume: Keep the progress of the table in the checkpoint table and continue from it.
+    """
+    start_time = time.time()
+    table_name = list(definition.keys())[0]
+    logging.info('Found table definition "%s"', table_name)
+    table_definition = definition[table_name]
+    columns = table_definition.get('fields', [])
+    excludes = table_definition.get('excludes', [])
+    search = table_definition.get('search')
+    primary_key = table_definition.get('primary_key', DEFAULT_PRIMARY_KEY)
+    chunk_size = table_definition.get('chunk_size', DEFAULT_CHUNK_SIZE)
+    apply_strategy = table_definition.get('apply', APPLY_UPDATE)
+    partitions = table_definition.get('partitions', 1)
+    settings = table_definition.get('settings', {})
+    unlogged = table_definition.get('unlogged', False)
+    rebuild_indexes = table_definition.get('rebuild_indexes')
+    checkpoints = get_checkpoints(connection, table_name) if resume else None
+    previous_settings = apply_settings(connection, settings) if settings else None
+    if unlogged and not dry_run:
+        set_table_logged(connection, table_name, False)
+        if partitions > 1:
+            # The partitions are scanned on other connections, that would wait for the lock of the altered table
+            connection.commit()
+    if apply_strategy == APPLY_REWRITE:
+        total_count = get_row_count(connection, table_name, dry_run=dry_run, exact=exact_count)
+        build_and_then_rewrite_data(
             connection,
             table_name,
-            primary_key,
             columns,
             excludes,
-            search,
             total_count,
             chunk_size,
             verbose=verbose,
             dry_run=dry_run,
             parallel=parallel,
+            binary_copy=binary_copy,
+            pipeline_depth=pipeline_depth,
+            primary_key=primary_key,
         )
-        end_time = time.time()
-        logging.info('{} anonymization took {:.2f}s'.format(table_name, end_time - start_time))
+    else:
+        indexes = []
+        if rebuild_indexes and not dry_run:
+            column_names = get_column_names(columns) if rebuild_indexes == REBUILD_INDEXES_COLUMNS else None
+            indexes = drop_secondary_indexes(connection, table_name, column_names, resume=resume)
+            if indexes and partitions > 1:
+                # The partitions are scanned on other connections, that would wait for the lock of the table
+                connection.commit()
+        pushdown_columns = []
+        if pushdown:
+            pushdown_columns, columns = get_pushdown_columns(columns, primary_key, excludes)
+            if pushdown_columns and excludes:
+                # The excluded columns may not be selected for the remaining columns anymore, so let PostgreSQL filter
+                # the excluded rows for both parts
+                search = get_search_condition(connection, search, excludes)
+                excludes = []
+        # Let PostgreSQL filter the excluded rows and the rows without any value to anonymize
+        fetch_search, excludes = get_fetch_condition(connection, search, columns, excludes)
+        if columns and partitions > 1:
+            if connection_pool is None:
+                raise ValueError('A connection pool is required to scan tables in partitions')
+            if parallel:
+                # Every partition compiles its own plan, so the values of unique providers couldn't be kept unique
+                # across the partitions
+                raise ValueError('Partitioned tables can\'t be anonymized in parallel')
+            build_and_then_import_data_partitioned(
+                connection,
+                connection_pool,
+                table_name,
+                primary_key,
+                columns,
+                excludes,
+                fetch_search,
+                chunk_size,
+                partitions,
+                verbose=verbose,
+                dry_run=dry_run,
+                exact_count=exact_count,
+                binary_copy=binary_copy,
+                pipeline_depth=pipeline_depth,
+                batch_commit=batch_commit,
+                checkpoints=checkpoints,
+                settings=settings,
+            )
+        elif columns:
+            total_count = get_row_count(connection, table_name, fetch_search, dry_run=dry_run, exact=exact_count)
+            build_and_then_import_data(
+                connection,
+                table_name,
+                primary_key,
+                columns,
+                excludes,
+                fetch_search,
+                total_count,
+                chunk_size,
+                verbose=verbose,
+                dry_run=dry_run,
+                parallel=parallel,
+                binary_copy=binary_copy,
+                pipeline_depth=pipeline_depth,
+                batch_commit=batch_commit,
+                checkpoint='' if resume else None,
+                start=checkpoints.get('') if resume else None,
+            )
+        if pushdown_columns:
+            apply_pushdown_update(connection, table_name, pushdown_columns, search, dry_run=dry_run)
+        log_sql_excludes(table_name, table_definition.get('excludes', []), excludes)
+        if indexes:
+            create_indexes(connection, table_name, indexes, verbose=verbose)
+    if unlogged and not dry_run:
+        set_table_logged(connection, table_name, True)
+    if resume:
+        complete_checkpoint(connection, table_name)
+        if batch_commit and not dry_run:
+            connection.commit()
+    if previous_settings:
+        apply_settings(connection, previous_settings)
+    end_time = time.time()
+    logging.info('{} anonymization took {:.2f}s'.format(table_name, end_time - start_time))
+
+
+# The compiled field definitions, the exclude matcher and the unique values of a table, see `compile_table_plan`
+TablePlan = namedtuple('TablePlan', ['fields', 'excludes', 'uniques'])
+
+# A compiled field definition, see `compile_field_plan`
+FieldPlan = namedtuple('FieldPlan', [
+    'path', 'column_name', 'keys', 'provider_class', 'provider_config', 'append', 'format', 'format_fields',
+])
+
+
+def compile_table_plan(columns, excludes=None):
+    """
+    Compile the field definitions of a table once, so they don't have to be interpreted again for every row.
+
+    :param list columns: A list of table columns with their provider rules.
+    :param list excludes: A list of exclude definitions.
+    :return: The compiled plan, that can be passed to :func:`process_row`.
+    :rtype: TablePlan
+    """
+    fields = tuple(compile_field_plan(definition) for definition in columns)
+    return TablePlan(fields, ExcludeMatcher(excludes), UniqueValues(fields))
+
+
+def compile_field_plan(definition):
+    """
+    Compile a single field definition: resolve its provider and split its JSON path and its format string.
+
+    :param dict definition: Column definition, e.g. ``{'guest_email': {'append': '@localhost', 'provider': 'md5'}}``
+    :return: The compiled field definition
+    :rtype: FieldPlan
+    """
+    full_column_name = get_column_name(definition, True)
+    column_definition = definition[full_column_name]
+    provider_config = column_definition.get('provider')
+    _format = column_definition.get('format')
+    format_fields = ()
+    if _format:
+        # Only the referenced columns are passed to the format string instead of the whole row
+        format_fields = tuple(set(
+            re.split(r'[.\[]', field_name, 1)[0] for field_name in get_format_field_names(_format)
+        ) - {'pga_value'})
+    keys = tuple(full_column_name.split('.'))
+    return FieldPlan(
+        path=full_column_name,
+        column_name=get_column_name(definition, False),
+        keys=keys if len(keys) > 1 else None,
+        provider_class=provider_registry.get_provider(provider_config['name']),
+        provider_config=provider_config,
+        append=column_definition.get('append'),
+        format=_format,
+        format_fields=format_fields,
+    )
 
 
-def process_row(row, columns, excludes):
-    if row_matches_excludes(row, excludes):
+def process_row(row, plan):
+    """
+    Anonymize a single data row according to a compiled table plan.
+
+    :param row: A data row, that is altered in place.
+    :param TablePlan plan: The compiled table plan, see :func:`compile_table_plan`.
+    :return: The altered row or None, if the row is excluded or none of its values has been altered.
+    """
+    if plan.excludes and plan.excludes.match(row) is not None:
         return None
     else:
-        row_column_dict = get_column_values(row, columns)
+        row_column_dict = apply_field_plans(row, plan.fields)
         if row_column_dict:
             for key, value in row_column_dict.items():
                 row[key] = value
@@ -75,6 +402,204 @@ def process_row(row, columns, excludes):
         return row
 
 
+def process_chunk(chunk, plan, verbose=False, parallel=False):
+    """
+    Anonymize a chunk of data rows according to a compiled table plan.
+
+    The excludes are matched in the current process, so the exclude counts of the plan are complete and excluded rows
+    aren't passed to the worker processes when the rows are anonymized in parallel. The remaining rows are anonymized
+    column by column with :func:`apply_field_plans_to_chunk`, in parallel every process of the active
+    :class:`WorkerPool` (or of a pool started for this chunk) gets a slice of them with the columns the field
+    definitions refer to. The values of the ``fake.unique.*`` fields of all processes are made unique afterwards, see
+    :class:`UniqueValues`.
+
+    :param pganonymize.chunk.Chunk chunk: The data rows, that are altered in place.
+    :param TablePlan plan: The compiled table plan, see :func:`compile_table_plan`.
+    :param bool verbose: Display a progress bar.
+    :param bool parallel: Data anonymization is done in parallel.
+    :return: The chunk, its ``altered`` mask marks the rows that have been anonymized.
+    :rtype: pganonymize.chunk.Chunk
+    """
+    indexes = plan.excludes.included_indexes(chunk) if plan.excludes else list(range(len(chunk)))
+    if not parallel:
+        return apply_field_plans_to_chunk(chunk, plan.fields, indexes)
+    column_names = []
+    for field in plan.fields:
+        for column_name in (field.column_name,) + field.format_fields:
+            if column_name not in column_names:
+                column_names.append(column_name)
+    worker_pool = WorkerPool.active or WorkerPool()
+    try:
+        size = int(math.ceil(len(indexes) / float(worker_pool.processes))) or 1
+        slices = [indexes[start:start + size] for start in range(0, len(indexes), size)]
+        results = worker_pool.map(plan.fields, [chunk.take(part, column_names) for part in slices], verbose=verbose)
+    finally:
+        if worker_pool is not WorkerPool.active:
+            worker_pool.close()
+    for part, result in zip(slices, results):
+        chunk.put(part, result)
+    if plan.uniques:
+        plan.uniques.deduplicate(chunk, indexes)
+    return chunk
+
+
+class WorkerPool(object):
+    """
+    A pool of worker processes to anonymize the chunks of all tables with the ``--parallel`` option.
+
+    The processes are started once and initialized with the schema and the compiled field definitions of the tables.
+    A chunk is sent with the index of its field definitions, field definitions that the pool hasn't been initialized
+    with are sent along with the chunk. While a pool is open it is the :attr:`active` pool, that :func:`process_chunk`
+    uses.
+
+    Every chunk is sent with a seed of its own, that is derived from the seed of the pool and the number of the chunk.
+    The worker process seeds Faker and :mod:`random` with it, so the generated values don't depend on the process a
+    chunk is anonymized by and the same seed (e.g. the ``seed`` Faker option) reproduces them.
+
+    The text columns of the chunks and of the anonymized chunks are passed as
+    :class:`pganonymize.chunk.SharedChunk` instead of being pickled, if shared memory is available. The buffers of the
+    chunks are kept and reused for the next chunks, while every worker process creates a buffer for its result.
+
+    :param list table_fields: The compiled field definitions of the tables, see :func:`get_table_fields`.
+    :param int processes: Number of worker processes, the number of CPUs if omitted.
+    :param bool share_chunks: Pass the chunks in shared memory, if it is available.
+    :param int seed: The seed of the pool, the ``seed`` Faker option or a random seed if omitted.
+    """
+
+    #: The open pool
+    active = None
+
+    def __init__(self, table_fields=(), processes=None, share_chunks=True, seed=None):
+        self.table_fields = list(table_fields)
+        self.processes = processes or multiprocessing.cpu_count()
+        if seed is None:
+            seed = faker_initializer.options.get('seed')
+        self.seed = seed if seed is not None else random.SystemRandom().getrandbits(64)
+        self._tasks = 0
+        # The unique values generated again by this process only depend on the seed as well, see `UniqueValues`. The
+        # chunks get the following seeds, otherwise this process would generate the values of the first chunk again.
+        faker_initializer.seed(self.seed)
+        self.share_chunks = share_chunks and shared_memory is not None
+        if self.share_chunks:
+            # The worker processes have to share the resource tracker, that removes leaked shared memory buffers
+            resource_tracker.ensure_running()
+        self._buffers = []
+        self._lock = threading.Lock()
+        self._pool = multiprocessing.Pool(self.processes, initializer=init_worker,
+                                          initargs=(config.schema, self.table_fields))
+        if WorkerPool.active is None:
+            WorkerPool.active = self
+
+    def map(self, fields, chunks, verbose=False):
+        """
+        Anonymize chunks in the worker processes.
+
+        :param tuple fields: The compiled field definitions, see :func:`compile_field_plan`.
+        :param list chunks: The chunks to anonymize, one per task.
+        :param bool verbose: Display a progress bar.
+        :return: The anonymized chunks in the same order.
+        :rtype: list
+        """
+        with self._lock:
+            if self.share_chunks:
+                chunks = [self._share(index, chunk) for index, chunk in enumerate(chunks)]
+            try:
+                index = self.table_fields.index(fields)
+            except ValueError:
+                index = None
+            tasks = [(index, fields if index is None else None, chunk, self.seed + 1 + self._tasks + number)
+                     for number, chunk in enumerate(chunks)]
+            self._tasks += len(tasks)
+            results = []
+            try:
+                for result in tqdm(self._pool.imap(apply_worker_fields, tasks), total=len(tasks),
+                                   disable=not verbose, leave=False):
+                    results.append(result)
+                return [result.to_chunk() if isinstance(result, SharedChunk) else result for result in results]
+            finally:
+                for result in results:
+                    if isinstance(result, SharedChunk):
+                        result.unlink()
+
+    def _share(self, index, chunk):
+        memory = self._buffers[index] if index < len(self._buffers) else None
+        # The values have been read from PostgreSQL
+        shared_chunk = SharedChunk.create(chunk, memory, check=False)
+        if shared_chunk.memory is not None:
+            if memory is not None:
+                memory.close()
+                memory.unlink()
+                self._buffers[index] = shared_chunk.memory
+            else:
+                self._buffers.append(shared_chunk.memory)
+        return shared_chunk
+
+    def close(self):
+        """
+        Stop the worker processes.
+        """
+        self._pool.terminate()
+        self._pool.join()
+        for memory in self._buffers:
+            memory.close()
+            memory.unlink()
+        self._buffers = []
+        if WorkerPool.active is self:
+            WorkerPool.active = None
+
+
+# The compiled field definitions a worker process has been initialized with, see `init_worker`
+worker_table_fields = []
+
+
+def init_worker(schema, table_fields):
+    """
+    Initialize a worker process of a :class:`WorkerPool` once.
+
+    :param dict schema: The parsed schema, so it isn't loaded again.
+    :param list table_fields: The compiled field definitions of the tables.
+    """
+    global worker_table_fields
+    config._schema = schema
+    worker_table_fields = table_fields
+
+
+def apply_worker_fields(task):
+    """
+    Anonymize a chunk in a worker process, see :meth:`WorkerPool.map`.
+
+    :param tuple task: The index of the field definitions, the field definitions if there is no index, the chunk and
+      its seed.
+    :return: The anonymized columns, shared if the chunk has been shared.
+    :rtype: pganonymize.chunk.Chunk or pganonymize.chunk.SharedChunk
+    """
+    index, fields, chunk, seed = task
+    # Forked processes inherit the random state of the main process and a process anonymizes any of the chunks
+    random.seed(seed)
+    faker_initializer.seed(seed)
+    fields = worker_table_fields[index] if fields is None else fields
+    shared = isinstance(chunk, SharedChunk)
+    chunk = apply_field_plans_to_chunk(chunk.to_chunk() if shared else chunk, fields)
+    # The columns only used by format strings haven't been changed
+    column_names = []
+    for field in fields:
+        if field.column_name not in column_names:
+            column_names.append(field.column_name)
+    chunk = Chunk(column_names, [chunk.column(column_name) for column_name in column_names], chunk.altered)
+    return SharedChunk.create(chunk) if shared else chunk
+
+
+def get_table_fields(definitions):
+    """
+    Compile the field definitions of all tables, e.g. to initialize a :class:`WorkerPool` with.
+
+    :param list definitions: The table definitions of the schema.
+    :return: A list of compiled field definitions, see :func:`compile_table_plan`.
+    :rtype: list
+    """
+    return [compile_table_plan(list(definition.values())[0].get('fields', [])).fields for definition in definitions]
+
+
 def build_and_then_import_data(
     connection,
     table,
@@ -87,136 +612,1652 @@ def build_and_then_import_data(
     verbose=False,
     dry_run=False,
     parallel=False,
+    binary_copy=False,
+    pipeline_depth=0,
+    batch_commit=False,
+    checkpoint=None,
+    start=None,
+):
+    """
+    Select all data from a table and return it together with a list of table columns.
+
+    :param connection: A database connection instance.
+    :param str table: Name of the table to retrieve the data.
+    :param str primary_key: Table primary key
+    :param list columns: A list of table fields
+    :param list[dict] excludes: A list of exclude definitions.
+    :param str search: A SQL WHERE (search_condition) to filter and keep only the searched rows.
+    :param int total_count: The (estimated) amount of rows for the current table, only used for the progress bar.
+    :param int chunk_size: Number of data rows to fetch with the cursor
+    :param bool verbose: Display logging information and a progress bar.
+    :param bool dry_run: Script is running in dry-run mode, no commit expected.
+    :param bool parallel: Data anonymization is done in parallel.
+    :param bool binary_copy: Read the table data with a binary ``COPY`` instead of a server-side cursor.
+    :param int pipeline_depth: Fetch, anonymize and import the batches concurrently with at most this many batches
+      waiting between the stages. 0 processes the batches one after another.
+    :param bool batch_commit: Apply and commit the anonymized rows after every batch instead of once per table.
+    :param str checkpoint: Save the last committed primary key value under this scan name after every batch, see
+      :func:`save_checkpoint`. Only used together with `batch_commit`.
+    :param start: Only anonymize the rows with a greater primary key value, e.g. the last value of a checkpoint.
+      Only used together with `batch_commit`.
+    """
+    column_names = get_column_names(columns)
+    key_columns = get_key_columns(primary_key)
+    sql_columns = get_select_columns(primary_key, column_names)
+    sql_select = SQL('SELECT {columns} FROM {table}').format(table=Identifier(table), columns=sql_columns)
+    if search:
+        sql_select = Composed([sql_select, SQL(" WHERE {search_condition}".format(search_condition=search))])
+    if dry_run:
+        sql_select = Composed([sql_select, SQL(" LIMIT 100")])
+        logging.info(sql_select.as_string(connection))
+    temp_table = 'tmp_{table}'.format(table=table)
+    plan = compile_table_plan(columns, excludes)
+
+    def transform(chunk):
+        chunk = process_chunk(chunk, plan, verbose=verbose, parallel=parallel)
+        return chunk.take(chunk.altered_indexes())
+
+    if batch_commit and not dry_run:
+        logging.info('Applying and committing changes on table {} after every batch'.format(table))
+        create_temporary_table(connection, columns, table, temp_table, primary_key)
+        # The queries of the fetching and the loading stage of the pipeline share the connection
+        lock = threading.Lock()
+
+        def transform_batch(chunk):
+            return get_key_value(chunk.row(-1), primary_key), transform(chunk)
+
+        def load(batch):
+            last_value, data = batch
+            with lock:
+                import_data(connection, temp_table, key_columns + column_names, data)
+                update_from_temporary_table(connection, temp_table, table, primary_key, columns)
+                truncate_temporary_table(connection, temp_table)
+                if checkpoint is not None:
+                    save_checkpoint(connection, table, checkpoint, last_value)
+                connection.commit()
+
+        if start is not None:
+            logging.info('Continuing table {} after the primary key {}'.format(table, start))
+        batches = fetch_keyset_batches(connection, table, primary_key, key_columns + column_names, search,
+                                       chunk_size, total_count, verbose=verbose, binary_copy=binary_copy, lock=lock,
+                                       start=start)
+        run_pipeline(batches, transform_batch, load, depth=pipeline_depth)
+    else:
+        cursor = None
+        # The queries of the fetching and the loading stage of the pipeline share the connection
+        lock = threading.Lock()
+        if use_keyset_copy(table, primary_key, binary_copy, dry_run):
+            batches = fetch_keyset_batches(connection, table, primary_key, key_columns + column_names, search,
+                                           chunk_size, total_count, verbose=verbose, binary_copy=True, lock=lock)
+        else:
+            cursor = get_fetch_cursor(connection, table, key_columns + column_names)
+            cursor.execute(sql_select.as_string(connection))
+            batches = fetch_batches(cursor, key_columns + column_names, chunk_size, total_count, table,
+                                    verbose=verbose)
+        create_temporary_table(connection, columns, table, temp_table, primary_key)
+
+        def load(data):
+            with lock:
+                import_data(connection, temp_table, key_columns + column_names, data)
+
+        run_pipeline(batches, transform, load, depth=pipeline_depth)
+        apply_anonymized_data(connection, temp_table, table, primary_key, columns)
+        if cursor is not None:
+            cursor.close()
+    remove_temporary_table(connection, temp_table)
+    plan.excludes.log_counts(table)
+    plan.uniques.log_counts(table)
+
+
+def use_keyset_copy(table, primary_key, binary_copy, dry_run=False):
+    """
+    Return whether the rows of a table, that are written on the same connection while they are read, are read with a
+    binary ``COPY`` per batch.
+
+    A binary ``COPY`` keeps the connection busy until all of its rows have been read, so every batch is read with a
+    ``COPY`` of its own ordered by the primary key, see :func:`fetch_keyset_batches`. Otherwise the rows are read with
+    a server-side cursor.
+
+    :param str table: Name of the table
+    :param primary_key: Table primary key, a column name, a list of column names or ``ctid``.
+    :param bool binary_copy: Read the table data with a binary ``COPY``.
+    :param bool dry_run: Script is running in dry-run mode, only a few rows are read with a single query.
+    :rtype: bool
+    """
+    if not binary_copy or dry_run:
+        return False
+    if primary_key is None or primary_key == CTID:
+        logging.info('Table {} is read with a server-side cursor, it has no primary key to read it in batches with '
+                     'binary COPY'.format(table))
+        return False
+    return True
+
+
+def run_pipeline(batches, transform, load, depth=0):
+    """
+    Transform and load batches of rows.
+
+    With a positive depth the batches are fetched and loaded by two background threads, while the current thread
+    transforms them, so fetching the next batch and loading the previous one overlaps with the transformation. At most
+    `depth` batches are waiting between two stages, to limit the memory usage.
+
+    :param batches: An iterable of chunks, e.g. :func:`fetch_batches`.
+    :param transform: A function that transforms a chunk.
+    :param load: A function that loads a transformed chunk.
+    :param int depth: The maximum number of batches waiting between two stages, 0 disables the pipeline.
+    """
+    if depth < 1:
+        for batch in batches:
+            load(transform(batch))
+        return
+
+    fetched = queue.Queue(maxsize=depth)
+    transformed = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+    errors = []
+
+    def put(stage_queue, item):
+        while not stopped.is_set():
+            try:
+                stage_queue.put(item, timeout=PIPELINE_TIMEOUT)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(stage_queue):
+        while not stopped.is_set():
+            try:
+                return stage_queue.get(timeout=PIPELINE_TIMEOUT)
+            except queue.Empty:
+                pass
+        return PIPELINE_END
+
+    def fetch():
+        try:
+            for batch in batches:
+                if not put(fetched, batch):
+                    return
+        except Exception as exc:
+            errors.append(exc)
+            stopped.set()
+        put(fetched, PIPELINE_END)
+
+    def load_all():
+        try:
+            while True:
+                data = get(transformed)
+                if data is PIPELINE_END:
+                    return
+                load(data)
+        except Exception as exc:
+            errors.append(exc)
+            stopped.set()
+
+    threads = [threading.Thread(target=fetch), threading.Thread(target=load_all)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        while True:
+            batch = get(fetched)
+            if batch is PIPELINE_END or not put(transformed, transform(batch)):
+                break
+        put(transformed, PIPELINE_END)
+    except Exception:
+        stopped.set()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+
+
+def get_fetch_cursor(connection, table, column_names, binary_copy=False, server_side=True):
+    """
+    Return a cursor to fetch the data of a table in batches.
+
+    :param connection: A database connection instance.
+    :param str table: Name of the table to retrieve the data.
+    :param list column_names: The names of the selected columns.
+    :param bool binary_copy: Read the data with a binary ``COPY``, if all column types are supported.
+    :param bool server_side: Return a server-side cursor, otherwise the whole result is fetched on execution.
+    :return: A cursor or a :class:`pganonymize.reader.CopyCursor`, both return the rows as tuples. The connection
+      can't be used for other queries until all rows of a ``CopyCursor`` have been fetched.
+    """
+    if binary_copy:
+        decoders = get_column_decoders(connection, table, [name for name in column_names if name != CTID_COLUMN])
+        if decoders is not None:
+            if CTID_COLUMN in column_names:
+                # The row location is selected as text
+                decoders.insert(column_names.index(CTID_COLUMN), type_decoders['text'])
+            return CopyCursor(connection, column_names, decoders)
+    if not server_side:
+        return connection.cursor()
+    return connection.cursor(name='fetch_large_result')
+
+
+def fetch_keyset_batches(connection, table, primary_key, column_names, search, chunk_size, total_count=None,
+                         verbose=False, binary_copy=False, lock=None, start=None):
+    """
+    Fetch the rows of a table in batches ordered by the primary key, every batch with a query of its own.
+
+    Unlike a server-side cursor the batches don't depend on a single transaction, so the rows fetched so far can be
+    committed in between.
+
+    :param connection: A database connection instance.
+    :param str table: Name of the table to retrieve the data.
+    :param primary_key: Table primary key, a column name or a list of column names.
+    :param list column_names: The names of the selected columns, including the primary key.
+    :param str search: A SQL WHERE (search_condition) to filter and keep only the searched rows.
+    :param int chunk_size: Number of data rows to fetch with every query
+    :param int total_count: The (estimated) amount of rows, used for the progress bar.
+    :param bool verbose: Display a progress bar.
+    :param bool binary_copy: Read the data with a binary ``COPY``, if all column types are supported.
+    :param lock: A lock that is held while a batch is fetched, if the connection is shared with other threads.
+    :param start: Only fetch the rows with a greater primary key value, a tuple (or its JSON representation, see
+      :func:`save_checkpoint`) for a primary key with multiple columns.
+    :return: A generator of :class:`pganonymize.chunk.Chunk` instances
+    """
+    lock = lock or threading.Lock()
+    sql_columns = SQL(', ').join([Identifier(column_name) for column_name in column_names])
+    sql_key = SQL(', ').join([Identifier(column_name) for column_name in get_key_columns(primary_key)])
+    cursor = get_fetch_cursor(connection, table, column_names, binary_copy=binary_copy, server_side=False)
+    last_value = start
+    if start is not None and not isinstance(start, (list, tuple)) and isinstance(primary_key, (list, tuple)):
+        last_value = json.loads(start)
+    with tqdm(total=total_count, desc='Processing {}'.format(table), unit='rows', disable=not verbose) as progress_bar:
+        while True:
+            conditions = []
+            if search:
+                conditions.append(SQL('({search_condition})'.format(search_condition=search)))
+            if last_value is not None:
+                if isinstance(last_value, (list, tuple)):
+                    value = SQL('({values})').format(values=SQL(', ').join([Literal(item) for item in last_value]))
+                    conditions.append(SQL('({primary_key}) > {value}').format(primary_key=sql_key, value=value))
+                else:
+                    value = Literal(last_value)
+                    conditions.append(SQL('{primary_key} > {value}').format(primary_key=sql_key, value=value))
+            sql = SQL('SELECT {columns} FROM {table}').format(columns=sql_columns, table=Identifier(table))
+            if conditions:
+                sql = Composed([sql, SQL(' WHERE '), SQL(' AND ').join(conditions)])
+            sql = Composed([sql, SQL(' ORDER BY {primary_key} LIMIT {limit}').format(
+                primary_key=sql_key, limit=Literal(chunk_size))])
+            with lock:
+                cursor.execute(sql.as_string(connection))
+                # A binary COPY ends with its last row, so the connection is free for other queries again
+                records = cursor.fetchall()
+            if not records:
+                break
+            chunk = Chunk.from_rows(column_names, records)
+            del records
+            last_value = get_key_value(chunk.row(-1), primary_key)
+            yield chunk
+            progress_bar.update(len(chunk))
+    cursor.close()
+
+
+def fetch_batches(cursor, column_names, chunk_size, total_count=None, table=None, verbose=False):
+    """
+    Fetch the rows of a cursor in chunks until it is exhausted.
+
+    :param cursor: A database cursor with an executed query.
+    :param list column_names: The names of the selected columns.
+    :param int chunk_size: Number of data rows to fetch at once
+    :param int total_count: The (estimated) amount of rows, used for the progress bar.
+    :param str table: Name of the table, used for the progress bar.
+    :param bool verbose: Display a progress bar.
+    :return: A generator of :class:`pganonymize.chunk.Chunk` instances
+    """
+    desc = 'Processing {}'.format(table) if table else None
+    with tqdm(total=total_count, desc=desc, unit='rows', disable=not verbose) as progress_bar:
+        while True:
+            records = cursor.fetchmany(size=chunk_size)
+            if not records:
+                break
+            # Only keep the columns, not the rows as well
+            chunk = Chunk.from_rows(column_names, records)
+            del records
+            yield chunk
+            progress_bar.update(len(chunk))
+
+
+def build_and_then_import_data_partitioned(
+    connection,
+    connection_pool,
+    table,
+    primary_key,
+    columns,
+    excludes,
+    search,
+    chunk_size,
+    partitions,
+    verbose=False,
+    dry_run=False,
+    exact_count=False,
+    binary_copy=False,
+    pipeline_depth=0,
+    batch_commit=False,
+    checkpoints=None,
+    settings=None,
 ):
     """
-    Select all data from a table and return it together with a list of table columns.
+    Split a table into primary key ranges and anonymize every range concurrently.
+
+    Every range is scanned, anonymized and applied on its own pooled connection and committed on its own.
+
+    :param connection: A database connection instance.
+    :param pganonymize.utils.ConnectionPool connection_pool: The pool to take the database connections from.
+    :param str table: Name of the table to retrieve the data.
+    :param str primary_key: Table primary key
+    :param list columns: A list of table fields
+    :param list[dict] excludes: A list of exclude definitions.
+    :param str search: A SQL WHERE (search_condition) to filter and keep only the searched rows.
+    :param int chunk_size: Number of data rows to fetch with the cursor
+    :param int partitions: The number of primary key ranges to scan concurrently.
+    :param bool verbose: Display logging information and a progress bar.
+    :param bool dry_run: Script is running in dry-run mode, no commit expected.
+    :param bool exact_count: Count the rows of every range exactly instead of using the planner's estimate.
+    :param bool binary_copy: Read the table data with a binary ``COPY`` instead of a server-side cursor.
+    :param int pipeline_depth: Fetch, anonymize and import the batches concurrently with at most this many batches
+      waiting between the stages. 0 processes the batches one after another.
+    :param bool batch_commit: Apply and commit the anonymized rows after every batch instead of once per table.
+    :param dict checkpoints: The checkpoints of the table by their scan names, see :func:`get_checkpoints`. Every
+      range is saved as a scan of its own, if a previous run saved the ranges they are reused instead of splitting
+      the table again. None doesn't save any checkpoints.
+    :param dict settings: Configuration parameters to change on every connection while its range is anonymized.
+    """
+    if checkpoints:
+        conditions = [condition or None for condition in sorted(checkpoints)]
+    else:
+        # A primary key with multiple columns is split by its first column
+        partition_column = get_key_columns(primary_key)[0]
+        bounds = get_partition_bounds(connection, table, partition_column, partitions)
+        conditions = get_partition_conditions(connection, partition_column, bounds, search)
+        if checkpoints is not None and batch_commit and not dry_run:
+            # The ranges are committed before any of them, so the table is split the same way if it is resumed
+            for condition in conditions:
+                save_checkpoint(connection, table, condition or '')
+            connection.commit()
+    logging.info('Scanning table {} in {} partitions'.format(table, len(conditions)))
+
+    def run(partition_connection, condition):
+        previous_settings = apply_settings(partition_connection, settings) if settings else None
+        total_count = get_row_count(partition_connection, table, condition, dry_run=dry_run, exact=exact_count)
+        build_and_then_import_data(
+            partition_connection,
+            table,
+            primary_key,
+            columns,
+            excludes,
+            condition,
+            total_count,
+            chunk_size,
+            verbose=verbose,
+            dry_run=dry_run,
+            binary_copy=binary_copy,
+            pipeline_depth=pipeline_depth,
+            batch_commit=batch_commit,
+            checkpoint=None if checkpoints is None else condition or '',
+            start=None if checkpoints is None else checkpoints.get(condition or ''),
+        )
+        if previous_settings:
+            apply_settings(partition_connection, previous_settings)
+
+    run_concurrently(connection_pool, run, conditions, len(conditions), dry_run=dry_run)
+
+
+def get_partition_bounds(connection, table, primary_key, partitions):
+    """
+    Return the primary key values that split a table into ranges of about the same number of rows.
+
+    The bounds are taken from the histogram PostgreSQL collects for the primary key column. If the table hasn't been
+    analyzed yet, integer primary keys are split evenly between their minimum and maximum value.
+
+    :param connection: A database connection instance
+    :param str table: Name of the database table
+    :param str primary_key: Table primary key
+    :param int partitions: The number of ranges
+    :return: A list of up to ``partitions - 1`` primary key values in the order of the column, empty if the table can't
+      be split.
+    :rtype: list
+    :raises InvalidConfiguration: If the table has no column of the primary key's name.
+    """
+    cursor = connection.cursor()
+    cursor.execute(
+        'SELECT pg_catalog.format_type(atttypid, atttypmod) FROM pg_catalog.pg_attribute '
+        'WHERE attrelid = %s::regclass AND attname = %s',
+        (Identifier(table).as_string(connection), primary_key)
+    )
+    row = cursor.fetchone()
+    if row is None:
+        cursor.close()
+        raise InvalidConfiguration(
+            'Table "{}" can\'t be split into partitions, it has no column "{}"'.format(table, primary_key))
+    sql = SQL(
+        'SELECT unnest(s.histogram_bounds::text::{type}[]) FROM pg_catalog.pg_stats s '
+        'JOIN pg_catalog.pg_class c ON c.relname = s.tablename '
+        'JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace AND n.nspname = s.schemaname '
+        'WHERE c.oid = %s::regclass AND s.attname = %s AND NOT s.inherited'
+    ).format(type=SQL(row[0]))
+    cursor.execute(sql.as_string(connection), (Identifier(table).as_string(connection), primary_key))
+    histogram = [row[0] for row in cursor.fetchall()]
+    if len(histogram) > 2:
+        step = len(histogram) - 1
+        bounds = [histogram[(i * step + partitions // 2) // partitions] for i in range(1, partitions)]
+    else:
+        sql = SQL('SELECT min({primary_key}), max({primary_key}) FROM {table}').format(
+            primary_key=Identifier(primary_key), table=Identifier(table))
+        cursor.execute(sql.as_string(connection))
+        minimum, maximum = cursor.fetchone()
+        if not isinstance(minimum, numbers.Integral) or not isinstance(maximum, numbers.Integral):
+            bounds = []
+        else:
+            bounds = [minimum + (maximum - minimum + 1) * i // partitions for i in range(1, partitions)]
+    cursor.close()
+    # The bounds are in the order of the column's collation already, which may differ from Python's order
+    return [bound for i, bound in enumerate(bounds) if i == 0 or bound != bounds[i - 1]]
+
+
+def get_partition_conditions(connection, primary_key, bounds, search=None):
+    """
+    Return a search condition for every primary key range between the given bounds.
+
+    :param connection: A database connection instance
+    :param str primary_key: Table primary key
+    :param list bounds: A sorted list of primary key values, see :func:`get_partition_bounds`.
+    :param str search: A SQL WHERE (search_condition) that is added to every range.
+    :return: A list of search conditions
+    :rtype: list[str]
+    """
+    column = Identifier(primary_key)
+    ranges = []
+    for lower, upper in zip([None] + bounds, bounds + [None]):
+        conditions = []
+        if search:
+            conditions.append(SQL('({search_condition})'.format(search_condition=search)))
+        if lower is not None:
+            conditions.append(SQL('{column} >= {value}').format(column=column, value=Literal(lower)))
+        if upper is not None:
+            conditions.append(SQL('{column} < {value}').format(column=column, value=Literal(upper)))
+        ranges.append(SQL(' AND ').join(conditions).as_string(connection) if conditions else None)
+    return ranges
+
+
+def get_pool_size(definitions, jobs=1):
+    """
+    Return the number of database connections needed to anonymize the given table definitions.
+
+    :param list definitions: A list of table definitions from the YAML schema.
+    :param int jobs: Number of tables to anonymize concurrently.
+    :return: The maximum number of concurrently used pooled connections, 0 if no connection pool is needed.
+    :rtype: int
+    """
+    partitions = max([list(definition.values())[0].get('partitions', 1) for definition in definitions] or [1])
+    if jobs > 1:
+        return jobs * (partitions + 1) if partitions > 1 else jobs
+    return partitions if partitions > 1 else 0
+
+
+def build_and_then_rewrite_data(
+    connection,
+    table,
+    columns,
+    excludes,
+    total_count,
+    chunk_size,
+    verbose=False,
+    dry_run=False,
+    parallel=False,
+    binary_copy=False,
+    pipeline_depth=0,
+    primary_key=None,
+):
+    """
+    Rewrite a whole table with anonymized data instead of updating the rows in place.
+
+    All rows, including the excluded ones, are copied into a new table, that replaces the original table afterwards.
+    The constraints, indexes, triggers and views of the original table are recreated for the new one.
+
+    :param connection: A database connection instance.
+    :param str table: Name of the table to be rewritten.
+    :param list columns: A list of table fields
+    :param list[dict] excludes: A list of exclude definitions.
+    :param int total_count: The (estimated) amount of rows for the current table, only used for the progress bar.
+    :param int chunk_size: Number of data rows to fetch with the cursor
+    :param bool verbose: Display logging information and a progress bar.
+    :param bool dry_run: Script is running in dry-run mode, no commit expected.
+    :param bool parallel: Data anonymization is done in parallel.
+    :param bool binary_copy: Read the table data with a binary ``COPY`` instead of a server-side cursor.
+    :param int pipeline_depth: Fetch, anonymize and import the batches concurrently with at most this many batches
+      waiting between the stages. 0 processes the batches one after another.
+    :param primary_key: Table primary key, only used to read the table in batches with `binary_copy`.
+    :raises InvalidConfiguration: If the table is referenced by foreign keys, has identity or generated columns,
+      columns pgcopy can't write or materialized views depending on it.
+    """
+    referencing_tables = get_referencing_tables(connection, table)
+    if referencing_tables:
+        raise InvalidConfiguration('Table "{}" can\'t be rewritten, it is referenced by foreign keys of {}'.format(
+            table, ', '.join(referencing_tables)))
+    generated_columns = get_generated_columns(connection, table)
+    if generated_columns:
+        # The new table is created like the original one with plain columns, the generation expressions would become
+        # defaults and the identities would be lost
+        raise InvalidConfiguration('Table "{}" can\'t be rewritten, it has the identity or generated columns {}'.format(
+            table, ', '.join(generated_columns)))
+    materialized_views = get_dependent_materialized_views(connection, table)
+    if materialized_views:
+        # pgcopy only drops and recreates plain views, dropping the table would fail
+        raise InvalidConfiguration('Table "{}" can\'t be rewritten, the materialized views {} depend on it'.format(
+            table, ', '.join(materialized_views)))
+    column_names = get_table_column_names(connection, table)
+    json_columns = get_json_columns(get_copy_column_types(connection, table, column_names))
+    sql_columns = SQL(', ').join([Identifier(column_name) for column_name in column_names])
+    sql_select = SQL('SELECT {columns} FROM {table}').format(table=Identifier(table), columns=sql_columns)
+    if dry_run:
+        sql_select = Composed([sql_select, SQL(" LIMIT 100")])
+        logging.info(sql_select.as_string(connection))
+    if primary_key is not None and not set(get_key_columns(primary_key)) <= set(column_names):
+        primary_key = None
+    cursor = None
+    # The queries of the fetching and the loading stage of the pipeline share the connection
+    lock = threading.Lock()
+    if use_keyset_copy(table, primary_key, binary_copy, dry_run):
+        batches = fetch_keyset_batches(connection, table, primary_key, column_names, None, chunk_size, total_count,
+                                       verbose=verbose, binary_copy=True, lock=lock)
+    else:
+        cursor = get_fetch_cursor(connection, table, column_names)
+        cursor.execute(sql_select.as_string(connection))
+        batches = fetch_batches(cursor, column_names, chunk_size, total_count, table, verbose=verbose)
+    plan = compile_table_plan(columns, excludes)
+
+    def transform(chunk):
+        # Rows that haven't been anonymized are copied unchanged
+        return process_chunk(chunk, plan, verbose=verbose, parallel=parallel)
+
+    def load(data):
+        with lock:
+            import_data(connection, new_table, column_names, data, json_columns)
+
+    with Replace(connection, table) as new_table:
+        run_pipeline(batches, transform, load, depth=pipeline_depth)
+        if cursor is not None:
+            cursor.close()
+        plan.excludes.log_counts(table)
+        plan.uniques.log_counts(table)
+        logging.info('Replacing table {}'.format(table))
+
+
+def get_secondary_indexes(connection, table, column_names=None):
+    """
+    Return the secondary indexes of a table.
+
+    The index of the primary key and indexes that belong to a constraint or are referenced by a foreign key are left
+    out, as they can't be dropped on their own.
+
+    :param connection: A database connection instance
+    :param str table: Name of the database table
+    :param list column_names: Only return the indexes that cover one of these columns, in their key, an expression or
+      the predicate. None returns all secondary indexes.
+    :return: A list of tuples with the (qualified) name and the definition of the indexes.
+    :rtype: list
+    """
+    cursor = connection.cursor()
+    sql = (
+        'SELECT i.indexrelid::regclass::text, pg_catalog.pg_get_indexdef(i.indexrelid) FROM pg_catalog.pg_index i '
+        'WHERE i.indrelid = %s::regclass AND NOT i.indisprimary '
+        'AND NOT EXISTS (SELECT 1 FROM pg_catalog.pg_constraint c WHERE c.conindid = i.indexrelid)'
+    )
+    args = [Identifier(table).as_string(connection)]
+    if column_names is not None:
+        sql += (
+            ' AND EXISTS (SELECT 1 FROM pg_catalog.pg_depend d JOIN pg_catalog.pg_attribute a '
+            'ON a.attrelid = d.refobjid AND a.attnum = d.refobjsubid '
+            "WHERE d.classid = 'pg_catalog.pg_class'::regclass AND d.objid = i.indexrelid "
+            'AND d.refobjid = i.indrelid AND a.attname = ANY(%s))'
+        )
+        args.append(list(column_names))
+    cursor.execute(sql + ' ORDER BY 1', args)
+    indexes = [tuple(row) for row in cursor.fetchall()]
+    cursor.close()
+    return indexes
+
+
+def drop_secondary_indexes(connection, table, column_names=None, resume=False):
+    """
+    Drop the secondary indexes of a table, so they don't need to be maintained while the table is changed.
+
+    :param connection: A database connection instance
+    :param str table: Name of the database table
+    :param list column_names: Only drop the indexes that cover one of these columns, see :func:`get_secondary_indexes`.
+    :param bool resume: Save the dropped indexes in the checkpoint table and include the indexes a previous run has
+      dropped.
+    :return: A list of tuples with the name and the definition of the dropped indexes.
+    :rtype: list
+    """
+    indexes = get_secondary_indexes(connection, table, column_names)
+    if resume:
+        save_index_checkpoints(connection, table, indexes)
+    cursor = connection.cursor()
+    for name, definition in indexes:
+        logging.info('Dropping index {} of table {}'.format(name, table))
+        cursor.execute(SQL('DROP INDEX {index}').format(index=SQL(name)).as_string(connection))
+    cursor.close()
+    if resume:
+        indexes = get_index_checkpoints(connection, table)
+    return indexes
+
+
+def create_indexes(connection, table, indexes, verbose=False):
+    """
+    Rebuild the dropped indexes of a table.
+
+    The indexes are created one after another on the connection of the table. PostgreSQL builds a single B-tree index
+    with parallel workers if ``max_parallel_maintenance_workers`` allows it.
+
+    :param connection: A database connection instance
+    :param str table: Name of the database table
+    :param list indexes: A list of tuples with the name and the definition of the indexes.
+    :param bool verbose: Display a progress bar.
+    """
+    cursor = connection.cursor()
+    for name, definition in tqdm(indexes, desc='Rebuilding indexes of {}'.format(table), disable=not verbose):
+        start_time = time.time()
+        cursor.execute(definition)
+        logging.info('Rebuilding index {} took {:.2f}s'.format(name, time.time() - start_time))
+    cursor.close()
+
+
+def get_table_column_names(connection, table):
+    """
+    Return the names of all columns of a table.
+
+    :param connection: A database connection instance
+    :param str table: Name of the database table
+    :return: A list of column names, ordered by their position within the table
+    :rtype: list
+    """
+    cursor = connection.cursor()
+    cursor.execute(
+        'SELECT attname FROM pg_catalog.pg_attribute '
+        'WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped ORDER BY attnum',
+        (Identifier(table).as_string(connection),)
+    )
+    column_names = [row[0] for row in cursor.fetchall()]
+    cursor.close()
+    return column_names
+
+
+def get_generated_columns(connection, table):
+    """
+    Return the identity columns and the generated columns of a table.
+
+    :param connection: A database connection instance
+    :param str table: Name of the database table
+    :return: A list of column names, ordered by their position within the table
+    :rtype: list
+    """
+    conditions = []
+    if connection.server_version >= 100000:
+        conditions.append('attidentity <> \'\'')
+    if connection.server_version >= 120000:
+        conditions.append('attgenerated <> \'\'')
+    if not conditions:
+        return []
+    cursor = connection.cursor()
+    cursor.execute(
+        'SELECT attname FROM pg_catalog.pg_attribute '
+        'WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped AND ({}) ORDER BY attnum'.format(
+            ' OR '.join(conditions)),
+        (Identifier(table).as_string(connection),)
+    )
+    column_names = [row[0] for row in cursor.fetchall()]
+    cursor.close()
+    return column_names
+
+
+def get_copy_column_types(connection, table, column_names):
+    """
+    Return the types of the columns :func:`import_data` writes to a table.
+
+    The values are written with a binary ``COPY`` by pgcopy, that only knows the binary format of the common types,
+    e.g. not the one of ``inet``, ``interval`` or domain types.
+
+    :param connection: A database connection instance
+    :param table: Name of the database table, or a tuple with the schema name and the name of the table
+    :param list column_names: The columns to write
+    :return: The type names by the column names, e.g. ``{'id': 'int4', 'tags': '_text'}``
+    :rtype: dict
+    :raises InvalidConfiguration: If pgcopy can't write the values of one of the columns.
+    """
+    if isinstance(table, tuple):
+        sql_table, table = Identifier(*table), '.'.join(table)
+    else:
+        sql_table = Identifier(table)
+    cursor = connection.cursor()
+    # Arrays are written with the formatter of their element type, like pgcopy looks it up
+    cursor.execute(
+        'SELECT a.attname, t.typname, pg_catalog.format_type(a.atttypid, a.atttypmod), '
+        't.typcategory = \'E\' OR COALESCE(e.typname, t.typname) = ANY(%s) '
+        'FROM pg_catalog.pg_attribute a JOIN pg_catalog.pg_type t ON t.oid = a.atttypid '
+        'LEFT JOIN pg_catalog.pg_type e ON e.oid = t.typelem '
+        'WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped AND a.attname = ANY(%s) '
+        'ORDER BY a.attnum',
+        (sorted(type_formatters), sql_table.as_string(connection), list(column_names))
+    )
+    rows = cursor.fetchall()
+    cursor.close()
+    unsupported_columns = ['{} ({})'.format(column_name, type_name)
+                           for column_name, _, type_name, supported in rows if not supported]
+    if unsupported_columns:
+        raise InvalidConfiguration('Table "{}" can\'t be written with a binary COPY, the types of the columns {} '
+                                   'aren\'t supported'.format(table, ', '.join(unsupported_columns)))
+    return OrderedDict((column_name, type_name) for column_name, type_name, _, _ in rows)
+
+
+def get_json_columns(column_types):
+    """
+    Return the JSON columns of a table, whose values :func:`import_data` has to serialize.
+
+    :param dict column_types: The type names by the column names, see :func:`get_copy_column_types`
+    :return: A list of column names
+    :rtype: list
+    """
+    return [column_name for column_name, type_name in column_types.items() if type_name in ('json', 'jsonb')]
+
+
+def get_referencing_tables(connection, table):
+    """
+    Return the names of all tables that reference a table with a foreign key (including the table itself).
+
+    :param connection: A database connection instance
+    :param str table: Name of the database table
+    :return: A list of table names
+    :rtype: list
+    """
+    cursor = connection.cursor()
+    cursor.execute(
+        'SELECT DISTINCT conrelid::regclass::text FROM pg_catalog.pg_constraint '
+        'WHERE contype = \'f\' AND confrelid = %s::regclass',
+        (Identifier(table).as_string(connection),)
+    )
+    table_names = [row[0] for row in cursor.fetchall()]
+    cursor.close()
+    return table_names
+
+
+def get_dependent_materialized_views(connection, table):
+    """
+    Return the names of all materialized views that select from a table.
+
+    :param connection: A database connection instance
+    :param str table: Name of the database table
+    :return: A list of view names
+    :rtype: list
+    """
+    cursor = connection.cursor()
+    cursor.execute(
+        'SELECT DISTINCT r.ev_class::regclass::text FROM pg_catalog.pg_rewrite r '
+        'JOIN pg_catalog.pg_depend d ON d.classid = \'pg_catalog.pg_rewrite\'::regclass AND d.objid = r.oid '
+        'JOIN pg_catalog.pg_class c ON c.oid = r.ev_class '
+        'WHERE d.refobjid = %s::regclass AND c.relkind = \'m\' ORDER BY 1',
+        (Identifier(table).as_string(connection),)
+    )
+    view_names = [row[0] for row in cursor.fetchall()]
+    cursor.close()
+    return view_names
+
+
+def apply_anonymized_data(connection, temp_table, source_table, primary_key, definitions):
+    logging.info('Applying changes on table {}'.format(source_table))
+    # Rows addressed by their location are joined with a TID scan or a hash join, they don't need an index
+    if primary_key != CTID:
+        cursor = connection.cursor()
+        create_index_sql = SQL('CREATE INDEX ON {temp_table} ({primary_key})')
+        sql = create_index_sql.format(
+            temp_table=Identifier(temp_table),
+            primary_key=SQL(', ').join([Identifier(column_name) for column_name in get_key_columns(primary_key)]),
+        )
+        cursor.execute(sql.as_string(connection))
+        cursor.close()
+    update_from_temporary_table(connection, temp_table, source_table, primary_key, definitions)
+
+
+def update_from_temporary_table(connection, temp_table, source_table, primary_key, definitions):
+    """
+    Update the anonymized columns of a table with the rows of the temporary table.
+
+    Only rows with at least one changed column are updated and unchanged columns keep their current value, so no
+    new row versions are written for unchanged rows and unchanged (e.g. TOASTed) values aren't written again.
+
+    :param connection: A database connection instance.
+    :param str temp_table: Name of the temporary table with the anonymized rows.
+    :param str source_table: Name of the table to be updated.
+    :param str primary_key: Table primary key
+    :param list definitions: A list of table fields
+    """
+    cursor = connection.cursor()
+    column_names = get_column_names(definitions)
+    text_columns = get_columns_without_equality(connection, source_table, column_names)
+    set_columns = []
+    changes = []
+    for column in column_names:
+        comparison = SQL('t.{column} IS DISTINCT FROM s.{column}')
+        if column in text_columns:
+            comparison = SQL('t.{column}::text IS DISTINCT FROM s.{column}::text')
+        comparison = comparison.format(column=Identifier(column))
+        changes.append(comparison)
+        set_columns.append(SQL('{column} = CASE WHEN {comparison} THEN s.{column} ELSE t.{column} END').format(
+            column=Identifier(column), comparison=comparison))
+    sql_args = {
+        'table': Identifier(source_table),
+        'columns': SQL(', ').join(set_columns),
+        'source': Identifier(temp_table),
+        'join_condition': get_key_join_condition(primary_key),
+        'changes': SQL(' OR ').join(changes),
+    }
+    sql = SQL(
+        'UPDATE {table} t '
+        'SET {columns} '
+        'FROM {source} s '
+        'WHERE {join_condition} AND ({changes})'
+    ).format(**sql_args)
+    cursor.execute(sql.as_string(connection))
+    logging.info('Updated {} changed rows of table {}'.format(cursor.rowcount, source_table))
+    cursor.close()
+
+
+def get_columns_without_equality(connection, table, column_names):
+    """
+    Return the columns whose type has no equality operator of its own (e.g. ``json``, arrays or domains).
+
+    These columns are compared by their text representation.
+
+    :param connection: A database connection instance
+    :param str table: Name of the database table
+    :param list column_names: A list of column names
+    :return: A set of column names
+    :rtype: set
+    """
+    cursor = connection.cursor()
+    cursor.execute(
+        'SELECT a.attname FROM pg_catalog.pg_attribute a '
+        'WHERE a.attrelid = %s::regclass AND a.attname = ANY(%s) AND NOT EXISTS ('
+        "SELECT 1 FROM pg_catalog.pg_operator o WHERE o.oprname = '=' "
+        'AND o.oprleft = a.atttypid AND o.oprright = a.atttypid)',
+        (Identifier(table).as_string(connection), list(column_names))
+    )
+    column_names = {row[0] for row in cursor.fetchall()}
+    cursor.close()
+    return column_names
+
+
+def apply_pushdown_update(connection, table, pushdown_columns, search, dry_run=False):
+    """
+    Anonymize columns of a table with a single UPDATE statement evaluated by PostgreSQL.
+
+    :param connection: A database connection instance.
+    :param str table: Name of the table to be anonymized.
+    :param list pushdown_columns: A list of ``(column name, SQL expression)`` tuples, see :func:`get_pushdown_columns`.
+    :param str search: A SQL WHERE (search_condition) to filter and keep only the searched rows.
+    :param bool dry_run: Script is running in dry-run mode, the statement will only be explained.
+    """
+    logging.info('Applying SQL expressions for columns %s on table %s',
+                 ', '.join(name for name, _ in pushdown_columns), table)
+    set_columns = SQL(', ').join([
+        SQL('{column} = {expression}').format(column=Identifier(name), expression=expression)
+        for name, expression in pushdown_columns
+    ])
+    sql = SQL('UPDATE {table} SET {columns}').format(table=Identifier(table), columns=set_columns)
+    if search:
+        sql = Composed([sql, SQL(" WHERE {search_condition}".format(search_condition=search))])
+    if dry_run:
+        sql = Composed([SQL('EXPLAIN '), sql])
+        logging.info(sql.as_string(connection))
+    cursor = connection.cursor()
+    cursor.execute(sql.as_string(connection))
+    cursor.close()
+
+
+def get_search_condition(connection, search, excludes):
+    """
+    Combine a search condition with the SQL condition of the exclude definitions.
+
+    :param connection: A database connection instance.
+    :param str search: A SQL WHERE (search_condition) to filter and keep only the searched rows.
+    :param list[dict] excludes: A list of exclude definitions, that can be translated by :func:`get_exclude_condition`.
+    :return: The combined search condition
+    :rtype: str
+    """
+    conditions = []
+    if search:
+        conditions.append(SQL('({search_condition})'.format(search_condition=search)))
+    if excludes:
+        conditions.append(SQL('NOT ({excludes})').format(excludes=get_exclude_condition(excludes)))
+    return SQL(' AND ').join(conditions).as_string(connection)
+
+
+def get_fetch_condition(connection, search, columns, excludes):
+    """
+    Extend a search condition, so PostgreSQL filters the rows that wouldn't be anonymized anyway.
+
+    The exclude patterns that can be translated by :func:`translate_exclude_pattern` are evaluated by PostgreSQL and
+    rows are only fetched if at least one of the anonymized columns isn't NULL, as NULL values are never altered.
+
+    :param connection: A database connection instance.
+    :param str search: A SQL WHERE (search_condition) to filter and keep only the searched rows.
+    :param list columns: A list of table columns with their provider rules.
+    :param list[dict] excludes: A list of exclude definitions.
+    :return: The search condition (None without any condition) and the exclude definitions that still have to be
+      matched by Python.
+    :rtype: tuple
+    """
+    sql_excludes, excludes = split_excludes(excludes)
+    conditions = []
+    if search:
+        conditions.append(SQL('({search_condition})'.format(search_condition=search)))
+    if sql_excludes:
+        conditions.append(SQL('NOT ({excludes})').format(excludes=get_exclude_condition(sql_excludes)))
+    column_names = get_column_names(columns)
+    if column_names:
+        not_null = SQL(' OR ').join([
+            SQL('{column} IS NOT NULL').format(column=Identifier(column_name)) for column_name in column_names
+        ])
+        conditions.append(SQL('({not_null})').format(not_null=not_null) if len(column_names) > 1 else not_null)
+    if not conditions:
+        return search, excludes
+    return SQL(' AND ').join(conditions).as_string(connection), excludes
+
+
+def split_excludes(excludes):
+    """
+    Split exclude definitions into the patterns that can be evaluated by PostgreSQL and the remaining ones.
+
+    :param list[dict] excludes: A list of exclude definitions.
+    :return: A list of exclude definitions for :func:`get_exclude_condition` and a list of the remaining ones.
+    :rtype: tuple
+    """
+    sql_excludes = []
+    remaining_excludes = []
+    for definition in excludes or []:
+        column = list(definition.keys())[0]
+        patterns = definition.get(column) or []
+        sql_patterns = [pattern for pattern in patterns if translate_exclude_pattern(pattern) is not None]
+        remaining_patterns = [pattern for pattern in patterns if pattern not in sql_patterns]
+        if sql_patterns:
+            sql_excludes.append({column: sql_patterns})
+        if remaining_patterns:
+            remaining_excludes.append({column: remaining_patterns})
+    return sql_excludes, remaining_excludes
+
+
+def log_sql_excludes(table, excludes, remaining_excludes):
+    """
+    Log the exclude rules PostgreSQL has evaluated, as their matches aren't counted like the ones matched by Python.
+
+    :param str table: Name of the table
+    :param list[dict] excludes: The exclude definitions of the table.
+    :param list[dict] remaining_excludes: The exclude definitions that have been matched by Python.
+    """
+    remaining_rules = set(get_exclude_rules(remaining_excludes))
+    for column, pattern in get_exclude_rules(excludes):
+        if (column, pattern) not in remaining_rules:
+            logging.info('Exclude rule "{}" on column {} of table {} was evaluated by PostgreSQL, its matches are not '
+                         'counted'.format(pattern, column, table))
+
+
+def get_exclude_rules(excludes):
+    """
+    Return the column and the pattern of every exclude rule.
+
+    :param list[dict] excludes: A list of exclude definitions.
+    :rtype: list
+    """
+    rules = []
+    for definition in excludes or []:
+        column = list(definition.keys())[0]
+        rules.extend((column, pattern) for pattern in definition.get(column) or [])
+    return rules
+
+
+def get_pushdown_columns(columns, primary_key, excludes=None):
+    """
+    Split column definitions into the ones that can be evaluated by PostgreSQL and the remaining ones.
+
+    All columns stay with Python, if the exclude patterns can't be translated or if a ``format`` refers to another
+    column that is anonymized, as the result would depend on the order of evaluation.
+
+    :param list columns: A list of table columns with their provider rules.
+    :param str primary_key: Table primary key
+    :param list[dict] excludes: A list of exclude definitions.
+    :return: A list of ``(column name, SQL expression)`` tuples and a list of the remaining column definitions.
+    :rtype: tuple
+    """
+    if excludes and get_exclude_condition(excludes) is None:
+        return [], columns
+    column_names = [get_column_name(definition) for definition in columns]
+    for definition in columns:
+        _format = definition[get_column_name(definition, True)].get('format')
+        if _format and any(field_name in column_names for field_name in get_format_field_names(_format)):
+            return [], columns
+    pushdown_columns = []
+    remaining_columns = []
+    for definition, column_name in zip(columns, column_names):
+        expression = None
+        # Columns with multiple definitions (e.g. JSON paths) are left to Python
+        if column_names.count(column_name) == 1:
+            expression = get_column_sql_expression(definition, primary_key)
+        if expression is None:
+            remaining_columns.append(definition)
+        else:
+            pushdown_columns.append((column_name, expression))
+    return pushdown_columns, remaining_columns
+
+
+def get_column_sql_expression(definition, primary_key):
+    """
+    Return an SQL expression that computes the anonymized value of a column, including ``append`` and ``format``.
+
+    :param dict definition: Column definition
+    :param str primary_key: Table primary key
+    :return: The SQL expression or None, if the column definition can't be evaluated by PostgreSQL.
+    :rtype: psycopg2.sql.Composable
+    """
+    full_column_name = get_column_name(definition, True)
+    column_name = get_column_name(definition, False)
+    if full_column_name != column_name:
+        return None
+    column_definition = definition[full_column_name]
+    provider_config = column_definition.get('provider')
+    provider_class = provider_registry.get_provider(provider_config['name'])
+    expression = provider_class.sql_expression(Identifier(column_name), **provider_config)
+    if expression is None:
+        return None
+    append = column_definition.get('append')
+    _format = column_definition.get('format')
+    if (append or _format) and expression == SQL('NULL'):
+        return None
+    if append:
+        expression = SQL('({expression} || {append})').format(expression=expression, append=Literal(append))
+    if _format:
+        if 'pga_value' not in get_format_field_names(_format):
+            return None
+        parts = []
+        for literal_text, field_name, format_spec, conversion in Formatter().parse(_format):
+            if literal_text:
+                parts.append(Literal(literal_text))
+            if field_name is None:
+                continue
+            if format_spec or conversion:
+                return None
+            if field_name == 'pga_value':
+                parts.append(SQL('({expression})::text').format(expression=expression))
+            elif primary_key != CTID and field_name in get_key_columns(primary_key):
+                parts.append(SQL('{primary_key}::text').format(primary_key=Identifier(field_name)))
+            else:
+                return None
+        expression = SQL('({parts})').format(parts=SQL(' || ').join(parts))
+    return expression
+
+
+def get_format_field_names(_format):
+    """
+    Return the names of all replacement fields of a format string.
+
+    :param str _format: The format string, e.g. ``'{pga_value}-{id}'``
+    :return: A list of field names
+    :rtype: list
+    """
+    return [field_name for _, field_name, _, _ in Formatter().parse(_format) if field_name is not None]
+
+
+def get_exclude_condition(excludes):
+    """
+    Return an SQL condition that is true for every row matching one of the exclude definitions.
+
+    :param list excludes: A list of field exclusion roles, see :func:`row_matches_excludes`.
+    :return: The SQL condition or None, if one of the patterns can't be translated for PostgreSQL.
+    :rtype: psycopg2.sql.Composable
+    """
+    conditions = []
+    for definition in excludes:
+        column = list(definition.keys())[0]
+        for exclude in definition.get(column, []):
+            pattern = translate_exclude_pattern(exclude)
+            if pattern is None:
+                return None
+            condition = SQL('coalesce({column} ~* {pattern}, false)')
+            conditions.append(condition.format(column=Identifier(column), pattern=Literal(pattern)))
+    return SQL(' OR ').join(conditions)
+
+
+def translate_exclude_pattern(pattern):
+    """
+    Translate a Python exclude pattern into a PostgreSQL regular expression that matches the same values.
+
+    Only a conservative subset of the regular expression syntax is translated: literals, escaped special characters,
+    the ``\\d``, ``\\s`` and ``\\w`` classes, bracket expressions, groups, alternations and quantifiers.
+
+    :param str pattern: The regular expression pattern of an exclude definition.
+    :return: The pattern for the PostgreSQL ``~*`` operator or None, if the pattern can't be translated.
+    :rtype: str
+    """
+    translated = []
+    in_bracket = False
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        if char == '\\':
+            escaped = pattern[index + 1:index + 2]
+            if not escaped or (escaped.isalnum() and escaped not in 'dDsSwW'):
+                return None
+            if in_bracket and escaped in 'DSW':
+                return None
+            translated.append(pattern[index:index + 2])
+            index += 2
+            continue
+        if in_bracket:
+            if char == '[':
+                return None
+            if char == ']' and pattern[index - 1] != '[' and pattern[index - 2:index] != '[^':
+                in_bracket = False
+        elif char == '[':
+            in_bracket = True
+        elif char == '(' and pattern.startswith('(?', index) and not pattern.startswith('(?:', index):
+            return None
+        elif char in '*+?}' and pattern.startswith('+', index + 1):
+            return None
+        elif char == '{' and not re.match(r'\{\d+(,\d*)?\}', pattern[index:]):
+            return None
+        elif char == '.':
+            # Python's dot doesn't match a newline
+            char = '[^\\n]'
+        elif char == '$':
+            # Python's dollar sign also matches before a trailing newline
+            char = '\\n?$'
+        translated.append(char)
+        index += 1
+    if in_bracket:
+        return None
+    # Python's re.match only matches at the beginning of a value
+    return '^(?:{})'.format(''.join(translated))
+
+
+def row_matches_excludes(row, excludes=None):
+    """
+    Check whether a row matches a list of field exclusion patterns.
+
+    :param list row: The data row
+    :param list excludes: A list of field exclusion roles, e.g.:
+
+    >>> [
+    >>>     {'email': ['\\S.*@example.com', '\\S.*@foobar.com', ]}
+    >>> ]
+
+    :return: True or False
+    :rtype: bool
+    """
+    return ExcludeMatcher(excludes).match(row) is not None
+
+
+class ExcludeMatcher(object):
+    """
+    Match data rows against the exclude definitions of a table.
+
+    The patterns of a column are compiled once into a single alternation, so a value is matched with one regex call
+    instead of one per pattern. The rows matched by every exclude rule are counted.
+    """
+
+    def __init__(self, excludes=None):
+        # The column and the pattern of every exclude rule
+        self.rules = []
+        # The number of rows every exclude rule has matched
+        self.counts = []
+        # The column, the compiled regexes and the index of their first rule for every column
+        self._columns = []
+        column_rules = OrderedDict()
+        for definition in excludes or []:
+            column = list(definition.keys())[0]
+            column_rules.setdefault(column, []).extend(definition.get(column) or [])
+        for column, patterns in column_rules.items():
+            self._columns.append((column, compile_exclude_patterns(patterns), len(self.rules)))
+            self.rules.extend((column, pattern) for pattern in patterns)
+            self.counts.extend(0 for _ in patterns)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def match(self, row):
+        """
+        Return the exclude rule a row matches and count the match.
+
+        :param dict row: The data row
+        :return: The index of the first matching rule within :attr:`rules`, None if the row isn't excluded.
+        :rtype: int
+        """
+        for column, regexes, first_rule in self._columns:
+            value = row[column]
+            if value is not None:
+                rule = self._match_value(value, regexes, first_rule)
+                if rule is not None:
+                    return rule
+        return None
+
+    def included_indexes(self, chunk):
+        """
+        Return the rows of a chunk that aren't excluded and count the matches of the excluded ones.
+
+        :param pganonymize.chunk.Chunk chunk: The data rows
+        :return: The indexes of the rows that aren't excluded
+        :rtype: list
+        """
+        indexes = list(range(len(chunk)))
+        for column, regexes, first_rule in self._columns:
+            values = chunk.column(column)
+            indexes = [
+                index for index in indexes
+                if values[index] is None or self._match_value(values[index], regexes, first_rule) is None
+            ]
+        return indexes
+
+    def _match_value(self, value, regexes, first_rule):
+        for regex, offset in regexes:
+            match = regex.match(value)
+            if match is not None:
+                # The patterns of a combined regex are wrapped in a group each
+                rule = first_rule + (match.lastindex - 1 if offset is None else offset)
+                self.counts[rule] += 1
+                return rule
+        return None
+
+    def log_counts(self, table):
+        """
+        Log the number of rows every exclude rule has matched.
+
+        :param str table: Name of the table
+        """
+        for (column, pattern), count in zip(self.rules, self.counts):
+            logging.info('Exclude rule "{}" on column {} of table {} matched {} rows'.format(
+                pattern, column, table, count))
+
+
+class UniqueValues(object):
+    """
+    Keep the values of the ``fake.unique.*`` fields of a table unique, when the rows are anonymized in parallel.
+
+    Faker only knows the values generated in its own process, so the values generated by all worker processes are
+    checked in the main process. A value that has been generated before is generated again by the main process until it
+    is unique. These retries are counted for every field.
+    """
+
+    def __init__(self, fields=()):
+        self.fields = [field for field in fields
+                       if field.provider_config.get('name', '').startswith(UNIQUE_FAKE_PROVIDER)]
+        # The values are checked against the values of all processes, Faker's own unique values would only run out
+        self.configs = [dict(field.provider_config, name='fake.' + field.provider_config['name'][len(
+            UNIQUE_FAKE_PROVIDER):]) for field in self.fields]
+        # The values of every field
+        self.values = [set() for _ in self.fields]
+        # The number of checked values and the number of values generated again for every field
+        self.counts = [0] * len(self.fields)
+        self.retries = [0] * len(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def deduplicate(self, chunk, indexes):
+        """
+        Generate the values of a chunk again, that have been generated before.
+
+        :param pganonymize.chunk.Chunk chunk: The anonymized data rows, that are altered in place.
+        :param list indexes: The rows to check.
+        :raises UniquenessError: If no unique value could be generated.
+        """
+        for position, field in enumerate(self.fields):
+            values = self.values[position]
+            column = chunk.column(field.column_name)
+            keys = field.keys[1:] if field.keys is not None else None
+            format_columns = [(name, chunk.column(name)) for name in field.format_fields]
+            for index in indexes:
+                value = column[index] if keys is None else get_path(column[index], keys)
+                if value is None:
+                    continue
+                self.counts[position] += 1
+                retries = 0
+                while value in values:
+                    if retries == MAX_UNIQUE_RETRIES:
+                        raise UniquenessError('Got duplicated values after {} retries for field {}'.format(
+                            MAX_UNIQUE_RETRIES, field.path))
+                    retries += 1
+                    value = field.provider_class.alter_value(value, **self.configs[position])
+                    value = format_field_value(field, value, format_columns, index)
+                if retries:
+                    self.retries[position] += retries
+                    if keys is None:
+                        column[index] = value
+                    else:
+                        set_path(column[index], keys, value)
+                values.add(value)
+
+    def log_counts(self, table):
+        """
+        Log the number of values of every field, that have been generated again.
+
+        :param str table: Name of the table
+        """
+        for field, count, retries in zip(self.fields, self.counts, self.retries):
+            if count:
+                logging.info('Unique field {} of table {}: generated {} of {} values again ({:.2%})'.format(
+                    field.path, table, retries, count, retries / float(count)))
+
+
+def compile_exclude_patterns(patterns):
+    """
+    Compile the exclude patterns of a column (case-insensitive) into as few regexes as possible.
+
+    Patterns without capturing groups and inline flags are combined into a single alternation, whose alternatives are
+    tried in the order of the patterns like separate regexes. Other patterns are compiled on their own.
+
+    :param list patterns: The exclude patterns
+    :return: A list of tuples with a compiled regex and the index of its pattern, the index is None for a combined
+      regex and the matching pattern has to be taken from the group that matched.
+    :rtype: list
+    """
+    regexes = [re.compile(pattern, re.IGNORECASE) for pattern in patterns]
+    if len(patterns) > 1 and not any(regex.groups or INLINE_FLAGS.search(pattern)
+                                     for pattern, regex in zip(patterns, regexes)):
+        try:
+            combined = re.compile('|'.join('({})'.format(pattern) for pattern in patterns), re.IGNORECASE)
+        except re.error:
+            pass
+        else:
+            return [(combined, None)]
+    return [(regex, index) for index, regex in enumerate(regexes)]
+
+
+def create_temporary_table(connection, definitions, source_table, temp_table, primary_key):
+    primary_key = primary_key if primary_key else DEFAULT_PRIMARY_KEY
+    column_names = get_column_names(definitions)
+    sql_columns = get_select_columns(primary_key, column_names)
+    query = SQL('CREATE TEMP TABLE {temp_table} AS SELECT {columns} FROM {source_table} WITH NO DATA')
+    cursor = connection.cursor()
+    cursor.execute(
+        query.format(
+            temp_table=Identifier(temp_table),
+            columns=sql_columns,
+            source_table=Identifier(source_table),
+        ).as_string(connection)
+    )
+    cursor.close()
+
+
+def get_key_columns(primary_key):
+    """
+    Return the names of the columns that identify a row of the selected and staged data.
+
+    :param primary_key: Table primary key, a column name, a list of column names or ``ctid``.
+    :return: A list of column names
+    :rtype: list
+    """
+    if primary_key == CTID:
+        return [CTID_COLUMN]
+    if isinstance(primary_key, (list, tuple)):
+        return list(primary_key)
+    return [primary_key]
+
+
+def get_key_value(row, primary_key):
+    """
+    Return the primary key value of a row.
+
+    :param dict row: A data row
+    :param primary_key: Table primary key, a column name, a list of column names or ``ctid``.
+    :return: The value, a tuple of values for a primary key with multiple columns.
+    """
+    key_columns = get_key_columns(primary_key)
+    if len(key_columns) == 1:
+        return row[key_columns[0]]
+    return tuple(row[column_name] for column_name in key_columns)
+
+
+def get_select_columns(primary_key, column_names):
+    """
+    Return the select list of the primary key and the given columns.
+
+    The location of a row is selected as text, so it can be staged with a binary ``COPY``.
+
+    :param primary_key: Table primary key, a column name, a list of column names or ``ctid``.
+    :param list column_names: A list of column names
+    :return: The select list
+    :rtype: psycopg2.sql.Composable
+    """
+    if primary_key == CTID:
+        key_columns = [SQL('ctid::text AS {column}').format(column=Identifier(CTID_COLUMN))]
+    else:
+        key_columns = [Identifier(column_name) for column_name in get_key_columns(primary_key)]
+    return SQL(', ').join(key_columns + [Identifier(column_name) for column_name in column_names])
+
+
+def get_key_join_condition(primary_key):
+    """
+    Return the condition that joins a table (aliased ``t``) with its staged rows (aliased ``s``).
+
+    :param primary_key: Table primary key, a column name, a list of column names or ``ctid``.
+    :return: The join condition
+    :rtype: psycopg2.sql.Composable
+    """
+    if primary_key == CTID:
+        return SQL('t.ctid = s.{column}::tid').format(column=Identifier(CTID_COLUMN))
+    return SQL(' AND ').join([
+        SQL('t.{column} = s.{column}').format(column=Identifier(column_name))
+        for column_name in get_key_columns(primary_key)
+    ])
+
+
+def remove_temporary_table(connection, temp_table):
+    """
+    Remove the temporary table created during the anonymization process.
+
+    :param connection: A database connection instance.
+    :param str temp_table: Name of the temporary table to be removed.
+    """
+    cursor = connection.cursor()
+    sql = SQL('DROP TABLE IF EXISTS {temp_table}').format(temp_table=Identifier(temp_table))
+    cursor.execute(sql.as_string(connection))
+    cursor.close()
+
+
+def truncate_temporary_table(connection, temp_table):
+    """
+    Remove all rows of the temporary table, so it can be reused for the next batch.
+
+    :param connection: A database connection instance.
+    :param str temp_table: Name of the temporary table.
+    """
+    cursor = connection.cursor()
+    cursor.execute(SQL('TRUNCATE TABLE {temp_table}').format(temp_table=Identifier(temp_table)).as_string(connection))
+    cursor.close()
+
+
+def create_checkpoint_table(connection):
+    """
+    Create the table that keeps the progress of a run, if it doesn't exist yet.
+
+    Every table has a row for every scan, the name of a scan is the search condition of a partition or an empty
+    string. The row keeps the last committed primary key value of the scan or marks the table as completed. The
+    dropped indexes of a table are kept as rows with the name and the definition of the index.
+
+    :param connection: A database connection instance.
+    """
+    cursor = connection.cursor()
+    sql = SQL(
+        'CREATE TABLE IF NOT EXISTS {checkpoint_table} ('
+        'table_name text NOT NULL, '
+        'scan text NOT NULL, '
+        'last_value text, '
+        'index_definition text, '
+        'completed boolean NOT NULL DEFAULT false, '
+        'PRIMARY KEY (table_name, scan))'
+    ).format(checkpoint_table=Identifier(CHECKPOINT_TABLE))
+    cursor.execute(sql.as_string(connection))
+    cursor.close()
+
+
+def remove_checkpoint_table(connection):
+    """
+    Remove the checkpoint table after all tables have been anonymized.
 
     :param connection: A database connection instance.
-    :param str table: Name of the table to retrieve the data.
-    :param str primary_key: Table primary key
-    :param list columns: A list of table fields
-    :param list[dict] excludes: A list of exclude definitions.
-    :param str search: A SQL WHERE (search_condition) to filter and keep only the searched rows.
-    :param int total_count: The amount of rows for the current table
-    :param int chunk_size: Number of data rows to fetch with the cursor
-    :param bool verbose: Display logging information and a progress bar.
-    :param bool dry_run: Script is running in dry-run mode, no commit expected.
-    :param bool parallel: Data anonymization is done in parallel.
     """
-    column_names = get_column_names(columns)
-    sql_columns = SQL(', ').join([Identifier(column_name) for column_name in [primary_key] + column_names])
-    sql_select = SQL('SELECT {columns} FROM {table}').format(table=Identifier(table), columns=sql_columns)
-    if search:
-        sql_select = Composed([sql_select, SQL(" WHERE {search_condition}".format(search_condition=search))])
-    if dry_run:
-        sql_select = Composed([sql_select, SQL(" LIMIT 100")])
-        logging.info(sql_select.as_string(connection))
-    cursor = connection.cursor(cursor_factory=psycopg2.extras.DictCursor, name='fetch_large_result')
-    cursor.execute(sql_select.as_string(connection))
-    temp_table = 'tmp_{table}'.format(table=table)
-    create_temporary_table(connection, columns, table, temp_table, primary_key)
-    batches = int(math.ceil((1.0 * total_count) / (1.0 * chunk_size)))
-    for i in trange(batches, desc="Processing {} batches for {}".format(batches, table), disable=not verbose):
-        records = cursor.fetchmany(size=chunk_size)
-        if records:
-            data = parmap.map(process_row, records, columns, excludes, pm_pbar=verbose, pm_parallel=parallel)
-            import_data(connection, temp_table, [primary_key] + column_names, filter(None, data))
-    apply_anonymized_data(connection, temp_table, table, primary_key, columns)
-    remove_temporary_table(connection, temp_table)
-
+    cursor = connection.cursor()
+    sql = SQL('DROP TABLE IF EXISTS {checkpoint_table}').format(checkpoint_table=Identifier(CHECKPOINT_TABLE))
+    cursor.execute(sql.as_string(connection))
     cursor.close()
 
 
-def apply_anonymized_data(connection, temp_table, source_table, primary_key, definitions):
-    logging.info('Applying changes on table {}'.format(source_table))
+def get_completed_tables(connection):
+    """
+    Return the names of all tables that have been completed according to the checkpoint table.
+
+    :param connection: A database connection instance.
+    :return: A set of table names
+    :rtype: set
+    """
     cursor = connection.cursor()
-    create_index_sql = SQL('CREATE INDEX ON {temp_table} ({primary_key})')
-    sql = create_index_sql.format(temp_table=Identifier(temp_table), primary_key=Identifier(primary_key))
+    sql = SQL('SELECT table_name FROM {checkpoint_table} WHERE completed').format(
+        checkpoint_table=Identifier(CHECKPOINT_TABLE))
     cursor.execute(sql.as_string(connection))
+    tables = {row[0] for row in cursor.fetchall()}
+    cursor.close()
+    return tables
 
-    column_names = get_column_names(definitions)
-    columns_identifiers = [SQL('{column} = s.{column}').format(column=Identifier(column)) for column in column_names]
-    set_columns = SQL(', ').join(columns_identifiers)
-    sql_args = {
-        'table': Identifier(source_table),
-        'columns': set_columns,
-        'source': Identifier(temp_table),
-        'primary_key': Identifier(primary_key)
-    }
+
+def get_checkpoints(connection, table):
+    """
+    Return the last committed primary key values of the scans of a table that hasn't been completed.
+
+    :param connection: A database connection instance.
+    :param str table: Name of the database table
+    :return: A dictionary with the last primary key value (as text, None if the scan hasn't committed a batch yet)
+      by the name of the scan.
+    :rtype: dict
+    """
+    cursor = connection.cursor()
     sql = SQL(
-        'UPDATE {table} t '
-        'SET {columns} '
-        'FROM {source} s '
-        'WHERE t.{primary_key} = s.{primary_key}'
-    ).format(**sql_args)
-    cursor.execute(sql.as_string(connection))
+        'SELECT scan, last_value FROM {checkpoint_table} '
+        'WHERE table_name = %s AND index_definition IS NULL AND NOT completed'
+    ).format(checkpoint_table=Identifier(CHECKPOINT_TABLE))
+    cursor.execute(sql.as_string(connection), (table,))
+    checkpoints = {scan: last_value for scan, last_value in cursor.fetchall()}
     cursor.close()
+    return checkpoints
 
 
-def row_matches_excludes(row, excludes=None):
+def save_checkpoint(connection, table, scan, last_value=None):
     """
-    Check whether a row matches a list of field exclusion patterns.
+    Save the last primary key value of a scan, it's committed together with the anonymized rows.
 
-    :param list row: The data row
-    :param list excludes: A list of field exclusion roles, e.g.:
+    :param connection: A database connection instance.
+    :param str table: Name of the database table
+    :param str scan: Name of the scan, the search condition of a partition or an empty string.
+    :param last_value: The last primary key value that has been applied, a tuple is saved as a JSON array of the text
+      representations of its values.
+    """
+    if isinstance(last_value, tuple):
+        last_value = json.dumps([u'{}'.format(value) for value in last_value])
+    cursor = connection.cursor()
+    sql = SQL(
+        'INSERT INTO {checkpoint_table} (table_name, scan, last_value) VALUES (%s, %s, %s::text) '
+        'ON CONFLICT (table_name, scan) DO UPDATE SET last_value = EXCLUDED.last_value'
+    ).format(checkpoint_table=Identifier(CHECKPOINT_TABLE))
+    cursor.execute(sql.as_string(connection), (table, scan, last_value))
+    cursor.close()
 
-    >>> [
-    >>>     {'email': ['\\S.*@example.com', '\\S.*@foobar.com', ]}
-    >>> ]
 
-    :return: True or False
-    :rtype: bool
+def save_index_checkpoints(connection, table, indexes):
     """
-    excludes = excludes if excludes else []
-    for definition in excludes:
-        column = list(definition.keys())[0]
-        for exclude in definition.get(column, []):
-            pattern = re.compile(exclude, re.IGNORECASE)
-            if row[column] is not None and pattern.match(row[column]):
-                return True
-    return False
+    Save the definitions of indexes that are dropped, so they can be rebuilt by a resumed run.
 
+    :param connection: A database connection instance.
+    :param str table: Name of the database table
+    :param list indexes: A list of tuples with the name and the definition of the indexes.
+    """
+    cursor = connection.cursor()
+    sql = SQL('INSERT INTO {checkpoint_table} (table_name, scan, index_definition) VALUES (%s, %s, %s)').format(
+        checkpoint_table=Identifier(CHECKPOINT_TABLE))
+    for name, definition in indexes:
+        cursor.execute(sql.as_string(connection), (table, name, definition))
+    cursor.close()
 
-def create_temporary_table(connection, definitions, source_table, temp_table, primary_key):
-    primary_key = primary_key if primary_key else DEFAULT_PRIMARY_KEY
-    column_names = get_column_names(definitions)
-    sql_columns = SQL(', ').join([Identifier(column_name) for column_name in [primary_key] + column_names])
-    query = SQL('CREATE TEMP TABLE {temp_table} AS SELECT {columns} FROM {source_table} WITH NO DATA')
+
+def get_index_checkpoints(connection, table):
+    """
+    Return the indexes of a table that have been dropped and not been rebuilt yet.
+
+    :param connection: A database connection instance.
+    :param str table: Name of the database table
+    :return: A list of tuples with the name and the definition of the indexes.
+    :rtype: list
+    """
     cursor = connection.cursor()
-    cursor.execute(
-        query.format(
-            temp_table=Identifier(temp_table),
-            columns=sql_columns,
-            source_table=Identifier(source_table),
-        ).as_string(connection)
-    )
+    sql = SQL(
+        'SELECT scan, index_definition FROM {checkpoint_table} '
+        'WHERE table_name = %s AND index_definition IS NOT NULL ORDER BY scan'
+    ).format(checkpoint_table=Identifier(CHECKPOINT_TABLE))
+    cursor.execute(sql.as_string(connection), (table,))
+    indexes = [tuple(row) for row in cursor.fetchall()]
     cursor.close()
+    return indexes
 
 
-def remove_temporary_table(connection, temp_table):
+def complete_checkpoint(connection, table):
     """
-    Remove the temporary table created during the anonymization process.
+    Mark a table as completed and remove the checkpoints of its scans.
 
     :param connection: A database connection instance.
-    :param str temp_table: Name of the temporary table to be removed.
+    :param str table: Name of the database table
     """
     cursor = connection.cursor()
-    sql = SQL('DROP TABLE IF EXISTS {temp_table}').format(temp_table=Identifier(temp_table))
-    cursor.execute(sql.as_string(connection))
+    checkpoint_table = Identifier(CHECKPOINT_TABLE)
+    cursor.execute(
+        SQL('DELETE FROM {checkpoint_table} WHERE table_name = %s').format(
+            checkpoint_table=checkpoint_table).as_string(connection),
+        (table,)
+    )
+    cursor.execute(
+        SQL('INSERT INTO {checkpoint_table} (table_name, scan, completed) VALUES (%s, %s, true)').format(
+            checkpoint_table=checkpoint_table).as_string(connection),
+        (table, '')
+    )
     cursor.close()
 
 
-def import_data(connection, table_name, column_names, data):
+def import_data(connection, table_name, column_names, data, json_columns=None):
     """
     Import the temporary and anonymized data to a temporary table and write the changes back.
 
     :param connection: A database connection instance.
     :param str table_name: Name of the table to be populated with data.
     :param list column_names: A list of table fields
-    :param list data: The table data.
+    :param data: The table data, a :class:`pganonymize.chunk.Chunk` or a list of rows by the column names.
+    :param list json_columns: The JSON columns, whose values are serialized whatever their type is, see
+      :func:`get_json_columns`. Otherwise only dictionaries are serialized.
     """
     mgr = CopyManager(connection, table_name, column_names)
-    mgr.copy([[escape_str_replace(val) for col, val in row.items()] for row in data])
+    if not json_columns:
+        if isinstance(data, Chunk):
+            mgr.copy(data.rows(column_names, convert=escape_str_replace))
+        else:
+            mgr.copy([[escape_str_replace(val) for col, val in row.items()] for row in data])
+        return
+    converters = [escape_json_value if column_name in json_columns else escape_str_replace
+                  for column_name in column_names]
+    if isinstance(data, Chunk):
+        rows = data.rows(column_names)
+    else:
+        rows = [row.values() for row in data]
+    mgr.copy([[convert(val) for convert, val in zip(converters, row)] for row in rows])
 
 
 def get_connection(pg_args):
@@ -230,13 +2271,183 @@ def get_connection(pg_args):
     return psycopg2.connect(**pg_args)
 
 
-def get_table_count(connection, table, dry_run):
+def execute_init_sql(connection, init_sql):
+    """
+    Execute the initialisation SQL on a connection.
+
+    :param connection: A database connection instance
+    :param str init_sql: The SQL statements to execute
+    """
+    cursor = connection.cursor()
+    logging.info('Executing initialisation sql {}'.format(init_sql))
+    cursor.execute(init_sql)
+    cursor.close()
+
+
+def apply_settings(connection, settings):
+    """
+    Change configuration parameters for the session of a connection.
+
+    :param connection: A database connection instance
+    :param dict settings: The new values by the names of the parameters, e.g. ``{'work_mem': '1GB'}``.
+    :return: The previous values by the names of the parameters, to restore them later on.
+    :rtype: dict
+    """
+    cursor = connection.cursor()
+    previous_settings = {}
+    for name, value in settings.items():
+        if isinstance(value, bool):
+            # YAML parses unquoted on and off as booleans
+            value = 'on' if value else 'off'
+        cursor.execute('SELECT pg_catalog.current_setting(%s), pg_catalog.set_config(%s, %s, false)',
+                       (name, name, str(value)))
+        previous_settings[name], value = cursor.fetchone()
+        logging.info('Setting {} to {}'.format(name, value))
+    cursor.close()
+    return previous_settings
+
+
+def set_table_logged(connection, table, logged):
+    """
+    Switch a table between logged and unlogged.
+
+    Changes of an unlogged table aren't written to the write-ahead log, but the table is truncated after a crash of
+    the database server. Both switches rewrite the whole table, switching it back to logged writes it to the log once.
+
+    :param connection: A database connection instance
+    :param str table: Name of the database table
+    :param bool logged: Switch the table to logged, otherwise to unlogged.
+    """
+    cursor = connection.cursor()
+    logging.info('Switching table {} to {}'.format(table, 'logged' if logged else 'unlogged'))
+    sql = SQL('ALTER TABLE {table} SET {persistence}').format(
+        table=Identifier(table), persistence=SQL('LOGGED' if logged else 'UNLOGGED'))
+    cursor.execute(sql.as_string(connection))
+    cursor.close()
+
+
+class ConnectionPool(psycopg2.pool.ThreadedConnectionPool):
+    """
+    A thread-safe connection pool that runs the initialisation SQL on every new connection and applies the session
+    settings.
+    """
+
+    def __init__(self, minconn, maxconn, init_sql=None, settings=None, **pg_args):
+        self.init_sql = init_sql
+        self.settings = settings
+        super(ConnectionPool, self).__init__(minconn, maxconn, **pg_args)
+
+    def _connect(self, key=None):
+        connection = super(ConnectionPool, self)._connect(key)
+        if self.init_sql:
+            execute_init_sql(connection, self.init_sql)
+        if self.settings:
+            apply_settings(connection, self.settings)
+            connection.commit()
+        return connection
+
+
+def get_connection_pool(pg_args, size, init_sql=None, settings=None):
+    """
+    Return a pool of connections to the database.
+
+    :param dict pg_args: A dictionary with database related information
+    :param int size: The maximum number of connections within the pool
+    :param str init_sql: SQL to run on every new connection
+    :param dict settings: Configuration parameters to change on every new connection, see :func:`apply_settings`.
+    :return: A connection pool instance
+    :rtype: pganonymize.utils.ConnectionPool
+    """
+    return ConnectionPool(1, size, init_sql=init_sql, settings=settings, **pg_args)
+
+
+def get_table_size(connection, table):
+    """
+    Return the estimated size of a table (including its indexes and TOAST data) in bytes.
+
+    :param connection: A database connection instance
+    :param str table: Name of the database table
+    :return: The size of the table in bytes
+    :rtype: int
+    """
+    cursor = connection.cursor()
+    cursor.execute('SELECT pg_catalog.pg_total_relation_size(%s::regclass)', (Identifier(table).as_string(connection),))
+    size = cursor.fetchone()[0]
+    cursor.close()
+    return size
+
+
+def sort_definitions_by_size(connection, definitions):
+    """
+    Sort table definitions by the size of their tables, largest first.
+
+    :param connection: A database connection instance
+    :param list definitions: A list of table definitions from the YAML schema.
+    :return: The sorted list of table definitions
+    :rtype: list
+    """
+    sizes = [get_table_size(connection, list(definition.keys())[0]) or 0 for definition in definitions]
+    return [definition for _, definition in sorted(zip(sizes, definitions), key=lambda item: item[0], reverse=True)]
+
+
+def get_row_count(connection, table, search=None, dry_run=False, exact=False):
+    """
+    Return the exact or the estimated number of table entries.
+
+    :param connection: A database connection instance
+    :param str table: Name of the database table
+    :param str search: A SQL WHERE (search_condition) to filter the rows to be counted.
+    :param bool dry_run: Script is running in dry-run mode, no commit expected.
+    :param bool exact: Count the rows exactly instead of using the planner's estimate.
+    :return: The number of table entries, None if it is unknown
+    :rtype: int
+    """
+    if exact:
+        return get_table_count(connection, table, dry_run, search)
+    return get_table_estimate(connection, table, dry_run, search)
+
+
+def get_table_estimate(connection, table, dry_run, search=None):
+    """
+    Return the estimated number of table entries without scanning the table.
+
+    The estimate is taken from the table statistics or from the query planner, if a search condition is given.
+
+    :param connection: A database connection instance
+    :param str table: Name of the database table
+    :param bool dry_run: Script is running in dry-run mode, no commit expected.
+    :param str search: A SQL WHERE (search_condition) to filter the rows to be estimated.
+    :return: The estimated number of table entries, None if the table hasn't been analyzed yet
+    :rtype: int
+    """
+    if dry_run:
+        return 100
+    cursor = connection.cursor()
+    if search:
+        sql = SQL('EXPLAIN (FORMAT JSON) SELECT 1 FROM {table} WHERE {search_condition}').format(
+            table=Identifier(table), search_condition=SQL(search))
+        cursor.execute(sql.as_string(connection))
+        plan = cursor.fetchone()[0]
+        if not isinstance(plan, list):
+            plan = json.loads(plan)
+        estimate = plan[0]['Plan']['Plan Rows']
+    else:
+        cursor.execute('SELECT reltuples FROM pg_catalog.pg_class WHERE oid = %s::regclass',
+                       (Identifier(table).as_string(connection),))
+        estimate = cursor.fetchone()[0]
+    cursor.close()
+    # Tables that have never been analyzed have a negative estimate since PostgreSQL 14
+    return int(estimate) if estimate >= 0 else None
+
+
+def get_table_count(connection, table, dry_run, search=None):
     """
     Return the number of table entries.
 
     :param connection: A database connection instance
     :param str table: Name of the database table
     :param bool dry_run: Script is running in dry-run mode, no commit expected.
+    :param str search: A SQL WHERE (search_condition) to filter the rows to be counted.
     :return: The number of table entries
     :rtype: int
     """
@@ -244,6 +2455,8 @@ def get_table_count(connection, table, dry_run):
         return 100
     else:
         sql = SQL('SELECT COUNT(*) FROM {table}').format(table=Identifier(table))
+        if search:
+            sql = Composed([sql, SQL(" WHERE {search_condition}".format(search_condition=search))])
         cursor = connection.cursor()
         cursor.execute(sql.as_string(connection))
         total_count = cursor.fetchone()[0]
@@ -266,28 +2479,100 @@ def get_column_values(row, columns):
         {'guest_email': '12faf5a9bb6f6f067608dca3027c8fcb@localhost'}
     :rtype: dict
     """
+    return apply_field_plans(row, [compile_field_plan(definition) for definition in columns])
+
+
+def apply_field_plans(row, fields):
+    """
+    Alter a single data row according to compiled field definitions.
+
+    :param row: A data row from the current table to be altered
+    :param list fields: A list of compiled field definitions, see :func:`compile_field_plan`.
+    :return: A dictionary with all fields that have been altered and their value, see :func:`get_column_values`.
+    :rtype: dict
+    """
     column_dict = {}
-    for definition in columns:
-        full_column_name = get_column_name(definition, True)
-        column_name = get_column_name(definition, False)
-        column_definition = definition[full_column_name]
-        provider_config = column_definition.get('provider')
-        orig_value = nested_get(row, full_column_name)
+    for field in fields:
+        if field.keys is None:
+            try:
+                orig_value = row[field.path]
+            except KeyError:
+                orig_value = None
+        else:
+            orig_value = get_path(row, field.keys)
         # Skip the current column if there is no value to be altered
         if orig_value is not None:
-            provider_class = provider_registry.get_provider(provider_config['name'])
-            value = provider_class.alter_value(orig_value, **provider_config)
-            append = column_definition.get('append')
-            if append:
-                value = value + append
-            _format = column_definition.get('format')
-            if _format:
-                value = _format.format(pga_value=value, **row)
-            nested_set(row, full_column_name, value)
-            column_dict[column_name] = nested_get(row, column_name)
+            value = field.provider_class.alter_value(orig_value, **field.provider_config)
+            if field.append:
+                value = value + field.append
+            if field.format:
+                value = field.format.format(pga_value=value, **{name: row[name] for name in field.format_fields})
+            if field.keys is None:
+                row[field.path] = value
+            else:
+                set_path(row, field.keys, value)
+            column_dict[field.column_name] = row[field.column_name]
     return column_dict
 
 
+def apply_field_plans_to_chunk(chunk, fields, indexes=None):
+    """
+    Alter a chunk of data rows according to compiled field definitions, one field at a time.
+
+    Every provider is called once per field with all values of the chunk, see
+    :meth:`pganonymize.providers.Provider.alter_values`. The rows end up the same as with :func:`apply_field_plans`.
+
+    :param pganonymize.chunk.Chunk chunk: The data rows, that are altered in place.
+    :param list fields: A list of compiled field definitions, see :func:`compile_field_plan`.
+    :param list indexes: Only alter these rows, e.g. the rows that aren't excluded. All rows if omitted.
+    :return: The chunk, its ``altered`` mask marks the rows with at least one altered value.
+    :rtype: pganonymize.chunk.Chunk
+    """
+    if indexes is None:
+        indexes = range(len(chunk))
+    altered = chunk.altered
+    for field in fields:
+        column = chunk.column(field.column_name)
+        keys = field.keys[1:] if field.keys is not None else None
+        value_indexes = []
+        orig_values = []
+        for index in indexes:
+            orig_value = column[index] if keys is None else get_path(column[index], keys)
+            # Skip the rows without a value to be altered
+            if orig_value is not None:
+                value_indexes.append(index)
+                orig_values.append(orig_value)
+        if not value_indexes:
+            continue
+        values = field.provider_class.alter_values(orig_values, **field.provider_config)
+        format_columns = [(name, chunk.column(name)) for name in field.format_fields]
+        for index, value in zip(value_indexes, values):
+            value = format_field_value(field, value, format_columns, index)
+            if keys is None:
+                column[index] = value
+            else:
+                set_path(column[index], keys, value)
+            altered[index] = True
+    return chunk
+
+
+def format_field_value(field, value, format_columns, index):
+    """
+    Append the suffix of a field definition to a value generated by its provider and apply its format string.
+
+    :param FieldPlan field: The compiled field definition.
+    :param value: The value generated by the provider.
+    :param list format_columns: The names and the values of the columns the format string refers to.
+    :param int index: The row of the value.
+    :return: The value to store.
+    """
+    if field.append:
+        value = value + field.append
+    if field.format:
+        value = field.format.format(pga_value=value, **{name: values[index] for name, values in format_columns})
+    return value
+
+
 def truncate_tables(connection):
     """
     Truncate a list of tables.
@@ -304,25 +2589,128 @@ def truncate_tables(connection):
     cursor.close()
 
 
-def create_database_dump(filename, db_args, dump_args):
+def create_database_dump(filename, db_args, dump_args, jobs=1, compress=None):
     """
     Create a dump file from the current database.
 
+    The ``--verbose`` output of ``pg_dump`` is logged and used to measure the time it took to dump the data of every
+    table.
+
     :param str filename: Path to the dumpfile that should be created
     :param dict db_args: A dictionary with database related information
+    :param str dump_args: Options to pass to the pg_dump command
+    :param int jobs: Number of tables to dump concurrently. More than one job creates a dump in the directory format.
+    :param str compress: The compression method and/or level to pass to pg_dump, e.g. ``9`` or ``zstd:3``.
+    :return: The exit status of pg_dump
+    :rtype: int
     """
     env_vars = ''
     if db_args.get('password'):
         env_vars += 'PGPASSWORD={password}'.format(password=db_args['password'])
+    if jobs > 1:
+        dump_args += ' --format directory --jobs {jobs}'.format(jobs=jobs)
+    if compress is not None:
+        dump_args += ' --compress {compress}'.format(compress=compress)
     arguments = '--dbname {dbname} --username {user} --host {host} --port {port}'.format(**db_args)
-    cmd = '{env_vars}pg_dump {dump_args} {db_args} --file {filename}'.format(
+    cmd = '{env_vars}pg_dump {dump_args} --verbose {db_args} --file {filename}'.format(
         env_vars='{} '.format(env_vars) if env_vars else '',
         dump_args=dump_args,
         db_args=arguments,
         filename=filename,
     )
     logging.info('Creating database dump file "%s"', filename)
-    subprocess.call(cmd, shell=True)
+    start_time = time.time()
+    process = subprocess.Popen(cmd, shell=True, stderr=subprocess.PIPE, universal_newlines=True)
+    timings = read_dump_log(process.stderr, parallel=jobs > 1)
+    exit_status = process.wait()
+    end_time = time.time()
+    for table, duration in sorted(timings.items(), key=lambda item: item[1], reverse=True):
+        logging.info('Dumping table {} took {:.2f}s'.format(table, duration))
+    if exit_status:
+        logging.error('Creating database dump file "%s" failed with exit status %d', filename, exit_status)
+    else:
+        logging.info('Created database dump file "{}" with {} in {:.2f}s'.format(
+            filename, format_size(get_dump_size(filename)), end_time - start_time))
+    return exit_status
+
+
+def read_dump_log(lines, parallel=False):
+    """
+    Log the ``--verbose`` output of pg_dump and measure the time it took to dump the data of every table.
+
+    A single pg_dump process dumps one table after another, so the data of a table has been dumped as soon as the next
+    line is printed. Parallel workers report every finished table.
+
+    :param lines: An iterable of the output lines
+    :param bool parallel: The output is printed by pg_dump with more than one job.
+    :return: A dictionary with the qualified table names and their durations in seconds
+    :rtype: dict
+    """
+    started = {}
+    timings = {}
+    current_table = None
+    for line in lines:
+        now = time.time()
+        line = line.rstrip('\n')
+        if 'error: ' in line:
+            logging.error(line)
+        elif 'warning: ' in line or not line.startswith('pg_dump: '):
+            # Messages of the shell, e.g. if pg_dump can't be found
+            logging.warning(line)
+        else:
+            logging.debug(line)
+        if current_table is not None:
+            timings[current_table] = now - started.pop(current_table)
+            current_table = None
+        match = DUMP_TABLE_START.search(line)
+        if match:
+            started[match.group('table')] = now
+            current_table = None if parallel else match.group('table')
+            continue
+        match = DUMP_TABLE_END.search(line)
+        if match:
+            for table in list(started):
+                if table == match.group('table') or table.endswith('.' + match.group('table')):
+                    timings[table] = now - started.pop(table)
+                    break
+    if current_table is not None:
+        timings[current_table] = time.time() - started.pop(current_table)
+    return timings
+
+
+def get_dump_size(filename):
+    """
+    Return the size of a dump file or of all files of a dump directory.
+
+    :param str filename: Path to the dump file or directory
+    :return: The size in bytes, None if the dump doesn't exist
+    :rtype: int
+    """
+    if os.path.isdir(filename):
+        return sum(os.path.getsize(os.path.join(path, name))
+                   for path, _, names in os.walk(filename) for name in names)
+    if os.path.isfile(filename):
+        return os.path.getsize(filename)
+    return None
+
+
+def format_size(size):
+    """
+    Format a size in bytes for humans, e.g. ``1.5 MB``.
+
+    :param int size: The size in bytes
+    :return: The formatted size
+    :rtype: str
+    """
+    if size is None:
+        return 'an unknown size'
+    for unit in ('bytes', 'kB', 'MB', 'GB'):
+        if size < 1024:
+            break
+        size /= 1024.0
+    else:
+        unit = 'TB'
+    return '{:.0f} {}'.format(size, unit) if unit == 'bytes' else '{:.1f} {}'.format(size, unit)
 
 
 def get_column_name(definition, fully_qualified=False):
@@ -369,9 +2757,24 @@ def escape_str_replace(value):
     """
     if isinstance(value, dict):
         return json.dumps(value, default=str).encode()
+    if isinstance(value, memoryview):
+        # psycopg2 returns the values of bytea columns as memory views
+        return value.tobytes()
     return value
 
 
+def escape_json_value(value):
+    """
+    Get the serialized value of a JSON column.
+
+    :param value: The parsed value, e.g. a dictionary, a list or a string.
+    :return: The JSON text, None for NULL values
+    """
+    if value is None:
+        return None
+    return json.dumps(value, default=str).encode()
+
+
 def nested_get(dic, path, delimiter='.'):
     """
     Get from dictionary by path.
@@ -381,8 +2784,30 @@ def nested_get(dic, path, delimiter='.'):
     :param str delimiter: The path delimiter
     :return: Value at path
     """
+    return get_path(dic, path.split(delimiter))
+
+
+def nested_set(dic, path, value, delimiter='.'):
+    """
+    Set dictionary value by path.
+
+    :param dict dic: The source dictionary
+    :param str path: The path within dictionary
+    :param value: The value to be set
+    :param str delimiter: The path delimiter
+    """
+    set_path(dic, path.split(delimiter), value)
+
+
+def get_path(dic, keys):
+    """
+    Get from dictionary by a list of keys.
+
+    :param dict dic: The source dictionary.
+    :param keys: The keys of the nested dictionaries and of the value
+    :return: Value at path or None, if the path doesn't exist
+    """
     try:
-        keys = path.split(delimiter)
         for key in keys[:-1]:
             dic = dic.get(key, {})
         return dic[keys[-1]]
@@ -390,16 +2815,14 @@ def nested_get(dic, path, delimiter='.'):
         return None
 
 
-def nested_set(dic, path, value, delimiter='.'):
+def set_path(dic, keys, value):
     """
-    Set dictionary value by path.
+    Set dictionary value by a list of keys.
 
     :param dict dic: The source dictionary
-    :param str path: The path within dictionary
+    :param keys: The keys of the nested dictionaries and of the value
     :param value: The value to be set
-    :param str delimiter: The path delimiter
     """
-    keys = path.split(delimiter)
     for key in keys[:-1]:
         dic = dic.get(key, {})
     dic[keys[-1]] = value
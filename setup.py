@@ -43,8 +43,6 @@ exec(read('pganonymize', 'version.py'))
 install_requires = [
     'faker',
     'faker>=3.0,<4.0; python_version=="2.7"',
-    'parmap; python_version>="3.6"',
-    'parmap==1.5.2; python_version<"3.6"',
     'pgcopy',
     'pgcopy>=1.5,<1.6; python_version<"3.6"',
     'psycopg2',
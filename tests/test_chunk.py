@@ -0,0 +1,87 @@
+import pickle
+
+import pytest
+
+from pganonymize.chunk import Chunk, SharedChunk, shared_memory
+
+
+class TestChunk(object):
+
+    @pytest.mark.parametrize('rows', [
+        [(1, 'jane@example.com'), (2, None)],
+        [{'id': 1, 'email': 'jane@example.com'}, {'email': None, 'id': 2}],
+    ])
+    def test_from_rows(self, rows):
+        chunk = Chunk.from_rows(['id', 'email'], rows)
+        assert len(chunk) == 2
+        assert chunk.column('id') == [1, 2]
+        assert chunk.column('email') == ['jane@example.com', None]
+        assert chunk.altered == [False, False]
+        assert chunk.row(-1) == {'id': 2, 'email': None}
+
+    def test_empty(self):
+        chunk = Chunk.from_rows(['id'], [])
+        assert len(chunk) == 0
+        assert chunk.rows() == []
+
+    def test_rows(self):
+        chunk = Chunk(['id', 'email'], [[1, 2], ['a', None]])
+        assert chunk.rows() == [(1, 'a'), (2, None)]
+        assert chunk.rows(['email', 'id'], convert=lambda value: value or 'x') == [('a', 1), ('x', 2)]
+
+    def test_take_and_put(self):
+        chunk = Chunk(['id', 'email'], [[1, 2, 3], ['a', 'b', 'c']])
+        part = chunk.take([0, 2], ['email'])
+        assert part.column_names == ['email']
+        assert part.column('email') == ['a', 'c']
+        part.column('email')[1] = 'z'
+        part.altered[1] = True
+        chunk.put([0, 2], part)
+        assert chunk.column('email') == ['a', 'b', 'z']
+        assert chunk.altered_indexes() == [2]
+        assert chunk.take(chunk.altered_indexes()).rows() == [(3, 'z')]
+
+    def test_pickle(self):
+        chunk = Chunk(['id'], [[1, 2]], [True, False])
+        copy = pickle.loads(pickle.dumps(chunk, protocol=2))
+        assert copy.column_names == ['id']
+        assert copy.column('id') == [1, 2]
+        assert copy.altered == [True, False]
+
+
+@pytest.mark.skipif(shared_memory is None, reason='Shared memory requires Python 3.8')
+class TestSharedChunk(object):
+
+    def test_round_trip(self):
+        chunk = Chunk(['id', 'email', 'name', 'nothing'], [
+            [1, 2, 3],
+            [u'jane@example.com', None, u'j\u00f6rg@example.com'],
+            [u'', u'a\0b', u'c'],
+            [None, None, None],
+        ], [False, True, False])
+        shared_chunk = SharedChunk.create(chunk)
+        try:
+            assert sorted(shared_chunk.layout) == ['email']
+            assert pickle.loads(pickle.dumps(shared_chunk)).to_chunk().rows() == chunk.rows()
+            copy = shared_chunk.to_chunk()
+        finally:
+            shared_chunk.unlink()
+        assert copy.column_names == chunk.column_names
+        assert copy.column('email') == [u'jane@example.com', None, u'j\u00f6rg@example.com']
+        assert copy.altered == [False, True, False]
+        with pytest.raises(FileNotFoundError):
+            shared_chunk.to_chunk()
+
+    def test_reuse_memory(self):
+        memory = SharedChunk.create(Chunk(['email'], [[u'a' * 100]])).memory
+        try:
+            shared_chunk = SharedChunk.create(Chunk(['email'], [[u'b', u'c\0']]), memory, check=False)
+            assert shared_chunk.memory is None
+            assert shared_chunk.name == memory.name
+            assert shared_chunk.to_chunk().column('email') == [u'b', u'c', u'']
+            larger_chunk = SharedChunk.create(Chunk(['email'], [[u'd' * 200]]), memory)
+            assert larger_chunk.memory is not None
+            larger_chunk.unlink()
+        finally:
+            memory.close()
+            memory.unlink()
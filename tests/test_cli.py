@@ -4,28 +4,53 @@ from argparse import Namespace
 import pytest
 from mock import Mock, call, patch
 
-from tests.utils import quote_ident
+from tests.utils import literal_as_string, quote_ident
 
 from pganonymize.cli import get_arg_parser, main
+from pganonymize.exceptions import InvalidConfiguration
+
+SELECT_COLUMNS_WITHOUT_EQUALITY = call(
+    'SELECT a.attname FROM pg_catalog.pg_attribute a '
+    'WHERE a.attrelid = %s::regclass AND a.attname = ANY(%s) AND NOT EXISTS ('
+    "SELECT 1 FROM pg_catalog.pg_operator o WHERE o.oprname = '=' "
+    'AND o.oprleft = a.atttypid AND o.oprright = a.atttypid)',
+    ('"auth_user"', ['first_name', 'last_name', 'email'])
+)
+# The excluded rows and the rows without any value to anonymize are filtered by PostgreSQL
+FETCH_CONDITION = (
+    'NOT (coalesce("email" ~* \'^(?:\\S[^@]*@example\\.com)\', false)) '
+    'AND ("first_name" IS NOT NULL OR "last_name" IS NOT NULL OR "email" IS NOT NULL)'
+)
+UPDATE_AUTH_USER = call(
+    'UPDATE "auth_user" t SET '
+    '"first_name" = CASE WHEN t."first_name" IS DISTINCT FROM s."first_name" THEN s."first_name" '
+    'ELSE t."first_name" END, '
+    '"last_name" = CASE WHEN t."last_name" IS DISTINCT FROM s."last_name" THEN s."last_name" ELSE t."last_name" END, '
+    '"email" = CASE WHEN t."email" IS DISTINCT FROM s."email" THEN s."email" ELSE t."email" END '
+    'FROM "tmp_auth_user" s WHERE t."id" = s."id" AND (t."first_name" IS DISTINCT FROM s."first_name" OR '
+    't."last_name" IS DISTINCT FROM s."last_name" OR t."email" IS DISTINCT FROM s."email")'
+)
 
 
 class TestCli(object):
 
+    @patch('psycopg2.sql.Literal.as_string', autospec=True, side_effect=literal_as_string)
     @patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
     @patch('pganonymize.utils.psycopg2.connect')
     @patch('pganonymize.utils.subprocess')
     @pytest.mark.parametrize('cli_args, expected, expected_executes, commit_calls, call_dump', [
         ['--host localhost --port 5432 --user root --password my-cool-password --dbname db --schema ./tests/schemes/valid_schema.yml -v --init-sql "set work_mem=\'1GB\'"',  # noqa
          Namespace(verbose=1, list_providers=False, schema='./tests/schemes/valid_schema.yml', dbname='db', user='root',
-                   password='my-cool-password', host='localhost', port='5432', dry_run=False, dump_file=None, dump_options='--format custom --compress 9', init_sql="set work_mem='1GB'", parallel=False),  # noqa
+                   password='my-cool-password', host='localhost', port='5432', dry_run=False, dump_file=None, dump_options='--format custom --compress 9', dump_jobs=1, dump_compress=None, input_dump=None, target=None, init_sql="set work_mem='1GB'", parallel=False, jobs=1, pushdown=False, exact_count=False, binary_copy=False, pipeline_depth=0, batch_commit=False, resume=False),  # noqa
          [call("set work_mem='1GB'"),
           call('TRUNCATE TABLE "django_session"'),
-          call('SELECT COUNT(*) FROM "auth_user"'),
-          call('SELECT "id", "first_name", "last_name", "email" FROM "auth_user"'),
+          call('EXPLAIN (FORMAT JSON) SELECT 1 FROM "auth_user" WHERE ' + FETCH_CONDITION),
+          call('SELECT "id", "first_name", "last_name", "email" FROM "auth_user" WHERE ' + FETCH_CONDITION),
           call(
              'CREATE TEMP TABLE "tmp_auth_user" AS SELECT "id", "first_name", "last_name", "email" FROM "auth_user" WITH NO DATA'),  # noqa
           call('CREATE INDEX ON "tmp_auth_user" ("id")'),
-          call('UPDATE "auth_user" t SET "first_name" = s."first_name", "last_name" = s."last_name", "email" = s."email" FROM "tmp_auth_user" s WHERE t."id" = s."id"'),  # noqa
+          SELECT_COLUMNS_WITHOUT_EQUALITY,
+          UPDATE_AUTH_USER,
           call('DROP TABLE IF EXISTS "tmp_auth_user"')
           ],
          1,
@@ -33,55 +58,73 @@ class TestCli(object):
          ],
         ['--dry-run --host localhost --port 5432 --user root --password my-cool-password --dbname db --schema ./tests/schemes/valid_schema.yml -v --init-sql "set work_mem=\'1GB\'"',  # noqa
          Namespace(verbose=1, list_providers=False, schema='./tests/schemes/valid_schema.yml', dbname='db', user='root',
-                   password='my-cool-password', host='localhost', port='5432', dry_run=True, dump_file=None, dump_options='--format custom --compress 9', init_sql="set work_mem='1GB'", parallel=False),  # noqa
+                   password='my-cool-password', host='localhost', port='5432', dry_run=True, dump_file=None, dump_options='--format custom --compress 9', dump_jobs=1, dump_compress=None, input_dump=None, target=None, init_sql="set work_mem='1GB'", parallel=False, jobs=1, pushdown=False, exact_count=False, binary_copy=False, pipeline_depth=0, batch_commit=False, resume=False),  # noqa
          [call("set work_mem='1GB'"),
           call('TRUNCATE TABLE "django_session"'),
-             call('SELECT "id", "first_name", "last_name", "email" FROM "auth_user" LIMIT 100'),
+             call('SELECT "id", "first_name", "last_name", "email" FROM "auth_user" WHERE ' + FETCH_CONDITION +
+                  ' LIMIT 100'),
              call('CREATE TEMP TABLE "tmp_auth_user" AS SELECT "id", "first_name", "last_name", "email" FROM "auth_user" WITH NO DATA'),  # noqa
              call('CREATE INDEX ON "tmp_auth_user" ("id")'),
-             call('UPDATE "auth_user" t SET "first_name" = s."first_name", "last_name" = s."last_name", "email" = s."email" FROM "tmp_auth_user" s WHERE t."id" = s."id"'),  # noqa
+             SELECT_COLUMNS_WITHOUT_EQUALITY,
+             UPDATE_AUTH_USER,
              call('DROP TABLE IF EXISTS "tmp_auth_user"')
           ],
             0, []
          ],
-        ['--dump-file ./dump.sql --dump-options "--format plain" --host localhost --port 5432 --user root --password my-cool-password --dbname db --schema ./tests/schemes/valid_schema.yml -v --init-sql "set work_mem=\'1GB\'"',  # noqa
+        ['--dump-file ./dump.sql --dump-options "--format plain" --exact-count --host localhost --port 5432 --user root --password my-cool-password --dbname db --schema ./tests/schemes/valid_schema.yml -v --init-sql "set work_mem=\'1GB\'"',  # noqa
          Namespace(verbose=1, list_providers=False, schema='./tests/schemes/valid_schema.yml', dbname='db', user='root',
-                   password='my-cool-password', host='localhost', port='5432', dry_run=False, dump_file='./dump.sql', dump_options='--format plain', init_sql="set work_mem='1GB'", parallel=False),  # noqa
+                   password='my-cool-password', host='localhost', port='5432', dry_run=False, dump_file='./dump.sql', dump_options='--format plain', dump_jobs=1, dump_compress=None, input_dump=None, target=None, init_sql="set work_mem='1GB'", parallel=False, jobs=1, pushdown=False, exact_count=True, binary_copy=False, pipeline_depth=0, batch_commit=False, resume=False),  # noqa
          [
              call("set work_mem='1GB'"),
              call('TRUNCATE TABLE "django_session"'),
-             call('SELECT COUNT(*) FROM "auth_user"'),
-             call('SELECT "id", "first_name", "last_name", "email" FROM "auth_user"'),
+             call('SELECT COUNT(*) FROM "auth_user" WHERE ' + FETCH_CONDITION),
+             call('SELECT "id", "first_name", "last_name", "email" FROM "auth_user" WHERE ' + FETCH_CONDITION),
              call(
                  'CREATE TEMP TABLE "tmp_auth_user" AS SELECT "id", "first_name", "last_name", "email" FROM "auth_user" WITH NO DATA'),  # noqa
              call('CREATE INDEX ON "tmp_auth_user" ("id")'),
-             call('UPDATE "auth_user" t SET "first_name" = s."first_name", "last_name" = s."last_name", "email" = s."email" FROM "tmp_auth_user" s WHERE t."id" = s."id"'),  # noqa
+             SELECT_COLUMNS_WITHOUT_EQUALITY,
+             UPDATE_AUTH_USER,
              call('DROP TABLE IF EXISTS "tmp_auth_user"')
          ],
          1,
-         [call('PGPASSWORD=my-cool-password pg_dump --format plain --dbname db --username root --host localhost --port 5432 --file ./dump.sql', shell=True)]  # noqa
+         [('PGPASSWORD=my-cool-password pg_dump --format plain --verbose --dbname db --username root --host localhost --port 5432 --file ./dump.sql',)]  # noqa
          ],
 
         ['--list-providers --parallel',
          Namespace(verbose=None, list_providers=True, schema='schema.yml', dbname=None, user=None,
-                   password='', host='localhost', port='5432', dry_run=False, dump_file=None, dump_options='--format custom --compress 9', init_sql=False, parallel=True),  # noqa
+                   password='', host='localhost', port='5432', dry_run=False, dump_file=None, dump_options='--format custom --compress 9', dump_jobs=1, dump_compress=None, input_dump=None, target=None, init_sql=False, parallel=True, jobs=1, pushdown=False, exact_count=False, binary_copy=False, pipeline_depth=0, batch_commit=False, resume=False),  # noqa
          [], 0, []
          ],
     ])
-    def test_cli_args(self, subprocess, patched_connect, quote_ident, cli_args, expected, expected_executes, commit_calls, call_dump):  # noqa
+    def test_cli_args(self, subprocess, patched_connect, quote_ident, literal, cli_args, expected, expected_executes, commit_calls, call_dump):  # noqa
         arg_parser = get_arg_parser()
         parsed_args = arg_parser.parse_args(shlex.split(cli_args))
         assert parsed_args == expected
         mock_cursor = Mock()
-        mock_cursor.fetchone.return_value = [0]
+        mock_cursor.fetchone.side_effect = lambda: (
+            [[{'Plan': {'Plan Rows': 0}}]] if mock_cursor.execute.call_args[0][0].startswith('EXPLAIN') else [0])
         mock_cursor.fetchmany.return_value = None
+        mock_cursor.fetchall.return_value = []
 
         connection = Mock()
         connection.cursor.return_value = mock_cursor
 
         patched_connect.return_value = connection
-        main(parsed_args)
+        subprocess.Popen.return_value.stderr = []
+        subprocess.Popen.return_value.wait.return_value = 0
+        assert not main(parsed_args)
         assert mock_cursor.execute.call_args_list == expected_executes
         assert connection.commit.call_count == commit_calls
 
-        assert subprocess.call.call_args_list == call_dump
+        assert [args for args, kwargs in subprocess.Popen.call_args_list] == call_dump
+
+    @patch('psycopg2.connect')
+    @pytest.mark.parametrize('option', [
+        '--dump-file ./dump.sql', '--pushdown', '--batch-commit', '--resume', '--exact-count',
+    ])
+    def test_target_incompatible_options(self, patched_connect, option):
+        parsed_args = get_arg_parser().parse_args(shlex.split(
+            '--schema ./tests/schemes/valid_schema.yml --dbname db --target "dbname=staging" ' + option))
+        with pytest.raises(InvalidConfiguration, match=option.split()[0]):
+            main(parsed_args)
+        assert not patched_connect.called
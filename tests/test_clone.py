@@ -0,0 +1,173 @@
+import pytest
+from mock import ANY, Mock, call, patch
+
+from pganonymize.clone import clone_table, clone_tables, copy_table_data, get_copy_column_names
+from pganonymize.exceptions import InvalidConfiguration
+from tests.utils import literal_as_string, quote_ident
+
+
+def get_connection(rows=None):
+    cursor = Mock()
+    cursor.fetchall.return_value = rows or []
+    cursor.fetchone.return_value = ['00000003-00000002-1']
+    connection = Mock(server_version=160000)
+    connection.cursor.return_value = cursor
+    return connection, cursor
+
+
+@patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+class TestCopyTableData(object):
+
+    @pytest.mark.parametrize('condition, source_sql', [
+        [None, 'COPY "public"."auth_user" ("id", "email") TO STDOUT (FORMAT binary)'],
+        ['id > 10', 'COPY (SELECT "id", "email" FROM "public"."auth_user" WHERE id > 10) TO STDOUT (FORMAT binary)'],
+    ])
+    def test_copy_table_data(self, quote_ident, condition, source_sql):
+        source_connection, source_cursor = get_connection()
+        target_connection, target_cursor = get_connection()
+        source_cursor.copy_expert.side_effect = lambda sql, file: file.write(b'PGCOPY' * 10000)
+        copied = []
+        target_cursor.copy_expert.side_effect = lambda sql, file: copied.append(file.read())
+
+        copy_table_data(source_connection, target_connection, ('public', 'auth_user'), ['id', 'email'], condition)
+
+        assert source_cursor.copy_expert.call_args[0][0] == source_sql
+        assert target_cursor.copy_expert.call_args[0][0] == (
+            'COPY "public"."auth_user" ("id", "email") FROM STDIN (FORMAT binary)')
+        assert copied == [b'PGCOPY' * 10000]
+
+    def test_source_error(self, quote_ident):
+        source_connection, source_cursor = get_connection()
+        target_connection, target_cursor = get_connection()
+        source_cursor.copy_expert.side_effect = ValueError('source')
+        target_cursor.copy_expert.side_effect = lambda sql, file: file.read()
+
+        with pytest.raises(ValueError, match='source'):
+            copy_table_data(source_connection, target_connection, ('public', 'auth_user'), ['id'])
+
+
+@patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+@pytest.mark.parametrize('server_version, expected_query', [
+    [110000, 'SELECT attname FROM pg_catalog.pg_attribute '
+             'WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped ORDER BY attnum'],
+    [120000, 'SELECT attname FROM pg_catalog.pg_attribute '
+             'WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped AND attgenerated = \'\' '
+             'ORDER BY attnum'],
+])
+def test_get_copy_column_names(quote_ident, server_version, expected_query):
+    connection, cursor = get_connection([('id',), ('email',)])
+    connection.server_version = server_version
+    assert get_copy_column_names(connection, ('public', 'auth_user')) == ['id', 'email']
+    cursor.execute.assert_called_once_with(expected_query, ('"public"."auth_user"',))
+
+
+@patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+@patch('pganonymize.clone.import_data')
+@patch('pganonymize.clone.copy_table_data')
+@patch('pganonymize.clone.get_fetch_cursor')
+@patch('pganonymize.clone.get_copy_column_names', return_value=['id', 'email'])
+class TestCloneTable(object):
+
+    def test_unchanged_table(self, get_copy_column_names, get_fetch_cursor, copy_table_data, import_data,
+                             quote_ident):
+        source_connection, target_connection = Mock(), Mock()
+        clone_table(source_connection, target_connection, ('public', 'auth_group'))
+        copy_table_data.assert_called_once_with(source_connection, target_connection, ('public', 'auth_group'),
+                                                ['id', 'email'])
+        assert not get_fetch_cursor.called
+        assert not import_data.called
+
+    @pytest.mark.parametrize('search, exclude, condition', [
+        [None, '\\b.*@example.com', None],
+        ['id > 1', '\\b.*@example.com', '(id > 1) AND "email" IS NOT NULL'],
+        [None, '.*@internal', 'NOT (coalesce("email" ~* \'^(?:[^\\n]*@internal)\', false)) AND "email" IS NOT NULL'],
+    ])
+    @patch('psycopg2.sql.Literal.as_string', autospec=True, side_effect=literal_as_string)
+    def test_anonymized_table(self, literal, get_copy_column_names, get_fetch_cursor, copy_table_data, import_data,
+                              quote_ident, search, exclude, condition):
+        source_connection, _ = get_connection()
+        target_connection = Mock()
+        cursor = get_fetch_cursor.return_value
+        records = [(1, 'jane@example.com'), (2, 'john@doe.org')]
+        cursor.fetchmany.side_effect = [records, []]
+        table_definition = {
+            'fields': [{'email': {'provider': {'name': 'set', 'value': 'foo@localhost'}}}],
+            'excludes': [{'email': [exclude]}, {'email': ['\\b.*@example.com']}],
+            'search': search,
+        }
+
+        clone_table(source_connection, target_connection, ('public', 'auth_user'), table_definition,
+                    binary_copy=True)
+
+        if condition:
+            copy_table_data.assert_called_once_with(source_connection, target_connection, ('public', 'auth_user'),
+                                                    ['id', 'email'], condition='({}) IS NOT TRUE'.format(condition))
+        else:
+            assert not copy_table_data.called
+        get_fetch_cursor.assert_called_once_with(source_connection, 'public.auth_user', ['id', 'email'],
+                                                 binary_copy=True)
+        expected_select = 'SELECT "id", "email" FROM "public"."auth_user"'
+        if condition:
+            expected_select += ' WHERE ' + condition
+        cursor.execute.assert_called_once_with(expected_select)
+        import_data.assert_called_once_with(target_connection, 'public.auth_user', ['id', 'email'], ANY, [])
+        assert import_data.call_args[0][3].rows() == [(1, 'jane@example.com'), (2, 'foo@localhost')]
+
+
+@patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+@patch('pganonymize.clone.WorkerPool')
+@patch('pganonymize.clone.copy_sequences')
+@patch('pganonymize.clone.clone_table')
+@patch('pganonymize.clone.get_tables')
+@patch('pganonymize.clone.config')
+@pytest.mark.parametrize('dry_run, parallel', [[False, False], [True, False], [False, True]])
+def test_clone_tables(mock_config, get_tables, clone_table, copy_sequences, worker_pool, quote_ident, dry_run,
+                      parallel):
+    mock_config.schema = {
+        'tables': [{'auth_user': {'fields': []}}, {'missing': {'fields': []}}],
+        'truncate': ['public.django_session'],
+    }
+    get_tables.return_value = [('public', 'auth_user'), ('public', 'django_session'), ('public', 'auth_group')]
+    connection, cursor = get_connection()
+    source_connection, target_connection = Mock(), Mock()
+    source_pool = Mock(getconn=Mock(return_value=source_connection))
+    target_pool = Mock(getconn=Mock(return_value=target_connection))
+
+    clone_tables(connection, source_pool, target_pool, jobs=1 if parallel else 2, dry_run=dry_run, parallel=parallel)
+
+    assert call('SELECT pg_catalog.pg_export_snapshot()') in cursor.execute.call_args_list
+    source_cursor = source_connection.cursor.return_value
+    assert source_cursor.execute.call_args_list == [
+        call('SET TRANSACTION SNAPSHOT %s', ('00000003-00000002-1',))] * 2
+    assert clone_table.call_count == 2
+    for expected_call in [
+        call(source_connection, target_connection, ('public', 'auth_user'), {'fields': []}, verbose=False,
+             parallel=parallel, binary_copy=False, pipeline_depth=0),
+        call(source_connection, target_connection, ('public', 'auth_group'), None, verbose=False,
+             parallel=parallel, binary_copy=False, pipeline_depth=0),
+    ]:
+        assert expected_call in clone_table.call_args_list
+    copy_sequences.assert_called_once_with(connection, target_connection)
+    assert target_connection.commit.call_count == (0 if dry_run else 3)
+    assert target_pool.putconn.call_count == 3
+    assert source_pool.putconn.call_count == 2
+    if parallel:
+        worker_pool.assert_called_once_with([(), ()])
+        worker_pool.return_value.close.assert_called_once_with()
+    else:
+        assert not worker_pool.called
+
+
+@patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+@patch('pganonymize.clone.clone_table')
+@patch('pganonymize.clone.get_tables', return_value=[('public', 'sessions')])
+@patch('pganonymize.clone.config')
+def test_clone_tables_unsupported_types(mock_config, get_tables, clone_table, quote_ident):
+    mock_config.schema = {'tables': [{'sessions': {'fields': []}}]}
+    connection, cursor = get_connection()
+    cursor.fetchall.side_effect = [[('id',), ('ip',)], [('id', 'int4', 'integer', True), ('ip', 'inet', 'inet', False)]]
+
+    with pytest.raises(InvalidConfiguration, match=r'Table "public.sessions" .* columns ip \(inet\) aren'):
+        clone_tables(connection, Mock(), Mock())
+
+    assert not clone_table.called
@@ -63,7 +63,7 @@ def test_load_schema(file, envs, expected):
 
 
 def test_validate_args_with_config_when_valid():
-    args = Mock(parallel=False)
+    args = Mock(target=None, parallel=False, jobs=1)
     schema = {
         'tables': [
             {
@@ -79,8 +79,8 @@ def test_validate_args_with_config_when_valid():
     validate_args_with_config(args, config)
 
 
-def test_validate_args_with_config_when_invalid():
-    args = Mock(parallel=True)
+def test_validate_args_with_config_parallel_and_unique():
+    args = Mock(target=None, parallel=True, jobs=1)
     schema = {
         'tables': [
             {
@@ -93,5 +93,118 @@ def test_validate_args_with_config_when_invalid():
         ]
     }
     config = Mock(schema=schema)
+    validate_args_with_config(args, config)
+
+
+@pytest.mark.parametrize('seed', ['42', True, 4.2])
+def test_validate_args_with_config_invalid_seed(seed):
+    args = Mock(target=None, parallel=True, jobs=1)
+    config = Mock(schema={'options': {'faker': {'seed': seed}}})
+    with pytest.raises(InvalidConfiguration, match='seed'):
+        validate_args_with_config(args, config)
+
+
+def test_validate_args_with_config_parallel_and_jobs():
+    args = Mock(target=None, parallel=True, jobs=4)
+    config = Mock(schema={'tables': []})
+    with pytest.raises(InvalidConfiguration):
+        validate_args_with_config(args, config)
+
+
+@pytest.mark.parametrize('table_definition', [
+    {'apply': 'replace', 'fields': []},
+    {'apply': 'rewrite', 'search': 'id > 10', 'fields': []},
+])
+def test_validate_args_with_config_invalid_apply_strategy(table_definition):
+    args = Mock(target=None, parallel=False, jobs=1)
+    config = Mock(schema={'tables': [{'table_name': table_definition}]})
+    with pytest.raises(InvalidConfiguration):
+        validate_args_with_config(args, config)
+
+
+@pytest.mark.parametrize('option', ['dump_file', 'pushdown', 'batch_commit', 'resume', 'exact_count'])
+def test_validate_args_with_config_target_incompatible_options(option):
+    args = Mock(target='dbname=staging', parallel=False, jobs=1, dump_file=None, pushdown=False, batch_commit=False,
+                resume=False, exact_count=False)
+    config = Mock(schema={'tables': []})
+    validate_args_with_config(args, config)
+    setattr(args, option, True)
+    with pytest.raises(InvalidConfiguration, match='`--target` and `--{}` options'.format(option.replace('_', '-'))):
+        validate_args_with_config(args, config)
+
+
+@pytest.mark.parametrize('table_definition, parallel', [
+    ({'partitions': 0, 'fields': []}, False),
+    ({'partitions': '4', 'fields': []}, False),
+    ({'partitions': 4, 'apply': 'rewrite', 'fields': []}, False),
+    ({'partitions': 4, 'fields': []}, True),
+])
+def test_validate_args_with_config_invalid_partitions(table_definition, parallel):
+    args = Mock(target=None, parallel=parallel, jobs=1)
+    config = Mock(schema={'tables': [{'table_name': table_definition}]})
+    with pytest.raises(InvalidConfiguration):
+        validate_args_with_config(args, config)
+
+
+@pytest.mark.parametrize('batch_commit, resume, valid', [
+    (False, False, True),
+    (True, True, True),
+    (False, True, False),
+])
+def test_validate_args_with_config_resume_partitions(batch_commit, resume, valid):
+    args = Mock(target=None, parallel=False, jobs=1, batch_commit=batch_commit, resume=resume)
+    config = Mock(schema={'tables': [{'table_name': {'partitions': 4, 'fields': []}}]})
+    if valid:
+        validate_args_with_config(args, config)
+    else:
+        with pytest.raises(InvalidConfiguration, match='partitions of table "table_name" can only be resumed'):
+            validate_args_with_config(args, config)
+
+
+@pytest.mark.parametrize('schema', [
+    {'settings': ['work_mem'], 'tables': []},
+    {'tables': [{'table_name': {'settings': 'work_mem', 'fields': []}}]},
+    {'tables': [{'table_name': {'unlogged': True, 'apply': 'rewrite', 'fields': []}}]},
+])
+def test_validate_args_with_config_invalid_settings(schema):
+    args = Mock(target=None, parallel=False, jobs=1)
+    config = Mock(schema=schema)
+    with pytest.raises(InvalidConfiguration):
+        validate_args_with_config(args, config)
+
+
+@pytest.mark.parametrize('table_definition, batch_commit', [
+    ({'rebuild_indexes': True, 'fields': []}, False),
+    ({'rebuild_indexes': 'all', 'apply': 'rewrite', 'fields': []}, False),
+    ({'rebuild_indexes': 'all', 'fields': []}, True),
+    ({'rebuild_indexes': 'columns', 'partitions': 4, 'fields': []}, False),
+])
+def test_validate_args_with_config_invalid_rebuild_indexes(table_definition, batch_commit):
+    args = Mock(target=None, parallel=False, jobs=1, batch_commit=batch_commit, resume=False)
+    config = Mock(schema={'tables': [{'table_name': table_definition}]})
+    with pytest.raises(InvalidConfiguration):
+        validate_args_with_config(args, config)
+
+
+@pytest.mark.parametrize('table_definition, batch_commit, resume', [
+    ({'rebuild_indexes': 'all', 'fields': []}, False, False),
+    ({'rebuild_indexes': 'all', 'fields': []}, True, True),
+    ({'rebuild_indexes': 'columns', 'partitions': 4, 'fields': []}, True, True),
+])
+def test_validate_args_with_config_rebuild_indexes(table_definition, batch_commit, resume):
+    args = Mock(target=None, parallel=False, jobs=1, batch_commit=batch_commit, resume=resume)
+    config = Mock(schema={'tables': [{'table_name': table_definition}]})
+    validate_args_with_config(args, config)
+
+
+@pytest.mark.parametrize('table_definition, batch_commit', [
+    ({'primary_key': [], 'fields': []}, False),
+    ({'primary_key': ['ctid', 'id'], 'fields': []}, False),
+    ({'primary_key': 'ctid', 'partitions': 2, 'fields': []}, False),
+    ({'primary_key': 'ctid', 'fields': []}, True),
+])
+def test_validate_args_with_config_invalid_primary_key(table_definition, batch_commit):
+    args = Mock(target=None, parallel=False, jobs=1, batch_commit=batch_commit)
+    config = Mock(schema={'tables': [{'table_name': table_definition}]})
     with pytest.raises(InvalidConfiguration):
         validate_args_with_config(args, config)
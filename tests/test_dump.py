@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import io
+
+import pytest
+from mock import patch
+
+from pganonymize.dump import (
+    anonymize_dump, decode_copy_value, encode_copy_value, parse_identifiers,
+)
+from pganonymize.exceptions import BadDataFormat, InvalidConfiguration
+
+SCHEMA = {
+    'tables': [
+        {
+            'auth_user': {
+                'fields': [
+                    {'last_name': {'provider': {'name': 'set', 'value': 'Bar'}}},
+                    {'email': {'provider': {'name': 'md5'}, 'append': '@localhost'}},
+                    {'metadata.phone': {'provider': {'name': 'clear'}}},
+                ],
+                'excludes': [
+                    {'email': ['\\S[^@]*@example\\.com']},
+                ]
+            }
+        },
+        {'public.orders': {'fields': [{'note': {'provider': {'name': 'clear'}}}]}},
+    ],
+    'truncate': ['django_session']
+}
+
+DUMP = '''--
+-- PostgreSQL database dump
+--
+
+SET client_encoding = 'UTF8';
+
+COPY public.auth_user (id, last_name, email, metadata) FROM stdin;
+1\tFoo\tjane.doe@example.com\t\\N
+2\tDöe\tjohn@doe.org\t{"phone": "1234", "zip": "12345"}
+3\t\\N\t\\N\t\\N
+\\.
+
+
+COPY public.django_session (session_key, session_data) FROM stdin;
+abc\tdata
+\\.
+
+
+COPY public.orders (id, "Note", note) FROM stdin;
+1\tTab\\there\tLine\\nbreak
+\\.
+
+
+COPY public.auth_group (id, name) FROM stdin;
+1\tFoo\\\\Bar
+\\.
+
+
+--
+-- PostgreSQL database dump complete
+--
+
+'''
+
+EXPECTED_DUMP = '''--
+-- PostgreSQL database dump
+--
+
+SET client_encoding = 'UTF8';
+
+COPY public.auth_user (id, last_name, email, metadata) FROM stdin;
+1\tFoo\tjane.doe@example.com\t\\N
+2\tBar\tbc6a715808d9aae0ddeefb1e47e482a6@localhost\t{"phone": null, "zip": "12345"}
+3\t\\N\t\\N\t\\N
+\\.
+
+
+COPY public.django_session (session_key, session_data) FROM stdin;
+\\.
+
+
+COPY public.orders (id, "Note", note) FROM stdin;
+1\tTab\\there\t\\N
+\\.
+
+
+COPY public.auth_group (id, name) FROM stdin;
+1\tFoo\\\\Bar
+\\.
+
+
+--
+-- PostgreSQL database dump complete
+--
+
+'''
+
+
+@patch('pganonymize.dump.config')
+def test_anonymize_dump(mock_config):
+    mock_config.schema = SCHEMA
+    output_file = io.BytesIO()
+    anonymize_dump(io.BytesIO(DUMP.encode('utf-8')), output_file)
+    assert output_file.getvalue().decode('utf-8') == EXPECTED_DUMP
+
+
+@patch('pganonymize.dump.config')
+def test_anonymize_dump_update_json(mock_config):
+    mock_config.schema = {'tables': [{'data': {'fields': [{'info': {'provider': {
+        'name': 'update_json',
+        'update_values_type': {'str': {'provider': {'name': 'set', 'value': 'x'}}},
+    }}}]}}]}
+    output_file = io.BytesIO()
+    dump = 'COPY public.data (id, info) FROM stdin;\n1\t{"a": "b", "c": {"d": "e"}}\n2\t\\N\n\\.\n'
+    anonymize_dump(io.BytesIO(dump.encode('utf-8')), output_file)
+    assert output_file.getvalue().decode('utf-8') == (
+        'COPY public.data (id, info) FROM stdin;\n1\t{"a": "x", "c": {"d": "x"}}\n2\t\\N\n\\.\n')
+
+
+@patch('pganonymize.dump.config')
+def test_anonymize_dump_missing_columns(mock_config):
+    mock_config.schema = {'tables': [{'data': {
+        'fields': [{'name': {'provider': {'name': 'set', 'value': 'x'}}}, {'email': {'provider': {'name': 'clear'}}}],
+        'excludes': [{'name': ['keep']}, {'login': ['admin']}],
+    }}]}
+    output_file = io.BytesIO()
+    dump = 'COPY public.data (id, name) FROM stdin;\n1\tkeep\n2\tD\\303\\266e\n\\.\n'
+    anonymize_dump(io.BytesIO(dump.encode('utf-8')), output_file)
+    assert output_file.getvalue().decode('utf-8') == 'COPY public.data (id, name) FROM stdin;\n1\tkeep\n2\tx\n\\.\n'
+
+
+@patch('pganonymize.dump.config')
+@pytest.mark.parametrize('schema, dump, exception', [
+    [{'tables': [{'auth_user': {'search': 'id > 10', 'fields': []}}]}, b'', InvalidConfiguration],
+    [SCHEMA, b'PGDMP\x01\x0e\x00', BadDataFormat],
+    [SCHEMA, b'COPY public.auth_user (id, last_name, email, metadata) FROM stdin;\n1\tFoo\n\\.\n', BadDataFormat],
+    [SCHEMA, b'COPY public.auth_user (id, last_name, email, metadata) FROM stdin;\n', BadDataFormat],
+])
+def test_anonymize_dump_invalid(mock_config, schema, dump, exception):
+    mock_config.schema = schema
+    with pytest.raises(exception):
+        anonymize_dump(io.BytesIO(dump), io.BytesIO())
+
+
+@pytest.mark.parametrize('value, expected', [
+    ['public.auth_user', ['public', 'auth_user']],
+    ['id, "First Name", "a ""quoted"", name"', ['id', 'First Name', 'a "quoted", name']],
+])
+def test_parse_identifiers(value, expected):
+    assert parse_identifiers(value) == expected
+
+
+@pytest.mark.parametrize('value, encoding, expected', [
+    [b'\\N', 'utf-8', None],
+    [b'plain', 'utf-8', 'plain'],
+    [b'a\\tb\\nc\\\\d\\re', 'utf-8', 'a\tb\nc\\d\re'],
+    [b'\\101\\x42\\.', 'utf-8', 'AB.'],
+    [b'D\\303\\266e', 'utf-8', 'D\xf6e'],
+    [b'D\\xc3\\xb6e', 'utf-8', 'D\xf6e'],
+    [b'D\\366e', 'latin-1', 'D\xf6e'],
+    [b'\\x\\\xc3\xb6', 'utf-8', 'x\xf6'],
+])
+def test_decode_copy_value(value, encoding, expected):
+    assert decode_copy_value(value, encoding) == expected
+
+
+@pytest.mark.parametrize('value, expected', [
+    [None, '\\N'],
+    [True, 't'],
+    [12, '12'],
+    ['a\tb\nc\\d', 'a\\tb\\nc\\\\d'],
+    [{'a': 1}, '{"a": 1}'],
+])
+def test_encode_copy_value(value, expected):
+    assert encode_copy_value(value) == expected
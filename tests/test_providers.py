@@ -5,6 +5,9 @@ from collections import OrderedDict
 import pytest
 import six
 from mock import MagicMock, Mock, call, patch
+from psycopg2.sql import Identifier
+
+from tests.utils import literal_as_string, quote_ident
 
 from pganonymize import exceptions, providers
 from pganonymize.exceptions import InvalidProviderArgument
@@ -78,16 +81,42 @@ class TestProviderRegistry(object):
     def test_get_provider(self, provider_id, effect):
         provider = None
         registry = providers.ProviderRegistry()
-        with patch.object(registry, '_registry', {
-            'foo': Mock(spec=providers.Provider),
-            'bar': Mock(spec=providers.Provider),
-            'baz.*': Mock(spec=providers.Provider, regex_match=True)
-        }):
-            with effect:
-                provider = registry.get_provider(provider_id)
+        registry.register(Mock(spec=providers.Provider, regex_match=False), 'foo')
+        registry.register(Mock(spec=providers.Provider, regex_match=False), 'bar')
+        registry.register(Mock(spec=providers.Provider, regex_match=True), 'baz.*')
+        with effect:
+            provider = registry.get_provider(provider_id)
         if provider is not None:
             assert isinstance(provider, providers.Provider)
 
+    @pytest.mark.parametrize('provider_id, expected', [
+        ('fake.name', 'regex'),
+        ('fake', 'exact'),
+        ('mask', 'mask'),
+        ('other.name', 'other'),
+    ])
+    def test_get_provider_precedence(self, provider_id, expected):
+        registry = providers.ProviderRegistry()
+        registry.register(Mock(regex_match=True, name='regex'), 'fake.+')
+        registry.register(Mock(regex_match=False, name='exact'), 'fake')
+        registry.register(Mock(regex_match=False, name='exact'), 'fake.name')
+        registry.register(Mock(regex_match=False, name='mask'), 'mask')
+        registry.register(Mock(regex_match=True, name='mask_regex'), 'mask.*')
+        registry.register(Mock(regex_match=True, name='other'), 'other\\..+')
+        assert registry.get_provider(provider_id)._mock_name == expected
+
+    def test_get_provider_cache(self):
+        registry = providers.ProviderRegistry()
+        registry.register(Mock(regex_match=True), 'foo.+')
+        with patch.object(providers.re, 'compile') as compile_pattern:
+            assert registry.get_provider('foo.bar') is registry.get_provider('foo.bar')
+        assert not compile_pattern.called
+        with pytest.raises(exceptions.InvalidProvider):
+            registry.get_provider('bar')
+        new_provider = Mock(regex_match=False)
+        registry.register(new_provider, 'bar')
+        assert registry.get_provider('bar') is new_provider
+
     def test_providers(self):
         pass
 
@@ -99,6 +128,64 @@ class TestProvider(object):
         with pytest.raises(NotImplementedError):
             provider.alter_value('Foo')
 
+    def test_sql_expression(self):
+        assert providers.Provider.sql_expression(Identifier('foo')) is None
+
+    def test_alter_values(self):
+        class CustomProvider(providers.Provider):
+            @classmethod
+            def alter_value(cls, original_value, **kwargs):
+                return original_value + kwargs['suffix']
+
+        assert CustomProvider.alter_values(['a', 'b'], suffix='!') == ['a!', 'b!']
+
+
+@pytest.mark.parametrize('provider_class, kwargs', [
+    (providers.ClearProvider, {}),
+    (providers.SetProvider, {'value': 'Bar'}),
+    (providers.MaskProvider, {'sign': '?'}),
+    (providers.MaskProvider, {}),
+    (providers.PartialMaskProvider, {'sign': '?', 'unmasked_left': 2}),
+    (providers.PartialMaskProvider, {}),
+    (providers.MD5Provider, {}),
+    (providers.MD5Provider, {'as_number': True, 'as_number_length': 4}),
+])
+def test_alter_values(provider_class, kwargs):
+    values = ['Foo', 'Barbara', u'D\xf6e']
+    assert provider_class.alter_values(values, **kwargs) == [
+        provider_class.alter_value(value, **kwargs) for value in values
+    ]
+
+
+@patch('psycopg2.sql.Literal.as_string', autospec=True, side_effect=literal_as_string)
+@patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+@pytest.mark.parametrize('provider_class, kwargs, expected', [
+    (providers.ClearProvider, {}, 'NULL'),
+    (providers.SetProvider, {'value': None}, 'NULL'),
+    (providers.SetProvider, {'value': 'Bar'}, 'CASE WHEN "col" IS NULL THEN "col" ELSE \'Bar\' END'),
+    (providers.SetProvider, {'value': 42}, 'CASE WHEN "col" IS NULL THEN "col" ELSE \'42\' END'),
+    (providers.SetProvider, {'value': {'foo': 'bar'}}, None),
+    (providers.MaskProvider, {'sign': None}, 'repeat(\'X\', char_length("col"))'),
+    (providers.MaskProvider, {'sign': '?'}, 'repeat(\'?\', char_length("col"))'),
+    (providers.PartialMaskProvider, {'sign': '?', 'unmasked_left': 2},
+     'left("col", 2) || repeat(\'?\', char_length("col") - 3) || right("col", 1)'),
+    (providers.MD5Provider, {}, 'md5("col")'),
+    (providers.MD5Provider, {'as_number': True, 'as_number_length': 4},
+     "mod((((('x' || substr(md5(\"col\"), 1, 8))::bit(32)::bigint::numeric * 4294967296 + "
+     "('x' || substr(md5(\"col\"), 9, 8))::bit(32)::bigint)::numeric * 4294967296 + "
+     "('x' || substr(md5(\"col\"), 17, 8))::bit(32)::bigint)::numeric * 4294967296 + "
+     "('x' || substr(md5(\"col\"), 25, 8))::bit(32)::bigint), 10000)"),
+    (providers.ChoiceProvider, {'values': ['Foo']}, None),
+    (providers.UUID4Provider, {}, None),
+    (providers.FakeProvider, {'name': 'fake.first_name'}, None),
+])
+def test_sql_expression(quote_ident, literal, provider_class, kwargs, expected):
+    expression = provider_class.sql_expression(Identifier('col'), **kwargs)
+    if expected is None:
+        assert expression is None
+    else:
+        assert expression.as_string(Mock()) == expected
+
 
 class TestChoiceProvider(object):
 
@@ -107,6 +194,12 @@ class TestChoiceProvider(object):
         for choice in choices:
             assert providers.ChoiceProvider.alter_value(choice, values=choices) in choices
 
+    def test_alter_values(self):
+        choices = ['Foo', 'Bar', 'Baz']
+        values = providers.ChoiceProvider.alter_values(['a'] * 10, values=choices)
+        assert len(values) == 10
+        assert set(values) <= set(choices)
+
 
 class TestClearProvider(object):
 
@@ -127,6 +220,14 @@ class TestFakeProvider(object):
         providers.FakeProvider.alter_value('Foo', name=name)
         assert operator.attrgetter(function_name)(mock_faker).call_count == 1
 
+    @patch('pganonymize.providers.faker_initializer._faker')
+    def test_alter_values(self, mock_faker):
+        mock_faker.date_of_birth.side_effect = [1, 2, 3]
+        values = providers.FakeProvider.alter_values(['a', 'b', 'c'], name='fake.date_of_birth',
+                                                     kwargs={'minimum_age': 18})
+        assert values == [1, 2, 3]
+        assert mock_faker.date_of_birth.call_args_list == [call(minimum_age=18)] * 3
+
     @pytest.mark.parametrize('name', ['fake.foo_name'])
     def test_invalid_names(self, name):
         with pytest.raises(exceptions.InvalidProviderArgument):
@@ -157,6 +258,20 @@ class TestFakeProvider(object):
         assert faker.date_of_birth.call_count == 1
 
 
+class TestFakerInitializer(object):
+
+    @patch.object(providers, 'Faker')
+    def test_seed(self, mock_faker):
+        faker_initializer = providers.FakerInitializer()
+        faker_initializer._options = {}
+        faker_initializer.seed(42)
+        assert not mock_faker.called
+        assert faker_initializer.faker is mock_faker.return_value
+        mock_faker.return_value.seed_instance.assert_called_once_with(42)
+        faker_initializer.seed(43)
+        assert mock_faker.return_value.seed_instance.call_args == call(43)
+
+
 class TestMaskProvider(object):
 
     @pytest.mark.parametrize('value, sign, expected', [
@@ -212,6 +327,11 @@ class TestUUID4Provider(object):
     def test_alter_value(self, value, expected):
         assert type(providers.UUID4Provider.alter_value(value)) == expected
 
+    def test_alter_values(self):
+        values = providers.UUID4Provider.alter_values(['a', 'b'])
+        assert len(set(values)) == 2
+        assert all(isinstance(value, uuid.UUID) for value in values)
+
 
 class TestUpdateJSONProvider(object):
 
@@ -0,0 +1,171 @@
+import struct
+import uuid
+from collections import namedtuple
+from datetime import date, datetime
+from decimal import Decimal
+
+import pytest
+from mock import Mock, patch
+
+from pganonymize.reader import UTC, CopyCursor, get_column_decoders, type_decoders
+
+Attribute = namedtuple('Attribute', ['attname', 'type_category', 'type_name'])
+
+
+def field(data):
+    if data is None:
+        return struct.pack('>i', -1)
+    return struct.pack('>i', len(data)) + data
+
+
+def copy_data(rows):
+    data = struct.pack('>11sii', b'PGCOPY\n\377\r\n\0', 0, 0)
+    for row in rows:
+        data += struct.pack('>h', len(row)) + b''.join(field(value) for value in row)
+    return data + struct.pack('>h', -1)
+
+
+@pytest.mark.parametrize('type_name, data, expected', [
+    ['bool', b'\x01', True],
+    ['int2', struct.pack('>h', -3), -3],
+    ['int4', struct.pack('>i', 123456), 123456],
+    ['int8', struct.pack('>q', -9876543210), -9876543210],
+    ['float8', struct.pack('>d', 2.25), 2.25],
+    ['text', u'V\xe4r\xe9'.encode('utf-8'), u'V\xe4r\xe9'],
+    ['bytea', b'\x00\xff', b'\x00\xff'],
+    ['json', b'{"a": [1, 2]}', {'a': [1, 2]}],
+    ['jsonb', b'\x01{"b": null}', {'b': None}],
+    ['date', struct.pack('>i', -1), date(1999, 12, 31)],
+    ['timestamp', struct.pack('>q', 1500000), datetime(2000, 1, 1, 0, 0, 1, 500000)],
+    ['timestamptz', struct.pack('>q', 0), datetime(2000, 1, 1, tzinfo=UTC)],
+    ['numeric', struct.pack('>hhHhHHH', 3, 1, 0, 6, 12, 3456, 7800), Decimal('123456.780000')],
+    ['numeric', struct.pack('>hhHhH', 1, -1, 0x4000, 1, 5000), Decimal('-0.5')],
+    ['numeric', struct.pack('>hhHhH', 1, 2, 0, 0, 1234), Decimal('123400000000')],
+    ['numeric', struct.pack('>hhHh', 0, 0, 0, 2), Decimal('0.00')],
+    ['numeric', struct.pack('>hhHh', 0, 0, 0xC000, 0), Decimal('NaN')],
+    ['uuid', uuid.UUID(int=1).bytes, uuid.UUID(int=1)],
+])
+def test_type_decoders(type_name, data, expected):
+    value = type_decoders[type_name](data, 'utf-8')
+    if type_name == 'numeric':
+        assert str(value) == str(expected)
+    else:
+        assert value == expected
+
+
+@patch('pganonymize.reader.util.get_schema', return_value='public')
+@patch('pganonymize.reader.inspect.get_types')
+@pytest.mark.parametrize('types, expected', [
+    [[Attribute('id', 'N', 'int4'), Attribute('name', 'S', 'text')], [type_decoders['int4'], type_decoders['text']]],
+    [[Attribute('id', 'N', 'int4'), Attribute('name', 'A', 'text')], None],
+    [[Attribute('id', 'N', 'int4'), Attribute('name', 'U', 'point')], None],
+])
+def test_get_column_decoders(get_types, get_schema, types, expected):
+    get_types.return_value = {attribute.attname: attribute for attribute in types}
+    connection = Mock()
+    assert get_column_decoders(connection, 'auth_user', ['id', 'name']) == expected
+    get_types.assert_called_once_with(connection, 'public', 'auth_user')
+
+
+class TestCopyCursor(object):
+
+    @pytest.mark.parametrize('block_size', [1024, 1, 7])
+    def test_fetchmany(self, block_size):
+        rows = [
+            [struct.pack('>i', index), u'name {}'.format(index).encode('utf-8') if index % 3 else None]
+            for index in range(10)
+        ]
+        mock_cursor = Mock()
+        mock_cursor.copy_expert.side_effect = lambda sql, file: file.write(copy_data(rows))
+        connection = Mock(encoding='UTF8')
+        connection.cursor.return_value = mock_cursor
+
+        with patch('pganonymize.reader.BLOCK_SIZE', block_size):
+            cursor = CopyCursor(connection, ['id', 'name'], [type_decoders['int4'], type_decoders['text']])
+            cursor.execute('SELECT "id", "name" FROM "auth_user"')
+            batches = [cursor.fetchmany(size=4) for _ in range(4)]
+            cursor.close()
+
+        mock_cursor.copy_expert.assert_called_once()
+        assert mock_cursor.copy_expert.call_args[0][0] == (
+            'COPY (SELECT "id", "name" FROM "auth_user") TO STDOUT (FORMAT binary)')
+        assert [len(batch) for batch in batches] == [4, 4, 2, 0]
+        assert batches[0][0] == (0, None)
+        assert batches[2][0] == (8, u'name 8')
+
+    def test_streaming(self):
+        rows = [[struct.pack('>i', index), b'x' * 1000] for index in range(1000)]
+        written = []
+
+        def copy_expert(sql, file):
+            # More data than a pipe can buffer, so it is only written while the rows are fetched
+            data = copy_data(rows)
+            for offset in range(0, len(data), 100000):
+                file.write(data[offset:offset + 100000])
+                written.append(offset)
+
+        mock_cursor = Mock()
+        mock_cursor.copy_expert.side_effect = copy_expert
+        connection = Mock(encoding='UTF8')
+        connection.cursor.return_value = mock_cursor
+        cursor = CopyCursor(connection, ['id', 'name'], [type_decoders['int4'], type_decoders['text']])
+        cursor.execute('SELECT "id", "name" FROM "auth_user"')
+        assert len(written) < 11
+        assert len(cursor.fetchmany(size=10)) == 10
+        assert len(cursor.fetchall()) == 990
+        assert cursor.fetchall() == []
+        assert len(written) == 11
+        mock_cursor.close.assert_called_once_with()
+
+    def test_copy_error(self):
+        mock_cursor = Mock()
+        mock_cursor.copy_expert.side_effect = RuntimeError('relation "auth_user" does not exist')
+        connection = Mock(encoding='UTF8')
+        connection.cursor.return_value = mock_cursor
+        cursor = CopyCursor(connection, ['id'], [type_decoders['int4']])
+        with pytest.raises(RuntimeError, match='does not exist'):
+            cursor.execute('SELECT "id" FROM "auth_user"')
+
+    def test_close(self):
+        errors = []
+
+        def copy_expert(sql, file):
+            file.write(copy_data([[struct.pack('>i', 1)]])[:-2])
+            try:
+                while True:
+                    file.write(struct.pack('>hii', 1, 4, 2) * 1000)
+                    file.flush()
+            except (IOError, OSError) as exc:
+                errors.append(exc)
+                raise
+
+        mock_cursor = Mock()
+        mock_cursor.copy_expert.side_effect = copy_expert
+        connection = Mock(encoding='UTF8')
+        connection.cursor.return_value = mock_cursor
+        cursor = CopyCursor(connection, ['id'], [type_decoders['int4']])
+        cursor.execute('SELECT "id" FROM "auth_user"')
+        assert cursor.fetchmany(size=2) == [(1,), (2,)]
+        # Closing the cursor aborts the COPY
+        cursor.close()
+        assert len(errors) == 1
+
+    def test_invalid_data(self):
+        mock_cursor = Mock()
+        mock_cursor.copy_expert.side_effect = lambda sql, file: file.write(copy_data([[b'\x00']])[:-4])
+        connection = Mock(encoding='UTF8')
+        connection.cursor.return_value = mock_cursor
+        cursor = CopyCursor(connection, ['id'], [type_decoders['bool']])
+        cursor.execute('SELECT "id" FROM "auth_user"')
+        with pytest.raises(ValueError):
+            cursor.fetchmany(size=10)
+
+
+@patch('pganonymize.reader.util.get_schema')
+@patch('pganonymize.reader.inspect.get_types')
+def test_get_column_decoders_qualified_table(get_types, get_schema):
+    get_types.return_value = {'id': Attribute('id', 'N', 'int4')}
+    connection = Mock()
+    assert get_column_decoders(connection, 'other.auth_user', ['id']) == [type_decoders['int4']]
+    get_types.assert_called_once_with(connection, 'other', 'auth_user')
+    assert not get_schema.called
@@ -1,17 +1,40 @@
+import json
+import logging
 import math
+import subprocess
 from collections import OrderedDict, namedtuple
 
+import psycopg2.extensions
 import pytest
 from mock import ANY, Mock, call, patch
 
-from tests.utils import quote_ident
+from tests.utils import literal_as_string, quote_ident
 
+from pganonymize.chunk import Chunk
+from pganonymize.exceptions import InvalidConfiguration, InvalidProvider, UniquenessError
+from pganonymize.providers import MD5Provider, SetProvider
 from pganonymize.utils import (
-    anonymize_tables, build_and_then_import_data, create_database_dump, get_column_values, get_connection, import_data,
-    truncate_tables,
+    ExcludeMatcher, FieldPlan, WorkerPool, anonymize_tables, apply_field_plans, apply_field_plans_to_chunk,
+    apply_settings, apply_worker_fields, build_and_then_import_data, build_and_then_rewrite_data,
+    compile_exclude_patterns, compile_table_plan, create_database_dump, format_size, get_column_values,
+    get_connection, get_connection_pool, get_copy_column_types, get_dump_size, get_fetch_condition, get_json_columns,
+    get_partition_bounds, get_partition_conditions, get_pool_size, get_pushdown_columns, get_row_count,
+    get_secondary_indexes, get_table_fields, import_data, init_worker, log_sql_excludes, process_chunk, process_row,
+    read_dump_log, run_pipeline, sort_definitions_by_size, split_excludes, translate_exclude_pattern, truncate_tables,
 )
 
 
+def fetch_batch_rows(mock_cursor, batches):
+    """Return the batches one after another for the queries that fetch a batch ordered by the primary key."""
+    batches = list(batches)
+
+    def fetchall():
+        if ' ORDER BY ' in mock_cursor.execute.call_args[0][0] and batches:
+            return batches.pop(0)
+        return []
+    return fetchall
+
+
 class TestGetConnection(object):
 
     @patch('pganonymize.utils.psycopg2.connect')
@@ -27,6 +50,259 @@ class TestGetConnection(object):
         mock_connect.assert_called_once_with(**connection_data)
 
 
+class TestGetConnectionPool(object):
+
+    @patch('pganonymize.utils.psycopg2.connect')
+    def test(self, mock_connect):
+        mock_cursor = Mock()
+        mock_connect.return_value.cursor.return_value = mock_cursor
+        mock_connect.return_value.closed = False
+        mock_connect.return_value.info.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        connection_data = {'dbname': 'test', 'user': 'user'}
+        pool = get_connection_pool(connection_data, 4, init_sql='SET work_mem TO \'1GB\'')
+        connection = pool.getconn()
+        assert connection is mock_connect.return_value
+        mock_connect.assert_called_once_with(**connection_data)
+        assert mock_cursor.execute.call_args_list == [call('SET work_mem TO \'1GB\'')]
+        pool.putconn(connection)
+        assert pool.getconn() is connection
+        assert mock_connect.call_count == 1
+
+    @patch('pganonymize.utils.psycopg2.connect')
+    def test_settings(self, mock_connect):
+        mock_cursor = Mock()
+        mock_cursor.fetchone.return_value = ('on', 'off')
+        mock_connect.return_value.cursor.return_value = mock_cursor
+        pool = get_connection_pool({'dbname': 'test'}, 2, settings={'synchronous_commit': 'off'})
+        pool.getconn()
+        assert mock_cursor.execute.call_args_list == [call(
+            'SELECT pg_catalog.current_setting(%s), pg_catalog.set_config(%s, %s, false)',
+            ('synchronous_commit', 'synchronous_commit', 'off')
+        )]
+        mock_connect.return_value.commit.assert_called_once_with()
+
+
+class TestSettings(object):
+
+    def test_apply_settings(self):
+        mock_cursor = Mock()
+        mock_cursor.fetchone.side_effect = [('on', 'off'), ('4MB', '1GB')]
+        connection = Mock()
+        connection.cursor.return_value = mock_cursor
+        previous = apply_settings(connection, OrderedDict([('synchronous_commit', False), ('work_mem', '1GB')]))
+        assert previous == {'synchronous_commit': 'on', 'work_mem': '4MB'}
+        assert mock_cursor.execute.call_args_list == [
+            call('SELECT pg_catalog.current_setting(%s), pg_catalog.set_config(%s, %s, false)',
+                 ('synchronous_commit', 'synchronous_commit', 'off')),
+            call('SELECT pg_catalog.current_setting(%s), pg_catalog.set_config(%s, %s, false)',
+                 ('work_mem', 'work_mem', '1GB')),
+        ]
+
+    @patch('pganonymize.utils.build_and_then_import_data')
+    @patch('pganonymize.utils.get_row_count', return_value=10)
+    @patch('pganonymize.utils.config')
+    @patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+    @pytest.mark.parametrize('dry_run', [False, True])
+    def test_anonymize_tables(self, quote_ident, mock_config, get_row_count, build_and_import, dry_run):
+        fields = [{'first_name': {'provider': {'name': 'clear'}}}]
+        mock_config.schema = {'tables': [
+            {'auth_user': {'fields': fields, 'unlogged': True, 'settings': {'work_mem': '1GB'}}},
+        ]}
+        mock_cursor = Mock()
+        mock_cursor.fetchone.side_effect = [('4MB', '1GB'), ('1GB', '4MB')]
+        connection = Mock()
+        connection.cursor.return_value = mock_cursor
+
+        anonymize_tables(connection, dry_run=dry_run)
+
+        assert build_and_import.call_count == 1
+        set_config = 'SELECT pg_catalog.current_setting(%s), pg_catalog.set_config(%s, %s, false)'
+        expected_execute_calls = [call(set_config, ('work_mem', 'work_mem', '1GB'))]
+        if not dry_run:
+            expected_execute_calls += [
+                call('ALTER TABLE "auth_user" SET UNLOGGED'),
+                call('ALTER TABLE "auth_user" SET LOGGED'),
+            ]
+        expected_execute_calls.append(call(set_config, ('work_mem', 'work_mem', '4MB')))
+        assert mock_cursor.execute.call_args_list == expected_execute_calls
+        connection.commit.assert_not_called()
+
+    @patch('pganonymize.utils.WorkerPool')
+    @patch('pganonymize.utils.anonymize_table', side_effect=ValueError)
+    @patch('pganonymize.utils.config')
+    def test_anonymize_tables_parallel(self, mock_config, anonymize_table, worker_pool):
+        mock_config.schema = {'tables': [{'auth_user': {'fields': [{'email': {'provider': {'name': 'clear'}}}]}}]}
+        with pytest.raises(ValueError):
+            anonymize_tables(Mock(), parallel=True)
+        table_fields = worker_pool.call_args[0][0]
+        assert [field.column_name for field in table_fields[0]] == ['email']
+        assert anonymize_table.call_args[1]['parallel'] is True
+        worker_pool.return_value.close.assert_called_once_with()
+
+
+class TestSortDefinitionsBySize(object):
+
+    @patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+    def test(self, quote_ident):
+        sizes = {'"small"': 10, '"large"': 1000, '"empty"': None, '"medium"': 100}
+        mock_cursor = Mock()
+        mock_cursor.execute.side_effect = lambda sql, args: setattr(mock_cursor, '_size', sizes[args[0]])
+        mock_cursor.fetchone.side_effect = lambda: [mock_cursor._size]
+        connection = Mock()
+        connection.cursor.return_value = mock_cursor
+        definitions = [{'small': {}}, {'empty': {}}, {'large': {}}, {'medium': {}}]
+        result = sort_definitions_by_size(connection, definitions)
+        assert result == [{'large': {}}, {'medium': {}}, {'small': {}}, {'empty': {}}]
+        assert mock_cursor.execute.call_args_list[0] == call(
+            'SELECT pg_catalog.pg_total_relation_size(%s::regclass)', ('"small"',))
+
+
+class TestGetRowCount(object):
+
+    @patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+    @pytest.mark.parametrize('search, fetched, expected, expected_execute', [
+        [None, 1234.0, 1234,
+         call('SELECT reltuples FROM pg_catalog.pg_class WHERE oid = %s::regclass', ('"auth_user"',))],
+        [None, -1.0, None,
+         call('SELECT reltuples FROM pg_catalog.pg_class WHERE oid = %s::regclass', ('"auth_user"',))],
+        ['id > 10', [{'Plan': {'Plan Rows': 42}}], 42,
+         call('EXPLAIN (FORMAT JSON) SELECT 1 FROM "auth_user" WHERE id > 10')],
+        ['id > 10', '[{"Plan": {"Plan Rows": 42}}]', 42,
+         call('EXPLAIN (FORMAT JSON) SELECT 1 FROM "auth_user" WHERE id > 10')],
+    ])
+    def test_estimate(self, quote_ident, search, fetched, expected, expected_execute):
+        mock_cursor = Mock()
+        mock_cursor.fetchone.return_value = [fetched]
+        connection = Mock()
+        connection.cursor.return_value = mock_cursor
+        assert get_row_count(connection, 'auth_user', search) == expected
+        assert mock_cursor.execute.call_args_list == [expected_execute]
+
+    @patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+    @pytest.mark.parametrize('search, expected_execute', [
+        [None, call('SELECT COUNT(*) FROM "auth_user"')],
+        ['id > 10', call('SELECT COUNT(*) FROM "auth_user" WHERE id > 10')],
+    ])
+    def test_exact(self, quote_ident, search, expected_execute):
+        mock_cursor = Mock()
+        mock_cursor.fetchone.return_value = [7]
+        connection = Mock()
+        connection.cursor.return_value = mock_cursor
+        assert get_row_count(connection, 'auth_user', search, exact=True) == 7
+        assert mock_cursor.execute.call_args_list == [expected_execute]
+
+    @pytest.mark.parametrize('exact', [False, True])
+    def test_dry_run(self, exact):
+        connection = Mock()
+        assert get_row_count(connection, 'auth_user', dry_run=True, exact=exact) == 100
+        connection.cursor.assert_not_called()
+
+
+class TestPartitions(object):
+
+    @patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+    @pytest.mark.parametrize('histogram, min_max, partitions, expected', [
+        ([1, 10, 20, 30, 40, 50, 60, 70, 80], None, 4, [20, 40, 60]),
+        ([1, 2, 3], None, 4, [2, 3]),
+        (['a', 'a', 'B', 'B', 'c', 'c', 'D', 'D', 'e'], None, 4, ['B', 'c', 'D']),
+        (['a', 'a', 'B', 'B', 'B', 'c', 'c', 'D', 'D'], None, 4, ['B', 'c']),
+        ([], (1, 100), 4, [26, 51, 76]),
+        ([], (1, 2), 4, [1, 2]),
+        ([], ('a', 'z'), 4, []),
+        ([], (None, None), 4, []),
+    ])
+    def test_get_partition_bounds(self, quote_ident, histogram, min_max, partitions, expected):
+        mock_cursor = Mock()
+        mock_cursor.fetchone.side_effect = [['integer'], min_max]
+        mock_cursor.fetchall.return_value = [[value] for value in histogram]
+        connection = Mock()
+        connection.cursor.return_value = mock_cursor
+        assert get_partition_bounds(connection, 'big', 'id', partitions) == expected
+        assert mock_cursor.execute.call_args_list[1] == call(
+            'SELECT unnest(s.histogram_bounds::text::integer[]) FROM pg_catalog.pg_stats s '
+            'JOIN pg_catalog.pg_class c ON c.relname = s.tablename '
+            'JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace AND n.nspname = s.schemaname '
+            'WHERE c.oid = %s::regclass AND s.attname = %s AND NOT s.inherited', ('"big"', 'id'))
+
+    @patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+    @patch('psycopg2.sql.Literal.as_string', autospec=True, side_effect=literal_as_string)
+    @pytest.mark.parametrize('bounds, search, expected', [
+        ([], None, [None]),
+        ([], 'active', ['(active)']),
+        ([10, 20], None, ['"id" < 10', '"id" >= 10 AND "id" < 20', '"id" >= 20']),
+        ([10], 'active', ['(active) AND "id" < 10', '(active) AND "id" >= 10']),
+    ])
+    def test_get_partition_conditions(self, literal, quote_ident, bounds, search, expected):
+        assert get_partition_conditions(Mock(), 'id', bounds, search) == expected
+
+    @pytest.mark.parametrize('partitions, jobs, expected', [
+        ([], 1, 0),
+        ([1, None], 1, 0),
+        ([1, 4], 1, 4),
+        ([1, None], 3, 3),
+        ([2, 4], 3, 15),
+    ])
+    def test_get_pool_size(self, partitions, jobs, expected):
+        definitions = [
+            {'table_{}'.format(index): {'partitions': value} if value else {}} for index, value in enumerate(partitions)
+        ]
+        assert get_pool_size(definitions, jobs) == expected
+
+    @patch('pganonymize.utils.build_and_then_import_data')
+    @patch('pganonymize.utils.get_partition_bounds', return_value=[100, 200])
+    @patch('pganonymize.utils.get_row_count', return_value=300)
+    @patch('pganonymize.utils.config')
+    @patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+    @patch('psycopg2.sql.Literal.as_string', autospec=True, side_effect=literal_as_string)
+    def test_anonymize_tables(self, literal, quote_ident, mock_config, get_row_count, get_bounds,
+                              build_and_import):
+        fields = [{'first_name': {'provider': {'name': 'clear'}}}]
+        mock_config.schema = {'tables': [{'big': {'partitions': 3, 'chunk_size': 50, 'fields': fields}}]}
+        connections = [Mock(name='connection_{}'.format(index)) for index in range(3)]
+        connection_pool = Mock()
+        connection_pool.getconn.side_effect = connections
+        connection = Mock()
+
+        anonymize_tables(connection, connection_pool=connection_pool)
+
+        get_bounds.assert_called_once_with(connection, 'big', 'id', 3)
+        assert sorted(args[0][5] for args in build_and_import.call_args_list) == [
+            '("first_name" IS NOT NULL) AND "id" < 100',
+            '("first_name" IS NOT NULL) AND "id" >= 100 AND "id" < 200',
+            '("first_name" IS NOT NULL) AND "id" >= 200',
+        ]
+        assert all(args[0][0] in connections and args[0][6] == 300 for args in build_and_import.call_args_list)
+        assert all(conn.commit.call_count == 1 for conn in connections)
+        connection.commit.assert_not_called()
+
+    @patch('pganonymize.utils.config')
+    @patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+    def test_anonymize_tables_without_pool(self, quote_ident, mock_config):
+        fields = [{'first_name': {'provider': {'name': 'clear'}}}]
+        mock_config.schema = {'tables': [{'big': {'partitions': 3, 'fields': fields}}]}
+        with pytest.raises(ValueError):
+            anonymize_tables(Mock())
+
+    @patch('pganonymize.utils.WorkerPool')
+    @patch('pganonymize.utils.config')
+    @patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+    def test_anonymize_tables_parallel(self, quote_ident, mock_config, worker_pool):
+        fields = [{'first_name': {'provider': {'name': 'clear'}}}]
+        mock_config.schema = {'tables': [{'big': {'partitions': 3, 'fields': fields}}]}
+        with pytest.raises(ValueError):
+            anonymize_tables(Mock(), parallel=True, connection_pool=Mock())
+
+    def test_get_partition_bounds_unknown_column(self):
+        mock_cursor = Mock()
+        mock_cursor.fetchone.return_value = None
+        connection = Mock()
+        connection.cursor.return_value = mock_cursor
+        with patch('psycopg2.extensions.quote_ident', side_effect=quote_ident):
+            with pytest.raises(InvalidConfiguration, match='Table "big" .* no column "uid"'):
+                get_partition_bounds(connection, 'big', 'uid', 3)
+        mock_cursor.close.assert_called_once_with()
+
+
 class TestTruncateTables(object):
 
     @patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
@@ -86,20 +362,59 @@ class TestImportData(object):
         expected = [call('COPY "public"."src_tbl" ("id", "location") FROM STDIN WITH BINARY', ANY)]
         assert mock_cursor.copy_expert.call_args_list == expected
 
+    @patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+    @patch('pgcopy.copy.util')
+    @patch('pgcopy.copy.inspect')
+    @pytest.mark.parametrize('chunk', [False, True])
+    def test_json_and_bytea(self, inspect, util, quote_ident, chunk):
+        mock_cursor = Mock()
+        copied = []
+        mock_cursor.copy_expert.side_effect = lambda sql, file: copied.append(file.read())
+        connection = Mock(encoding='UTF8')
+        connection.cursor.return_value = mock_cursor
+        Record = namedtuple('Record', 'attname,type_category,type_name,type_mod,not_null,typelem')
+        inspect.get_types.return_value = {
+            'doc': Record(attname='doc', type_category='U', type_name='jsonb', type_mod=-1, not_null=False, typelem=0),
+            'meta': Record(attname='meta', type_category='U', type_name='json', type_mod=-1, not_null=False,
+                           typelem=0),
+            'data': Record(attname='data', type_category='U', type_name='bytea', type_mod=-1, not_null=False,
+                           typelem=0),
+        }
+        column_names = ['doc', 'meta', 'data']
+        rows = [
+            [[1, 'a'], 'text', memoryview(b'\x00\x01\xff')],
+            [None, 42, None],
+            [{'key': 'value'}, None, b'\x02'],
+        ]
+        if chunk:
+            data = Chunk.from_rows(column_names, rows)
+        else:
+            data = [OrderedDict(zip(column_names, row)) for row in rows]
+
+        import_data(connection, 'public.docs', column_names, data, json_columns=['doc', 'meta'])
+
+        stream = copied[0]
+        for value in [b'\x01[1, "a"]', b'"text"', b'\x00\x00\x00\x03\x00\x01\xff', b'42', b'\x01{"key": "value"}',
+                      b'\x00\x00\x00\x01\x02']:
+            assert value in stream
+
     @patch('pganonymize.utils.CopyManager')
     @patch('pganonymize.utils.config')
+    @patch('psycopg2.sql.Literal.as_string', autospec=True, side_effect=literal_as_string)
     @patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
-    def test_anonymize_tables(self, quote_ident, mock_config, copy_manager):
+    def test_anonymize_tables(self, quote_ident, literal, mock_config, copy_manager):
         mock_cursor = Mock()
-        mock_cursor.fetchone.return_value = [2]
+        mock_cursor.fetchone.return_value = [[{'Plan': {'Plan Rows': 2}}]]
         mock_cursor.fetchmany.side_effect = [
             [
-                OrderedDict([('first_name', None), ('json_column', None)]),
-                OrderedDict([('first_name', 'exclude me'), ('json_column', {'field1': 'foo'})]),
-                OrderedDict([('first_name', 'John Doe'), ('json_column', {'field1': 'foo'})]),
-                OrderedDict([('first_name', 'John Doe'), ('json_column', {'field2': 'bar'})])
-            ]
+                (1, None, None),
+                (2, 'exclude me', {'field1': 'foo'}),
+                (3, 'John Doe', {'field1': 'foo'}),
+                (4, 'John Doe', {'field2': 'bar'}),
+            ],
+            [],
         ]
+        mock_cursor.fetchall.return_value = []
         cmm = Mock()
         copy_manager.return_value = cmm
         copy_manager.copy.return_value = []
@@ -157,8 +472,87 @@ class TestImportData(object):
         assert connection.cursor.call_count == mock_cursor.close.call_count
         assert copy_manager.call_args_list == [call(connection, 'tmp_auth_user', ['id', 'first_name', 'json_column'])]
         assert cmm.copy.call_count == 1
-        assert cmm.copy.call_args_list == [call([['dummy nameappend-me', b'{"field1": "dummy json field1"}'],
-                                                 ['dummy nameappend-me', b'{"field2": "dummy json field2"}']])]
+        # The excluded rows and the rows without any value are filtered by PostgreSQL
+        assert call(
+            'SELECT "id", "first_name", "json_column" FROM "auth_user" WHERE (first_name == "John") '
+            'AND NOT (coalesce("first_name" ~* \'^(?:exclude)\', false)) '
+            'AND ("first_name" IS NOT NULL OR "json_column" IS NOT NULL)'
+        ) in mock_cursor.execute.call_args_list
+        assert cmm.copy.call_args_list == [call([(2, 'dummy nameappend-me', b'{"field1": "dummy json field1"}'),
+                                                 (3, 'dummy nameappend-me', b'{"field1": "dummy json field1"}'),
+                                                 (4, 'dummy nameappend-me', b'{"field2": "dummy json field2"}')])]
+
+    @patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+    @patch('pganonymize.utils.build_and_then_import_data')
+    @patch('pganonymize.utils.get_row_count', return_value=10)
+    @patch('pganonymize.utils.sort_definitions_by_size', side_effect=lambda connection, definitions: definitions[::-1])
+    @patch('pganonymize.utils.config')
+    @pytest.mark.parametrize('dry_run', [False, True])
+    def test_anonymize_tables_concurrently(self, mock_config, sort_definitions, get_row_count, build_and_import,
+                                           quote_ident, dry_run):
+        fields = [{'first_name': {'provider': {'name': 'clear'}}}]
+        definitions = [{'table_{}'.format(index): {'fields': fields}} for index in range(4)]
+        mock_config.schema = {'tables': definitions}
+        connections = [Mock(name='connection_{}'.format(index)) for index in range(2)]
+        connection_pool = Mock()
+        connection_pool.getconn.side_effect = connections * 2
+        connection = Mock()
+
+        anonymize_tables(connection, dry_run=dry_run, jobs=2, connection_pool=connection_pool)
+
+        sort_definitions.assert_called_once_with(connection, definitions)
+        assert sorted(args[0][1] for args in build_and_import.call_args_list) == [
+            'table_0', 'table_1', 'table_2', 'table_3'
+        ]
+        assert all(args[0][0] in connections for args in build_and_import.call_args_list)
+        assert connection_pool.putconn.call_count == 4
+        committed = sum(conn.commit.call_count for conn in connections)
+        rolled_back = sum(conn.rollback.call_count for conn in connections)
+        assert (committed, rolled_back) == ((0, 4) if dry_run else (4, 0))
+        connection.commit.assert_not_called()
+
+    @patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+    @patch('pganonymize.utils.build_and_then_import_data', side_effect=RuntimeError('Boom'))
+    @patch('pganonymize.utils.get_row_count', return_value=10)
+    @patch('pganonymize.utils.sort_definitions_by_size', side_effect=lambda connection, definitions: definitions)
+    @patch('pganonymize.utils.config')
+    def test_anonymize_tables_concurrently_error(self, mock_config, sort_definitions, get_row_count,
+                                                 build_and_import, quote_ident):
+        mock_config.schema = {'tables': [{'table_a': {'fields': [{'first_name': {'provider': {'name': 'clear'}}}]}}]}
+        pooled_connection = Mock()
+        connection_pool = Mock()
+        connection_pool.getconn.return_value = pooled_connection
+        with pytest.raises(RuntimeError):
+            anonymize_tables(Mock(), jobs=2, connection_pool=connection_pool)
+        pooled_connection.rollback.assert_called_once()
+        pooled_connection.commit.assert_not_called()
+        connection_pool.putconn.assert_called_once_with(pooled_connection)
+
+
+@patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+class TestGetCopyColumnTypes(object):
+
+    def test(self, quote_ident):
+        mock_cursor = Mock()
+        mock_cursor.fetchall.return_value = [('id', 'int4', 'integer', True), ('tags', '_text', 'text[]', True),
+                                             ('doc', 'jsonb', 'jsonb', True)]
+        connection = Mock()
+        connection.cursor.return_value = mock_cursor
+        column_types = get_copy_column_types(connection, ('public', 'docs'), ['id', 'tags', 'doc'])
+        assert list(column_types.items()) == [('id', 'int4'), ('tags', '_text'), ('doc', 'jsonb')]
+        assert get_json_columns(column_types) == ['doc']
+        args = mock_cursor.execute.call_args[0][1]
+        assert 'jsonb' in args[0] and 'inet' not in args[0]
+        assert args[1:] == ('"public"."docs"', ['id', 'tags', 'doc'])
+
+    def test_unsupported_types(self, quote_ident):
+        mock_cursor = Mock()
+        mock_cursor.fetchall.return_value = [('id', 'int4', 'integer', True), ('ip', 'inet', 'inet', False),
+                                             ('duration', 'interval', 'interval', False)]
+        connection = Mock()
+        connection.cursor.return_value = mock_cursor
+        with pytest.raises(InvalidConfiguration, match=r'Table "sessions" .* ip \(inet\), duration \(interval\)'):
+            get_copy_column_types(connection, 'sessions', ['id', 'ip', 'duration'])
 
 
 class TestBuildAndThenImport(object):
@@ -169,15 +563,16 @@ class TestBuildAndThenImport(object):
                            {'COL2': {'provider': {'name': 'md5'}}}], 10, 3]
     ])
     def test(self, quote_ident, copy_manager, table, primary_key, columns, total_count, chunk_size):
-        fake_record = dict.fromkeys([list(definition.keys())[0] for definition in columns], '')
+        fake_record = ('',) * (len(columns) + 1)
         records = [
             [fake_record for row in range(0, chunk_size + 1)]
             for x in range(0, int(math.ceil(total_count / chunk_size + 1)))
         ]
 
         mock_cursor = Mock()
-        mock_cursor.fetchmany.side_effect = records
+        mock_cursor.fetchmany.side_effect = records + [[]]
         mock_cursor.fetchone.return_value = [{}]
+        mock_cursor.fetchall.return_value = [('COL2',)]
 
         connection = Mock()
         connection.cursor.return_value = mock_cursor
@@ -188,12 +583,149 @@ class TestBuildAndThenImport(object):
             call('SELECT "id", "col1", "COL2" FROM "src_tbl"'),
             call('CREATE TEMP TABLE "tmp_src_tbl" AS SELECT "id", "col1", "COL2" FROM "src_tbl" WITH NO DATA'),
             call('CREATE INDEX ON "tmp_src_tbl" ("id")'),
-            call('UPDATE "src_tbl" t SET "col1" = s."col1", "COL2" = s."COL2" FROM "tmp_src_tbl" s '
-                 'WHERE t."id" = s."id"'),
+            call('SELECT a.attname FROM pg_catalog.pg_attribute a '
+                 'WHERE a.attrelid = %s::regclass AND a.attname = ANY(%s) AND NOT EXISTS ('
+                 "SELECT 1 FROM pg_catalog.pg_operator o WHERE o.oprname = '=' "
+                 'AND o.oprleft = a.atttypid AND o.oprright = a.atttypid)', ('"src_tbl"', ['col1', 'COL2'])),
+            call('UPDATE "src_tbl" t SET '
+                 '"col1" = CASE WHEN t."col1" IS DISTINCT FROM s."col1" THEN s."col1" ELSE t."col1" END, '
+                 '"COL2" = CASE WHEN t."COL2"::text IS DISTINCT FROM s."COL2"::text THEN s."COL2" ELSE t."COL2" END '
+                 'FROM "tmp_src_tbl" s WHERE t."id" = s."id" AND '
+                 '(t."col1" IS DISTINCT FROM s."col1" OR t."COL2"::text IS DISTINCT FROM s."COL2"::text)'),
             call('DROP TABLE IF EXISTS "tmp_src_tbl"'),
         ]
         assert mock_cursor.execute.call_args_list == expected_execute_calls
 
+    @patch('psycopg2.sql.Literal.as_string', autospec=True, side_effect=literal_as_string)
+    @patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+    @patch('pganonymize.utils.CopyManager')
+    @pytest.mark.parametrize('pipeline_depth', [0, 2])
+    def test_batch_commit(self, copy_manager, quote_ident, literal, pipeline_depth):
+        columns = [{'name': {'provider': {'name': 'md5'}}}]
+        mock_cursor = Mock()
+        mock_cursor.fetchall.side_effect = fetch_batch_rows(mock_cursor, [
+            [{'id': 1, 'name': 'a'}, {'id': 2, 'name': 'b'}],
+            [{'id': 5, 'name': 'c'}],
+        ])
+        connection = Mock()
+        connection.cursor.return_value = mock_cursor
+
+        build_and_then_import_data(connection, 'src_tbl', 'id', columns, None, 'id < 10', 3, 2,
+                                   pipeline_depth=pipeline_depth, batch_commit=True)
+
+        update_call = call(
+            'UPDATE "src_tbl" t SET "name" = CASE WHEN t."name" IS DISTINCT FROM s."name" THEN s."name" ELSE t."name" '
+            'END FROM "tmp_src_tbl" s WHERE t."id" = s."id" AND (t."name" IS DISTINCT FROM s."name")')
+        truncate_call = call('TRUNCATE TABLE "tmp_src_tbl"')
+        select_calls = [
+            call('SELECT "id", "name" FROM "src_tbl" WHERE (id < 10) ORDER BY "id" LIMIT 2'),
+            call('SELECT "id", "name" FROM "src_tbl" WHERE (id < 10) AND "id" > 2 ORDER BY "id" LIMIT 2'),
+            call('SELECT "id", "name" FROM "src_tbl" WHERE (id < 10) AND "id" > 5 ORDER BY "id" LIMIT 2'),
+        ]
+        execute_calls = mock_cursor.execute.call_args_list
+        assert execute_calls[0] == call(
+            'CREATE TEMP TABLE "tmp_src_tbl" AS SELECT "id", "name" FROM "src_tbl" WITH NO DATA')
+        assert [c for c in execute_calls if c[0][0].startswith('SELECT "id"')] == select_calls
+        assert execute_calls.count(update_call) == 2
+        assert execute_calls.count(truncate_call) == 2
+        assert execute_calls[-1] == call('DROP TABLE IF EXISTS "tmp_src_tbl"')
+        assert connection.commit.call_count == 2
+        assert copy_manager.return_value.copy.call_count == 2
+
+    @patch('psycopg2.sql.Literal.as_string', autospec=True, side_effect=literal_as_string)
+    @patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+    @patch('pganonymize.utils.CopyManager')
+    @patch('pganonymize.utils.get_column_decoders', return_value=[Mock(), Mock()])
+    @patch('pganonymize.utils.CopyCursor')
+    @pytest.mark.parametrize('pipeline_depth', [0, 2])
+    def test_binary_copy(self, copy_cursor, get_column_decoders, copy_manager, quote_ident, literal, pipeline_depth):
+        columns = [{'name': {'provider': {'name': 'md5'}}}]
+        mock_cursor = Mock()
+        mock_cursor.fetchall.return_value = []
+        connection = Mock()
+        connection.cursor.return_value = mock_cursor
+        mock_copy_cursor = copy_cursor.return_value
+        mock_copy_cursor.fetchall.side_effect = fetch_batch_rows(mock_copy_cursor, [
+            [(1, 'a'), (2, 'b')],
+            [(5, 'c')],
+        ])
+
+        build_and_then_import_data(connection, 'src_tbl', 'id', columns, None, None, 3, 2, binary_copy=True,
+                                   pipeline_depth=pipeline_depth)
+
+        # Every batch is read with a COPY of its own, so the rows are imported on the same connection in between
+        assert mock_copy_cursor.execute.call_args_list == [
+            call('SELECT "id", "name" FROM "src_tbl" ORDER BY "id" LIMIT 2'),
+            call('SELECT "id", "name" FROM "src_tbl" WHERE "id" > 2 ORDER BY "id" LIMIT 2'),
+            call('SELECT "id", "name" FROM "src_tbl" WHERE "id" > 5 ORDER BY "id" LIMIT 2'),
+        ]
+        assert not mock_copy_cursor.fetchmany.called
+        assert copy_manager.return_value.copy.call_count == 2
+        assert mock_cursor.execute.call_args_list[-2][0][0].startswith('UPDATE "src_tbl" t SET')
+        assert not connection.commit.called
+
+    @patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+    @patch('pganonymize.utils.CopyManager')
+    @patch('pganonymize.utils.CopyCursor')
+    def test_binary_copy_ctid(self, copy_cursor, copy_manager, quote_ident):
+        columns = [{'email': {'provider': {'name': 'md5'}}}]
+        mock_cursor = Mock()
+        mock_cursor.fetchmany.side_effect = [[('(0,1)', 'foo@example.com')], []]
+        mock_cursor.fetchall.return_value = []
+        connection = Mock()
+        connection.cursor.return_value = mock_cursor
+
+        build_and_then_import_data(connection, 'events', 'ctid', columns, None, None, 1, 10, binary_copy=True)
+
+        assert not copy_cursor.called
+        assert mock_cursor.execute.call_args_list[0] == call('SELECT ctid::text AS "pga_ctid", "email" FROM "events"')
+        assert copy_manager.return_value.copy.call_count == 1
+
+    @patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+    @patch('pganonymize.utils.CopyManager')
+    def test_ctid(self, copy_manager, quote_ident):
+        columns = [{'email': {'provider': {'name': 'md5'}}}]
+        mock_cursor = Mock()
+        mock_cursor.fetchmany.side_effect = [[('(0,1)', 'foo@example.com')], []]
+        mock_cursor.fetchall.return_value = []
+        connection = Mock()
+        connection.cursor.return_value = mock_cursor
+
+        build_and_then_import_data(connection, 'events', 'ctid', columns, None, None, 1, 10)
+
+        executed = [args[0][0] for args in mock_cursor.execute.call_args_list]
+        assert executed[:2] == [
+            'SELECT ctid::text AS "pga_ctid", "email" FROM "events"',
+            'CREATE TEMP TABLE "tmp_events" AS SELECT ctid::text AS "pga_ctid", "email" FROM "events" WITH NO DATA',
+        ]
+        assert not any(sql.startswith('CREATE INDEX') for sql in executed)
+        assert executed[-2].endswith('FROM "tmp_events" s WHERE t.ctid = s."pga_ctid"::tid AND '
+                                     '(t."email" IS DISTINCT FROM s."email")')
+        assert copy_manager.call_args == call(connection, 'tmp_events', ['pga_ctid', 'email'])
+        assert copy_manager.return_value.copy.call_args == call([('(0,1)', 'b48def645758b95537d4424c84d1a9ff')])
+
+    @patch('psycopg2.sql.Literal.as_string', autospec=True, side_effect=literal_as_string)
+    @patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+    @patch('pganonymize.utils.CopyManager')
+    def test_composite_primary_key(self, copy_manager, quote_ident, literal):
+        columns = [{'name': {'provider': {'name': 'md5'}}}]
+        mock_cursor = Mock()
+        mock_cursor.fetchall.side_effect = fetch_batch_rows(mock_cursor, [[{'a': 1, 'b': 'x', 'name': 'foo'}]])
+        connection = Mock()
+        connection.cursor.return_value = mock_cursor
+
+        build_and_then_import_data(connection, 'comp', ['a', 'b'], columns, None, None, 1, 10, batch_commit=True,
+                                   checkpoint='', start='["0", "y"]')
+
+        executed = [args[0] for args in mock_cursor.execute.call_args_list]
+        assert executed[0] == ('CREATE TEMP TABLE "tmp_comp" AS SELECT "a", "b", "name" FROM "comp" WITH NO DATA',)
+        assert executed[1] == ('SELECT "a", "b", "name" FROM "comp" WHERE ("a", "b") > (\'0\', \'y\') '
+                               'ORDER BY "a", "b" LIMIT 10',)
+        assert ' WHERE t."a" = s."a" AND t."b" = s."b" AND ' in executed[3][0]
+        assert executed[5][1] == ('comp', '', '["1", "x"]')
+        assert executed[6] == ('SELECT "a", "b", "name" FROM "comp" WHERE ("a", "b") > (1, \'x\') '
+                               'ORDER BY "a", "b" LIMIT 10',)
+
     @patch('pganonymize.utils.CopyManager')
     def test_column_format(self, copy_manager):
         columns = [
@@ -235,37 +767,733 @@ class TestBuildAndThenImport(object):
         assert result == expected
 
 
-class TestCreateDatabaseDump(object):
+class TestTablePlan(object):
 
-    @patch('pganonymize.utils.subprocess.call')
-    def test(self, mock_call):
-        filename = '/tmp/dump.gz'
-        db_args = {'dbname': 'database', 'user': 'foo', 'host': 'localhost', 'port': 5432}
-        dump_args = '--format custom --compress 9'
-        create_database_dump(filename, db_args, dump_args)
-        mock_call.assert_called_once_with(
-            'pg_dump --format custom --compress 9 --dbname database --username foo --host localhost --port 5432 --file /tmp/dump.gz',  # noqa
-            shell=True,
+    def test_compile_table_plan(self):
+        columns = [
+            {'email': {'provider': {'name': 'md5'}, 'append': '@localhost'}},
+            {'data.user.name': {'provider': {'name': 'set', 'value': 'foo'}, 'format': '{pga_value}-{id}-{data[x]}'}},
+        ]
+        excludes = [{'email': ['.*@example.com']}]
+        plan = compile_table_plan(columns, excludes)
+        assert plan.excludes.rules == [('email', '.*@example.com')]
+        email, name = plan.fields
+        assert email == FieldPlan(
+            path='email', column_name='email', keys=None, provider_class=MD5Provider,
+            provider_config={'name': 'md5'}, append='@localhost', format=None, format_fields=(),
         )
+        assert name.path == 'data.user.name'
+        assert name.column_name == 'data'
+        assert name.keys == ('data', 'user', 'name')
+        assert name.provider_class is SetProvider
+        assert sorted(name.format_fields) == ['data', 'id']
+
+    def test_compile_unknown_provider(self):
+        with pytest.raises(InvalidProvider):
+            compile_table_plan([{'email': {'provider': {'name': 'unknown'}}}])
 
-    @patch('pganonymize.utils.subprocess.call')
-    def test_with_password(self, mock_call):
-        filename = '/tmp/dump.gz'
-        db_args = {'dbname': 'database', 'user': 'foo', 'host': 'localhost', 'port': 5432, 'password': 'pass'}
-        dump_args = '--format custom --compress 9'
-        create_database_dump(filename, db_args, dump_args)
-        mock_call.assert_called_once_with(
-            'PGPASSWORD=pass pg_dump --format custom --compress 9 --dbname database --username foo --host localhost --port 5432 --file /tmp/dump.gz',  # noqa
-            shell=True,
+    @pytest.mark.parametrize('row, expected', [
+        [{'id': 1, 'email': 'jane@example.com', 'data': {'user': {'name': 'Jane'}}}, None],
+        [{'id': 2, 'email': None, 'data': None}, None],
+        [
+            {'id': 3, 'email': 'john@doe.org', 'data': {'user': {'name': 'John'}}},
+            {'id': 3, 'email': 'bc6a715808d9aae0ddeefb1e47e482a6@localhost', 'data': {'user': {'name': 'foo-3'}}},
+        ],
+        [
+            {'id': 4, 'email': None, 'data': {'user': 'John'}},
+            None,
+        ],
+    ])
+    def test_process_row(self, row, expected):
+        columns = [
+            {'email': {'provider': {'name': 'md5'}, 'append': '@localhost'}},
+            {'data.user.name': {'provider': {'name': 'set', 'value': 'foo'}, 'format': '{pga_value}-{id}'}},
+        ]
+        plan = compile_table_plan(columns, [{'email': ['.*@example.com']}])
+        assert process_row(row, plan) == expected
+
+
+class TestApplyFieldPlansToChunk(object):
+
+    def test(self):
+        columns = [
+            {'email': {'provider': {'name': 'md5'}, 'append': '@localhost'}},
+            {'data.user.name': {'provider': {'name': 'set', 'value': 'foo'}, 'format': '{pga_value}-{id}-{email}'}},
+            {'login': {'provider': {'name': 'mask'}}},
+        ]
+        fields = compile_table_plan(columns).fields
+        records = [
+            {'id': 1, 'email': 'jane@example.com', 'data': {'user': {'name': 'Jane'}}, 'login': 'jane'},
+            {'id': 2, 'email': None, 'data': {'user': {}}, 'login': None},
+            {'id': 3, 'email': None, 'data': None, 'login': 'john'},
+        ]
+        expected = []
+        for record in records:
+            row = json.loads(json.dumps(record))
+            expected.append(row if apply_field_plans(row, fields) else None)
+        chunk = apply_field_plans_to_chunk(Chunk.from_rows(['id', 'email', 'data', 'login'], records), fields)
+        assert chunk.altered == [True, False, True]
+        assert [chunk.row(index) if altered else None for index, altered in enumerate(chunk.altered)] == expected
+        assert expected[0]['data']['user']['name'] == 'foo-1-9e26471d35a78862c17e467d87cddedf@localhost'
+        assert expected[1] is None
+
+    @patch('pganonymize.providers.MD5Provider.alter_values', return_value=['a', 'b'])
+    def test_batch_call(self, alter_values):
+        fields = compile_table_plan([{'email': {'provider': {'name': 'md5'}}}]).fields
+        chunk = Chunk(['email'], [['x', None, 'y', 'z']])
+        apply_field_plans_to_chunk(chunk, fields, indexes=[0, 1, 2])
+        alter_values.assert_called_once_with(['x', 'y'], name='md5')
+        assert chunk.column('email') == ['a', None, 'b', 'z']
+        assert chunk.altered == [True, False, True, False]
+
+
+class TestUniqueValues(object):
+
+    @patch('pganonymize.providers.FakeProvider.alter_value', side_effect=['b', 'c'])
+    def test_deduplicate(self, alter_value, caplog):
+        plan = compile_table_plan([
+            {'email': {'provider': {'name': 'fake.unique.user_name'}, 'append': '@x'}},
+            {'name': {'provider': {'name': 'set', 'value': 'foo'}}},
+        ])
+        uniques = plan.uniques
+        assert [field.column_name for field in uniques.fields] == ['email']
+        chunk = Chunk(['email', 'name'], [['a@x', 'b@x', None, 'a@x'], ['1', '2', '3', '4']])
+        uniques.deduplicate(chunk, [0, 1, 2, 3])
+        assert chunk.column('email') == ['a@x', 'b@x', None, 'c@x']
+        assert alter_value.call_args_list == [call('a@x', name='fake.user_name'), call('b@x', name='fake.user_name')]
+        assert uniques.counts == [3]
+        assert uniques.retries == [2]
+        with caplog.at_level(logging.INFO):
+            uniques.log_counts('auth_user')
+        assert 'Unique field email of table auth_user: generated 2 of 3 values again (66.67%)' in caplog.text
+
+    @patch('pganonymize.utils.MAX_UNIQUE_RETRIES', 2)
+    @patch('pganonymize.providers.FakeProvider.alter_value', return_value='a')
+    def test_deduplicate_error(self, alter_value):
+        uniques = compile_table_plan([{'email': {'provider': {'name': 'fake.unique.user_name'}}}]).uniques
+        with pytest.raises(UniquenessError, match='after 2 retries for field email'):
+            uniques.deduplicate(Chunk(['email'], [['a', 'a']]), [0, 1])
+        assert alter_value.call_count == 2
+
+
+class TestExcludeMatcher(object):
+
+    EXCLUDES = [
+        {'email': ['\\S.*@example.com', '\\S.*@foobar.com']},
+        {'username': ['(admin|root)$']},
+        {'email': ['support@.*']},
+    ]
+
+    @pytest.mark.parametrize('row, expected', [
+        [{'email': 'Jane@Example.com', 'username': 'jane'}, 0],
+        [{'email': 'john@foobar.com', 'username': 'admin'}, 1],
+        [{'email': 'support@localhost', 'username': 'john'}, 2],
+        [{'email': None, 'username': 'root'}, 3],
+        [{'email': 'john@doe.org', 'username': 'administrator'}, None],
+        [{'email': None, 'username': None}, None],
+    ])
+    def test_match(self, row, expected):
+        matcher = ExcludeMatcher(self.EXCLUDES)
+        assert matcher.rules == [
+            ('email', '\\S.*@example.com'),
+            ('email', '\\S.*@foobar.com'),
+            ('email', 'support@.*'),
+            ('username', '(admin|root)$'),
+        ]
+        assert matcher.match(row) == expected
+        assert matcher.counts == [int(index == expected) for index in range(4)]
+
+    def test_compile_exclude_patterns(self):
+        regexes = compile_exclude_patterns(['a.*', 'b.*', 'c.*'])
+        assert len(regexes) == 1
+        assert regexes[0][1] is None
+        assert [index for regex, index in compile_exclude_patterns(['a.*', '(?s)b.*'])] == [0, 1]
+        assert [index for regex, index in compile_exclude_patterns(['(a)\\1', 'b.*'])] == [0, 1]
+
+    @patch('pganonymize.utils.logging')
+    def test_log_counts(self, mock_logging):
+        matcher = ExcludeMatcher([{'email': ['.*@example.com']}])
+        matcher.match({'email': 'jane@example.com'})
+        matcher.log_counts('auth_user')
+        mock_logging.info.assert_called_once_with(
+            'Exclude rule ".*@example.com" on column email of table auth_user matched 1 rows')
+
+    @patch('pganonymize.utils.logging')
+    def test_log_sql_excludes(self, mock_logging):
+        log_sql_excludes('auth_user', self.EXCLUDES, [{'email': ['\\S.*@foobar.com']}])
+        assert mock_logging.info.call_args_list == [
+            call('Exclude rule "{}" on column {} of table auth_user was evaluated by PostgreSQL, its matches are not '
+                 'counted'.format(pattern, column))
+            for column, pattern in [('email', '\\S.*@example.com'), ('username', '(admin|root)$'),
+                                    ('email', 'support@.*')]
+        ]
+
+    def test_included_indexes(self):
+        matcher = ExcludeMatcher(self.EXCLUDES)
+        chunk = Chunk(['email', 'username'], [
+            ['jane@example.com', 'support@localhost', None, 'john@doe.org', 'root@example.com'],
+            ['jane', 'john', 'root', 'john', 'root'],
+        ])
+        assert matcher.included_indexes(chunk) == [3]
+        assert matcher.counts == [2, 0, 1, 1]
+
+    @pytest.mark.parametrize('parallel', [False, True])
+    def test_process_chunk(self, parallel):
+        plan = compile_table_plan([{'email': {'provider': {'name': 'set', 'value': 'foo'}}}],
+                                  [{'email': ['.*@example.com']}])
+        chunk = Chunk(['id', 'email'], [[1, 2, 3, 4], ['jane@example.com', 'john@doe.org', None, 'jim@doe.org']])
+        worker_pool = WorkerPool([plan.fields], processes=2) if parallel else None
+        try:
+            with patch.object(WorkerPool, 'map', autospec=True, side_effect=WorkerPool.map) as worker_map:
+                assert process_chunk(chunk, plan, parallel=parallel) is chunk
+        finally:
+            if worker_pool is not None:
+                worker_pool.close()
+        assert chunk.column('email') == ['jane@example.com', 'foo', None, 'foo']
+        assert chunk.altered == [False, True, False, True]
+        assert plan.excludes.counts == [1]
+        if parallel:
+            slices = worker_map.call_args[0][2]
+            assert [(part.column_names, len(part)) for part in slices] == [(['email'], 2), (['email'], 1)]
+        else:
+            assert not worker_map.called
+
+
+class TestWorkerPool(object):
+
+    @pytest.mark.parametrize('share_chunks', [False, True])
+    def test_map(self, share_chunks):
+        fields = compile_table_plan([{'email': {'provider': {'name': 'md5'}, 'format': '{pga_value}-{id}'}}]).fields
+        other_fields = compile_table_plan([{'email': {'provider': {'name': 'set', 'value': 'foo'}}}]).fields
+        worker_pool = WorkerPool([fields], processes=2, share_chunks=share_chunks)
+        try:
+            assert WorkerPool.active is worker_pool
+            chunks = [Chunk(['email', 'id'], [['a', None], [1, 2]]), Chunk(['email', 'id'], [['c'], [3]])]
+            results = worker_pool.map(fields, chunks)
+            assert [result.column_names for result in results] == [['email'], ['email']]
+            assert [result.column('email') for result in results] == [
+                [MD5Provider.alter_value('a') + '-1', None], [MD5Provider.alter_value('c') + '-3']]
+            assert [result.altered for result in results] == [[True, False], [True]]
+            assert [result.column('email') for result in worker_pool.map(other_fields, chunks)] == [
+                ['foo', None], ['foo']]
+        finally:
+            worker_pool.close()
+        assert WorkerPool.active is None
+
+    @patch('pganonymize.utils.config')
+    @patch('pganonymize.utils.faker_initializer')
+    def test_init_worker(self, faker_initializer, mock_config):
+        fields = compile_table_plan([{'email': {'provider': {'name': 'set', 'value': 'foo'}}}]).fields
+        init_worker({'tables': []}, [fields])
+        assert mock_config._schema == {'tables': []}
+        chunk = apply_worker_fields((0, None, Chunk(['email'], [['a']]), 42))
+        assert chunk.column('email') == ['foo']
+        faker_initializer.seed.assert_called_once_with(42)
+
+    def test_unique_values(self):
+        plan = compile_table_plan([{'number': {'provider': {'name': 'fake.unique.random_int',
+                                                            'kwargs': {'min': 1, 'max': 60}}}}])
+
+        def anonymize(seed):
+            worker_pool = WorkerPool([plan.fields], processes=2, seed=seed)
+            try:
+                chunk = Chunk(['number'], [list(range(40))])
+                return process_chunk(chunk, plan, parallel=True).column('number')
+            finally:
+                worker_pool.close()
+
+        numbers = anonymize(7)
+        assert len(set(numbers)) == 40
+        assert plan.uniques.counts == [40]
+        plan.uniques.values[0].clear()
+        assert anonymize(7) == numbers
+
+    def test_get_table_fields(self):
+        definitions = [{'auth_user': {'fields': [{'email': {'provider': {'name': 'clear'}}}]}}, {'empty': {}}]
+        table_fields = get_table_fields(definitions)
+        assert [[field.column_name for field in fields] for fields in table_fields] == [['email'], []]
+
+
+class TestPushdown(object):
+
+    @pytest.mark.parametrize('pattern, expected', [
+        ['\\S[^@]*@example\\.com', '^(?:\\S[^@]*@example\\.com)'],
+        ['.*test$', '^(?:[^\\n]*test\\n?$)'],
+        ['foo|ba[]r]{2,3}', '^(?:foo|ba[]r]{2,3})'],
+        ['(?:foo)+?', '^(?:(?:foo)+?)'],
+        ['\\bfoo', None],
+        ['(?P<name>foo)', None],
+        ['(?i)foo', None],
+        ['[[:alpha:]]', None],
+        ['[\\S]', None],
+        ['foo{', None],
+        ['a*+', None],
+        ['[abc', None],
+    ])
+    def test_translate_exclude_pattern(self, pattern, expected):
+        assert translate_exclude_pattern(pattern) == expected
+
+    @patch('psycopg2.sql.Literal.as_string', autospec=True, side_effect=literal_as_string)
+    @patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+    def test_get_pushdown_columns(self, quote_ident, literal):
+        columns = [
+            {'first_name': {'provider': {'name': 'fake.first_name'}}},
+            {'email': {'provider': {'name': 'md5'}, 'append': '@localhost'}},
+            {'phone': {'provider': {'name': 'md5'}, 'format': '{pga_value}-{id}'}},
+            {'data.key': {'provider': {'name': 'clear'}}},
+            {'title': {'provider': {'name': 'clear'}, 'append': '!'}},
+            {'code': {'provider': {'name': 'mask'}, 'format': '{pga_value:>10}'}},
+        ]
+        pushdown_columns, remaining_columns = get_pushdown_columns(columns, 'id')
+        assert [(name, expression.as_string(Mock())) for name, expression in pushdown_columns] == [
+            ('email', '(md5("email") || \'@localhost\')'),
+            ('phone', '((md5("phone"))::text || \'-\' || "id"::text)'),
+        ]
+        assert remaining_columns == [columns[0], columns[3], columns[4], columns[5]]
+
+    @pytest.mark.parametrize('columns, excludes', [
+        [[{'email': {'provider': {'name': 'md5'}}}], [{'email': ['\\bfoo']}]],
+        [[{'email': {'provider': {'name': 'md5'}}},
+          {'login': {'provider': {'name': 'set', 'value': 'foo'}, 'format': '{pga_value}-{email}'}}], []],
+    ])
+    def test_get_pushdown_columns_not_possible(self, columns, excludes):
+        assert get_pushdown_columns(columns, 'id', excludes) == ([], columns)
+
+    def test_split_excludes(self):
+        excludes = [{'email': ['.*@example.com', '\\b.*@test']}, {'login': ['(?i)admin']}, {'phone': None}]
+        assert split_excludes(excludes) == (
+            [{'email': ['.*@example.com']}],
+            [{'email': ['\\b.*@test']}, {'login': ['(?i)admin']}],
         )
 
-    @patch('pganonymize.utils.subprocess.call')
-    def test_with_custom_dump_args(self, mock_call):
-        filename = '/tmp/dump.gz'
-        db_args = {'dbname': 'database', 'user': 'foo', 'host': 'localhost', 'port': 5432}
-        dump_args = '--format plain'
-        create_database_dump(filename, db_args, dump_args)
-        mock_call.assert_called_once_with(
-            'pg_dump --format plain --dbname database --username foo --host localhost --port 5432 --file /tmp/dump.gz',  # noqa
-            shell=True,
+    @patch('psycopg2.sql.Literal.as_string', autospec=True, side_effect=literal_as_string)
+    @patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+    @pytest.mark.parametrize('search, columns, excludes, expected', [
+        [None, [], [], (None, [])],
+        ['active', [], [{'email': ['\\bfoo']}], ('(active)', [{'email': ['\\bfoo']}])],
+        [None, [{'email': {'provider': {'name': 'md5'}}}, {'data.phone': {'provider': {'name': 'clear'}}},
+                {'data.email': {'provider': {'name': 'clear'}}}], [],
+         ('("email" IS NOT NULL OR "data" IS NOT NULL)', [])],
+        ['active', [{'email': {'provider': {'name': 'md5'}}}], [{'email': ['admin@', '\\bfoo']}],
+         ('(active) AND NOT (coalesce("email" ~* \'^(?:admin@)\', false)) AND "email" IS NOT NULL',
+          [{'email': ['\\bfoo']}])],
+    ])
+    def test_get_fetch_condition(self, quote_ident, literal, search, columns, excludes, expected):
+        assert get_fetch_condition(Mock(), search, columns, excludes) == expected
+
+    @patch('pganonymize.utils.build_and_then_import_data')
+    @patch('pganonymize.utils.config')
+    @patch('psycopg2.sql.Literal.as_string', autospec=True, side_effect=literal_as_string)
+    @patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+    @pytest.mark.parametrize('dry_run', [False, True])
+    def test_anonymize_tables(self, quote_ident, literal, mock_config, build_and_import, dry_run, caplog):
+        mock_cursor = Mock()
+        mock_cursor.fetchone.return_value = [[{'Plan': {'Plan Rows': 100}}]]
+        connection = Mock()
+        connection.cursor.return_value = mock_cursor
+        mock_config.schema = {'tables': [{
+            'auth_user': {
+                'fields': [
+                    {'first_name': {'provider': {'name': 'fake.first_name'}}},
+                    {'last_name': {'provider': {'name': 'set', 'value': 'Bar'}}},
+                ],
+                'excludes': [{'email': ['admin@']}],
+                'search': 'id > 10',
+            }
+        }]}
+        with caplog.at_level(logging.INFO):
+            anonymize_tables(connection, pushdown=True, dry_run=dry_run)
+
+        assert ('Exclude rule "admin@" on column email of table auth_user was evaluated by PostgreSQL, its matches are '
+                'not counted') in caplog.text
+        expected_search = '(id > 10) AND NOT (coalesce("email" ~* \'^(?:admin@)\', false))'
+        assert build_and_import.call_args == call(
+            connection, 'auth_user', 'id', [{'first_name': {'provider': {'name': 'fake.first_name'}}}], [],
+            '(' + expected_search + ') AND "first_name" IS NOT NULL', 100, ANY, verbose=False, dry_run=dry_run,
+            parallel=False, binary_copy=False, pipeline_depth=0, batch_commit=False, checkpoint=None, start=None,
         )
+        expected_update = ('UPDATE "auth_user" SET "last_name" = CASE WHEN "last_name" IS NULL THEN "last_name" '
+                           'ELSE \'Bar\' END WHERE ' + expected_search)
+        if dry_run:
+            expected_update = 'EXPLAIN ' + expected_update
+        assert mock_cursor.execute.call_args_list[-1] == call(expected_update)
+
+
+class TestRunPipeline(object):
+
+    @pytest.mark.parametrize('depth', [0, 1, 3])
+    def test(self, depth):
+        loaded = []
+        batches = ([index] * 3 for index in range(10))
+        run_pipeline(batches, lambda batch: [value * 2 for value in batch], loaded.append, depth=depth)
+        assert loaded == [[index * 2] * 3 for index in range(10)]
+
+    @pytest.mark.parametrize('stage', ['fetch', 'transform', 'load'])
+    def test_error(self, stage):
+        def batches():
+            for index in range(10):
+                if stage == 'fetch' and index == 5:
+                    raise RuntimeError('Boom')
+                yield [index]
+
+        def transform(batch):
+            if stage == 'transform' and batch == [5]:
+                raise RuntimeError('Boom')
+            return batch
+
+        def load(batch):
+            if stage == 'load' and batch == [5]:
+                raise RuntimeError('Boom')
+
+        with pytest.raises(RuntimeError):
+            run_pipeline(batches(), transform, load, depth=2)
+
+
+class TestBuildAndThenRewrite(object):
+
+    @patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+    @patch('pganonymize.utils.Replace')
+    @patch('pganonymize.utils.CopyManager')
+    def test(self, copy_manager, replace, quote_ident):
+        columns = [{'email': {'provider': {'name': 'md5'}, 'append': '@localhost'}}]
+        excludes = [{'email': ['admin@']}]
+        mock_cursor = Mock()
+        mock_cursor.fetchall.side_effect = [[], [], [], [('id',), ('name',), ('email',), ('tags',)], [
+            ('id', 'int4', 'integer', True), ('name', 'text', 'text', True), ('email', 'text', 'text', True),
+            ('tags', 'jsonb', 'jsonb', True),
+        ]]
+        mock_cursor.fetchmany.side_effect = [
+            [
+                (1, 'Foo', 'foo@example.com', ['a', 'b']),
+                (2, 'Admin', 'admin@example.com', 'admin'),
+                (3, 'Baz', None, None),
+            ],
+            [],
+        ]
+        connection = Mock(server_version=160000)
+        connection.cursor.return_value = mock_cursor
+        replace.return_value.__enter__ = Mock(return_value='auth_user_abcde')
+        replace.return_value.__exit__ = Mock(return_value=None)
+
+        build_and_then_rewrite_data(connection, 'auth_user', columns, excludes, 3, 10)
+
+        replace.assert_called_once_with(connection, 'auth_user')
+        assert mock_cursor.execute.call_args_list[-1] == call('SELECT "id", "name", "email", "tags" FROM "auth_user"')
+        assert copy_manager.call_args_list == [call(connection, 'auth_user_abcde', ['id', 'name', 'email', 'tags'])]
+        assert copy_manager.return_value.copy.call_args_list == [call([
+            [1, 'Foo', 'b48def645758b95537d4424c84d1a9ff@localhost', b'["a", "b"]'],
+            [2, 'Admin', 'admin@example.com', b'"admin"'],
+            [3, 'Baz', None, None],
+        ])]
+
+    @patch('psycopg2.sql.Literal.as_string', autospec=True, side_effect=literal_as_string)
+    @patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+    @patch('pganonymize.utils.Replace')
+    @patch('pganonymize.utils.CopyManager')
+    @patch('pganonymize.utils.get_column_decoders', return_value=[Mock(), Mock()])
+    @patch('pganonymize.utils.CopyCursor')
+    @pytest.mark.parametrize('primary_key, binary_batches', [['id', True], ['uuid', False], ['ctid', False]])
+    def test_binary_copy(self, copy_cursor, get_column_decoders, copy_manager, replace, quote_ident, literal,
+                         primary_key, binary_batches):
+        columns = [{'email': {'provider': {'name': 'md5'}}}]
+        mock_cursor = Mock()
+        mock_cursor.fetchall.side_effect = [[], [], [], [('id',), ('email',)],
+                                            [('id', 'int4', 'integer', True), ('email', 'text', 'text', True)]]
+        mock_cursor.fetchmany.side_effect = [[(1, 'foo@example.com')], []]
+        connection = Mock(server_version=160000)
+        connection.cursor.return_value = mock_cursor
+        mock_copy_cursor = copy_cursor.return_value
+        mock_copy_cursor.fetchall.side_effect = fetch_batch_rows(mock_copy_cursor, [[(1, 'foo@example.com')]])
+        replace.return_value.__enter__ = Mock(return_value='auth_user_abcde')
+        replace.return_value.__exit__ = Mock(return_value=None)
+
+        build_and_then_rewrite_data(connection, 'auth_user', columns, [], 1, 10, binary_copy=True,
+                                    primary_key=primary_key)
+
+        if binary_batches:
+            assert mock_copy_cursor.execute.call_args_list == [
+                call('SELECT "id", "email" FROM "auth_user" ORDER BY "id" LIMIT 10'),
+                call('SELECT "id", "email" FROM "auth_user" WHERE "id" > 1 ORDER BY "id" LIMIT 10'),
+            ]
+        else:
+            assert not copy_cursor.called
+            assert mock_cursor.execute.call_args_list[-1] == call('SELECT "id", "email" FROM "auth_user"')
+        assert copy_manager.return_value.copy.call_args_list == [call([(1, 'b48def645758b95537d4424c84d1a9ff')])]
+
+    @patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+    @patch('pganonymize.utils.Replace')
+    def test_referenced_table(self, replace, quote_ident):
+        mock_cursor = Mock()
+        mock_cursor.fetchall.return_value = [('auth_user_groups',)]
+        connection = Mock(server_version=160000)
+        connection.cursor.return_value = mock_cursor
+        with pytest.raises(InvalidConfiguration):
+            build_and_then_rewrite_data(connection, 'auth_user', [], [], 3, 10)
+        replace.assert_not_called()
+
+    @patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+    @patch('pganonymize.utils.Replace')
+    @pytest.mark.parametrize('server_version, condition', [
+        [160000, "(attidentity <> '' OR attgenerated <> '')"],
+        [110000, "(attidentity <> '')"],
+    ])
+    def test_generated_columns(self, replace, quote_ident, server_version, condition):
+        mock_cursor = Mock()
+        mock_cursor.fetchall.side_effect = [[], [('id',), ('full_name',)]]
+        connection = Mock(server_version=server_version)
+        connection.cursor.return_value = mock_cursor
+        with pytest.raises(InvalidConfiguration, match='identity or generated columns id, full_name'):
+            build_and_then_rewrite_data(connection, 'auth_user', [], [], 3, 10)
+        assert mock_cursor.execute.call_args == call(
+            'SELECT attname FROM pg_catalog.pg_attribute WHERE attrelid = %s::regclass AND attnum > 0 '
+            'AND NOT attisdropped AND ' + condition + ' ORDER BY attnum', ('"auth_user"',))
+        replace.assert_not_called()
+
+    @patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+    @patch('pganonymize.utils.Replace')
+    def test_materialized_views(self, replace, quote_ident):
+        mock_cursor = Mock()
+        mock_cursor.fetchall.side_effect = [[], [], [('user_stats',)]]
+        connection = Mock(server_version=160000)
+        connection.cursor.return_value = mock_cursor
+        with pytest.raises(InvalidConfiguration, match='the materialized views user_stats depend on it'):
+            build_and_then_rewrite_data(connection, 'auth_user', [], [], 3, 10)
+        sql, args = mock_cursor.execute.call_args[0]
+        assert "c.relkind = 'm'" in sql and args == ('"auth_user"',)
+        replace.assert_not_called()
+
+    @patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+    @patch('pganonymize.utils.Replace')
+    def test_unsupported_types(self, replace, quote_ident):
+        mock_cursor = Mock()
+        mock_cursor.fetchall.side_effect = [[], [], [], [('id',), ('ip',)],
+                                            [('id', 'int4', 'integer', True), ('ip', 'inet', 'inet', False)]]
+        connection = Mock(server_version=160000)
+        connection.cursor.return_value = mock_cursor
+        with pytest.raises(InvalidConfiguration, match=r'Table "sessions" .* columns ip \(inet\) aren'):
+            build_and_then_rewrite_data(connection, 'sessions', [], [], 3, 10)
+        replace.assert_not_called()
+
+
+class TestRebuildIndexes(object):
+
+    @patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+    @pytest.mark.parametrize('column_names', [None, ['email']])
+    def test_get_secondary_indexes(self, quote_ident, column_names):
+        mock_cursor = Mock()
+        mock_cursor.fetchall.return_value = [('auth_user_email', 'CREATE INDEX auth_user_email ON auth_user (email)')]
+        connection = Mock()
+        connection.cursor.return_value = mock_cursor
+        indexes = get_secondary_indexes(connection, 'auth_user', column_names)
+        assert indexes == [('auth_user_email', 'CREATE INDEX auth_user_email ON auth_user (email)')]
+        sql, args = mock_cursor.execute.call_args[0]
+        assert sql.startswith(
+            'SELECT i.indexrelid::regclass::text, pg_catalog.pg_get_indexdef(i.indexrelid) FROM pg_catalog.pg_index i '
+            'WHERE i.indrelid = %s::regclass AND NOT i.indisprimary '
+            'AND NOT EXISTS (SELECT 1 FROM pg_catalog.pg_constraint c WHERE c.conindid = i.indexrelid)')
+        assert ('pg_catalog.pg_depend' in sql) == (column_names is not None)
+        assert args == ['"auth_user"'] + ([column_names] if column_names else [])
+
+    @patch('pganonymize.utils.build_and_then_import_data')
+    @patch('pganonymize.utils.get_row_count', return_value=10)
+    @patch('pganonymize.utils.config')
+    @patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+    @pytest.mark.parametrize('dry_run', [False, True])
+    def test_anonymize_tables(self, quote_ident, mock_config, get_row_count, build_and_import, dry_run):
+        fields = [{'email': {'provider': {'name': 'md5'}}}]
+        mock_config.schema = {'tables': [{'auth_user': {'fields': fields, 'rebuild_indexes': 'columns'}}]}
+        mock_cursor = Mock()
+        mock_cursor.fetchall.return_value = [
+            ('auth_user_email', 'CREATE INDEX auth_user_email ON auth_user (email)'),
+            ('auth_user_lower', 'CREATE INDEX auth_user_lower ON auth_user (lower(email))'),
+        ]
+        connection = Mock()
+        connection.cursor.return_value = mock_cursor
+
+        anonymize_tables(connection, dry_run=dry_run)
+
+        assert build_and_import.call_count == 1
+        executed = [args[0][0] for args in mock_cursor.execute.call_args_list]
+        if dry_run:
+            assert executed == []
+        else:
+            assert executed[1:] == [
+                'DROP INDEX auth_user_email',
+                'DROP INDEX auth_user_lower',
+                'CREATE INDEX auth_user_email ON auth_user (email)',
+                'CREATE INDEX auth_user_lower ON auth_user (lower(email))',
+            ]
+            assert mock_cursor.execute.call_args_list[0][0][1] == ['"auth_user"', ['email']]
+
+
+class TestCheckpoints(object):
+
+    @patch('pganonymize.utils.build_and_then_import_data')
+    @patch('pganonymize.utils.get_row_count', return_value=10)
+    @patch('pganonymize.utils.config')
+    @patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+    def test_anonymize_tables(self, quote_ident, mock_config, get_row_count, build_and_import):
+        fields = [{'first_name': {'provider': {'name': 'clear'}}}]
+        mock_config.schema = {'tables': [{'done': {'fields': fields}}, {'auth_user': {'fields': fields}}]}
+        mock_cursor = Mock()
+        mock_cursor.fetchall.side_effect = [[('done',)], [('', '42')]]
+        connection = Mock()
+        connection.cursor.return_value = mock_cursor
+
+        anonymize_tables(connection, batch_commit=True, resume=True)
+
+        assert build_and_import.call_count == 1
+        assert build_and_import.call_args[0][1] == 'auth_user'
+        assert build_and_import.call_args[1]['checkpoint'] == ''
+        assert build_and_import.call_args[1]['start'] == '42'
+        executed = [args[0][0] for args in mock_cursor.execute.call_args_list]
+        assert executed[0].startswith('CREATE TABLE IF NOT EXISTS "pganonymize_checkpoint"')
+        assert executed[1:] == [
+            'SELECT table_name FROM "pganonymize_checkpoint" WHERE completed',
+            'SELECT scan, last_value FROM "pganonymize_checkpoint" '
+            'WHERE table_name = %s AND index_definition IS NULL AND NOT completed',
+            'DELETE FROM "pganonymize_checkpoint" WHERE table_name = %s',
+            'INSERT INTO "pganonymize_checkpoint" (table_name, scan, completed) VALUES (%s, %s, true)',
+            'DROP TABLE IF EXISTS "pganonymize_checkpoint"',
+        ]
+        assert connection.commit.call_count == 2
+
+    @patch('psycopg2.sql.Literal.as_string', autospec=True, side_effect=literal_as_string)
+    @patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+    @patch('pganonymize.utils.CopyManager')
+    def test_build_and_then_import_data(self, copy_manager, quote_ident, literal):
+        columns = [{'name': {'provider': {'name': 'md5'}}}]
+        mock_cursor = Mock()
+        mock_cursor.fetchall.side_effect = fetch_batch_rows(mock_cursor, [
+            [{'id': 7, 'name': 'a'}, {'id': 9, 'name': 'b'}],
+        ])
+        connection = Mock()
+        connection.cursor.return_value = mock_cursor
+
+        build_and_then_import_data(connection, 'src_tbl', 'id', columns, None, None, 2, 2, batch_commit=True,
+                                   checkpoint='"id" >= 5', start='5')
+
+        execute_calls = mock_cursor.execute.call_args_list
+        assert call('SELECT "id", "name" FROM "src_tbl" WHERE "id" > \'5\' ORDER BY "id" LIMIT 2') in execute_calls
+        assert call(
+            'INSERT INTO "pganonymize_checkpoint" (table_name, scan, last_value) VALUES (%s, %s, %s::text) '
+            'ON CONFLICT (table_name, scan) DO UPDATE SET last_value = EXCLUDED.last_value',
+            ('src_tbl', '"id" >= 5', 9)
+        ) in execute_calls
+        assert connection.commit.call_count == 1
+
+    @patch('pganonymize.utils.build_and_then_import_data')
+    @patch('pganonymize.utils.get_partition_bounds')
+    @patch('pganonymize.utils.get_row_count', return_value=300)
+    @patch('pganonymize.utils.config')
+    @patch('psycopg2.extensions.quote_ident', side_effect=quote_ident)
+    def test_partitions(self, quote_ident, mock_config, get_row_count, get_bounds, build_and_import):
+        fields = [{'first_name': {'provider': {'name': 'clear'}}}]
+        mock_config.schema = {'tables': [{'big': {'partitions': 2, 'fields': fields}}]}
+        mock_cursor = Mock()
+        mock_cursor.fetchall.side_effect = [[], [('"id" < 100', '50'), ('"id" >= 100', None)]]
+        connection = Mock()
+        connection.cursor.return_value = mock_cursor
+        connection_pool = Mock()
+        connection_pool.getconn.side_effect = [Mock(), Mock()]
+
+        anonymize_tables(connection, connection_pool=connection_pool, batch_commit=True, resume=True)
+
+        get_bounds.assert_not_called()
+        assert sorted((args[0][5], args[1]['checkpoint'], args[1]['start'])
+                      for args in build_and_import.call_args_list) == [
+            ('"id" < 100', '"id" < 100', '50'),
+            ('"id" >= 100', '"id" >= 100', None),
+        ]
+
+
+class TestCreateDatabaseDump(object):
+
+    @patch('pganonymize.utils.get_dump_size', return_value=1536)
+    @patch('pganonymize.utils.subprocess.Popen')
+    @pytest.mark.parametrize('kwargs, dump_args, password, expected_cmd', [
+        [
+            {}, '--format custom --compress 9', None,
+            'pg_dump --format custom --compress 9 --verbose --dbname database --username foo --host localhost --port 5432 --file /tmp/dump.gz',  # noqa
+        ],
+        [
+            {}, '--format custom --compress 9', 'pass',
+            'PGPASSWORD=pass pg_dump --format custom --compress 9 --verbose --dbname database --username foo --host localhost --port 5432 --file /tmp/dump.gz',  # noqa
+        ],
+        [
+            {}, '--format plain', None,
+            'pg_dump --format plain --verbose --dbname database --username foo --host localhost --port 5432 --file /tmp/dump.gz',  # noqa
+        ],
+        [
+            {'jobs': 4, 'compress': 'zstd:3'}, '--format custom --compress 9', None,
+            'pg_dump --format custom --compress 9 --format directory --jobs 4 --compress zstd:3 --verbose --dbname database --username foo --host localhost --port 5432 --file /tmp/dump.gz',  # noqa
+        ],
+    ])
+    def test(self, mock_popen, get_dump_size, kwargs, dump_args, password, expected_cmd):
+        mock_popen.return_value.stderr = ['pg_dump: dumping contents of table "public.auth_user"\n']
+        mock_popen.return_value.wait.return_value = 0
+        db_args = {'dbname': 'database', 'user': 'foo', 'host': 'localhost', 'port': 5432}
+        if password:
+            db_args['password'] = password
+        assert create_database_dump('/tmp/dump.gz', db_args, dump_args, **kwargs) == 0
+        mock_popen.assert_called_once_with(expected_cmd, shell=True, stderr=subprocess.PIPE, universal_newlines=True)
+        get_dump_size.assert_called_once_with('/tmp/dump.gz')
+
+    @patch('pganonymize.utils.get_dump_size')
+    @patch('pganonymize.utils.subprocess.Popen')
+    def test_failure(self, mock_popen, get_dump_size):
+        mock_popen.return_value.stderr = ['pg_dump: error: connection failed\n']
+        mock_popen.return_value.wait.return_value = 1
+        db_args = {'dbname': 'database', 'user': 'foo', 'host': 'localhost', 'port': 5432}
+        with patch('pganonymize.utils.logging') as mock_logging:
+            assert create_database_dump('/tmp/dump.gz', db_args, '--format plain') == 1
+        assert call('pg_dump: error: connection failed') in mock_logging.error.call_args_list
+        assert not get_dump_size.called
+
+
+class TestReadDumpLog(object):
+
+    @patch('pganonymize.utils.time')
+    def test_serial(self, mock_time):
+        mock_time.time.side_effect = [0, 1, 3, 4, 4.5, 10]
+        lines = [
+            'pg_dump: last built-in OID is 16383\n',
+            'pg_dump: dumping contents of table "public.big"\n',
+            'pg_dump: dumping contents of table "public.small"\n',
+            'pg_dump: saving encoding = UTF8\n',
+            'pg_dump: dumping contents of table "public.last"\n',
+        ]
+        assert read_dump_log(lines) == {'public.big': 2, 'public.small': 1, 'public.last': 5.5}
+
+    @patch('pganonymize.utils.time')
+    def test_parallel(self, mock_time):
+        mock_time.time.side_effect = [0, 1, 2, 5, 6, 7]
+        lines = [
+            'pg_dump: last built-in OID is 16383\n',
+            'pg_dump: dumping contents of table "public.big"\n',
+            'pg_dump: dumping contents of table "other.small"\n',
+            'pg_dump: finished item 2605 TABLE DATA small\n',
+            'pg_dump: dumping contents of table "public.last"\n',
+            'pg_dump: finished item 2597 TABLE DATA big\n',
+        ]
+        assert read_dump_log(lines, parallel=True) == {'public.big': 6, 'other.small': 3}
+
+
+def test_get_dump_size(tmpdir):
+    directory = tmpdir.mkdir('dump')
+    directory.join('toc.dat').write(b'x' * 10, mode='wb')
+    directory.join('3389.dat.gz').write(b'x' * 20, mode='wb')
+    assert get_dump_size(str(directory)) == 30
+    assert get_dump_size(str(directory.join('toc.dat'))) == 10
+    assert get_dump_size(str(tmpdir.join('missing'))) is None
+
+
+@pytest.mark.parametrize('size, expected', [
+    [None, 'an unknown size'],
+    [512, '512 bytes'],
+    [1536, '1.5 kB'],
+    [5 * 1024 ** 3, '5.0 GB'],
+    [3 * 1024 ** 4, '3.0 TB'],
+])
+def test_format_size(size, expected):
+    assert format_size(size) == expected
@@ -3,3 +3,12 @@ def quote_ident(a, real_db_connection):
     # quote_ident method implementation for test cases,
     # it's used since original implementation requires a proper connection, and not mock
     return '"{}"'.format(a)
+
+
+# Don't use this function anywhere else that tests
+def literal_as_string(literal, real_db_connection):
+    # as_string method implementation of psycopg2.sql.Literal for test cases,
+    # it's used since original implementation requires a proper connection, and not mock
+    if isinstance(literal.wrapped, str):
+        return "'{}'".format(literal.wrapped.replace("'", "''"))
+    return str(literal.wrapped)